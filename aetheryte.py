@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+import argparse
+import importlib
+import metrics
+
+MONITORS = {
+    "ffxiv-undercut": "ffxiv_undercut",
+    "ffxiv-pricecheck": "ffxiv_pricecheck",
+    "wow-undercut": "wow_undercut",
+    "wow-regionpricecheck": "wow_regionpricecheck",
+    "wow-singlepricecheck": "wow_singlepricecheck",
+}
+
+# exit codes for --once, so a cron job or systemd timer can tell what happened
+EXIT_NO_ALERTS = 0
+EXIT_ERROR = 1
+EXIT_ALERTS_SENT = 10
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="aetheryte.py",
+        description="Run a local-aetheryte monitor.",
+    )
+    parser.add_argument("monitor", choices=MONITORS, help="which monitor to run")
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="do one scan and delivery pass and exit, for cron jobs and systemd timers. "
+        + f"exits {EXIT_ALERTS_SENT} if alerts were sent, {EXIT_ERROR} on errors, "
+        + f"{EXIT_NO_ALERTS} otherwise",
+    )
+    return parser.parse_args(argv)
+
+
+def exit_status():
+    """Pick the --once exit code from the metrics of the run, errors take precedence over alerts."""
+    values = metrics.snapshot()
+    if values.get("errors", 0):
+        return EXIT_ERROR
+    if values.get("alerts", 0):
+        return EXIT_ALERTS_SENT
+    return EXIT_NO_ALERTS
+
+
+def main(argv=None):
+    """Run the selected monitor, either on its normal schedule or once.
+    Parameters:
+        - argv (list, optional): Command line arguments, defaults to sys.argv.
+    Returns:
+        - int: The exit code for --once runs, scheduled runs never return.
+    Processing Logic:
+        - Without --once this is the same as running the monitor's script directly.
+        - With --once the monitor's `run_once` does a single pass with no startup sleep,
+          waits for all webhook deliveries and saves its dedupe state.
+        - Any exception during a --once run is reported and counted as an error."""
+    args = parse_args(argv)
+    monitor = importlib.import_module(MONITORS[args.monitor])
+    if not args.once:
+        monitor.main()
+        return EXIT_NO_ALERTS
+
+    try:
+        monitor.run_once()
+    except Exception as ex:
+        print(f"Error: {args.monitor} run failed: {ex!r}")
+        metrics.incr("errors")
+    metrics.report(args.monitor)
+    return exit_status()
+
+
+if __name__ == "__main__":
+    exit(main())
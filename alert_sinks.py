@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import threading
+from discord_delivery import WebhookDispatcher
+import metrics
+from state_store import STATE_DIR
+
+# discord limits for a single webhook message
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+MAX_CONTENT_CHARS = 2000
+# picks the sink of every monitor, e.g. "null" to measure scans without delivery
+SINK_ENV = "AETHERYTE_ALERT_SINK"
+SINKS = ("discord", "jsonl", "stdout", "null")
+
+
+def embed_length(embed):
+    """Return the characters of an embed that count against `MAX_EMBED_CHARS`."""
+    length = len(embed.get("title", "")) + len(embed.get("description", ""))
+    length += len(embed.get("footer", {}).get("text", ""))
+    for field in embed.get("fields", []):
+        length += len(field.get("name", "")) + len(field.get("value", ""))
+    return length
+
+
+class AlertSink:
+    """Where a monitor's rendered alerts go, one batch at a time.
+    Processing Logic:
+        - An alert is either a text message (str) or a Discord embed (dict), and a batch
+          is every alert a check found for one target, e.g. a webhook url.
+        - `submit` may deliver in the background, `flush` waits until it is done, and
+          `send` delivers right away and reports whether it worked.
+        - Subclasses only implement `send`, batching is up to each of them."""
+
+    def submit(self, target, alerts, priority=0):
+        """Deliver a batch, e.g. with the value of its most valuable alert as `priority`."""
+        self.send(target, alerts)
+
+    def send(self, target, alerts):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class DiscordSink(AlertSink):
+    """Post alerts to Discord webhooks, packed into as few messages as Discord allows.
+    Parameters:
+        - mention (str, optional): Discord tag sent with every message, e.g. "<@1234>\\n".
+    Processing Logic:
+        - Embeds go up to `MAX_EMBEDS` and `MAX_EMBED_CHARS` per message, text alerts are
+          joined into messages of up to `MAX_CONTENT_CHARS`.
+        - Every message, sent or submitted, is delivered by the one worker of its webhook
+          within its rate limit, see discord_delivery.py."""
+
+    def __init__(self, mention=""):
+        self.mention = mention
+        self.dispatcher = WebhookDispatcher()
+
+    def payloads(self, alerts):
+        """Return the webhook bodies for a batch of alerts, in order."""
+        payloads = []
+        embeds, chars = [], 0
+        text = ""
+        for alert in alerts:
+            if isinstance(alert, dict):
+                length = embed_length(alert)
+                if embeds and (
+                    len(embeds) == MAX_EMBEDS or chars + length > MAX_EMBED_CHARS
+                ):
+                    payloads.append(self.with_mention({"embeds": embeds}))
+                    embeds, chars = [], 0
+                embeds.append(alert)
+                chars += length
+            elif text and (
+                len(self.mention) + len(text) + 1 + len(alert) > MAX_CONTENT_CHARS
+            ):
+                payloads.append({"content": self.mention + text})
+                text = alert
+            else:
+                text = f"{text}\n{alert}" if text else alert
+        if embeds:
+            payloads.append(self.with_mention({"embeds": embeds}))
+        if text:
+            payloads.append({"content": self.mention + text})
+        return payloads
+
+    def with_mention(self, payload):
+        if self.mention:
+            payload["content"] = self.mention
+        return payload
+
+    def submit(self, target, alerts, priority=0):
+        for payload in self.payloads(alerts):
+            self.dispatcher.submit(target, payload, priority)
+
+    def send(self, target, alerts):
+        results = [
+            self.dispatcher.send(target, payload) for payload in self.payloads(alerts)
+        ]
+        return all([result.result() for result in results])
+
+    def flush(self):
+        self.dispatcher.flush()
+
+
+def target_label(target):
+    """Return a webhook url without its token, so it can be written to a file."""
+    if "/webhooks/" in target:
+        return target.rsplit("/", 1)[0]
+    return target
+
+
+class JsonlSink(AlertSink):
+    """Append every alert to a JSON lines file instead of sending it.
+    Parameters:
+        - path (str): The file, its folder is created if needed.
+        - monitor (str): Written with every alert, so several monitors can share a file.
+    """
+
+    def __init__(self, path, monitor):
+        self.path = path
+        self.monitor = monitor
+        self.lock = threading.Lock()
+
+    def send(self, target, alerts):
+        sent_at = datetime.datetime.now().isoformat(timespec="seconds")
+        lines = "".join(
+            json.dumps(
+                {
+                    "time": sent_at,
+                    "monitor": self.monitor,
+                    "target": target_label(target),
+                    "alert": alert,
+                }
+            )
+            + "\n"
+            for alert in alerts
+        )
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        metrics.incr("sink_alerts", len(alerts))
+        return True
+
+
+class StdoutSink(AlertSink):
+    """Print every alert instead of sending it."""
+
+    def send(self, target, alerts):
+        for alert in alerts:
+            if isinstance(alert, dict):
+                print(f"ALERT {alert.get('title', '')}: {alert.get('description', '')}")
+                for field in alert.get("fields", []):
+                    print(f"  {field.get('name', '')}: {field.get('value', '')}")
+            else:
+                print(f"ALERT {alert}")
+        metrics.incr("sink_alerts", len(alerts))
+        return True
+
+
+class NullSink(AlertSink):
+    """Drop every alert, to measure a monitor's scans without any delivery cost."""
+
+    def send(self, target, alerts):
+        metrics.incr("sink_alerts", len(alerts))
+        return True
+
+
+def make_sink(kind, monitor, mention=""):
+    """Return the sink a monitor's `alert_sink` setting asks for.
+    Parameters:
+        - kind (str): One of `SINKS`, "jsonl" can name its file as "jsonl:alerts.jsonl".
+          AETHERYTE_ALERT_SINK overrides it for every monitor.
+        - monitor (str): The monitor's name, e.g. "ffxiv_undercut".
+        - mention (str, optional): Discord tag for the Discord sink.
+    Returns:
+        - AlertSink: The sink, the script exits on an unknown kind."""
+    kind = os.environ.get(SINK_ENV) or kind
+    name, _, path = kind.partition(":")
+    if name == "discord":
+        return DiscordSink(mention)
+    if name == "jsonl":
+        return JsonlSink(
+            path or os.path.join(STATE_DIR, "alerts", f"{monitor}.jsonl"), monitor
+        )
+    if name == "stdout":
+        return StdoutSink()
+    if name == "null":
+        return NullSink()
+    print(f"Error: unknown alert sink {kind!r}, expected one of {list(SINKS)}")
+    exit(1)
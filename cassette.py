@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+import atexit
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import requests
+from requests.structures import CaseInsensitiveDict
+import saddlebag_api
+
+MODES = ("record", "replay", "replay-timed")
+# headers describing the wire encoding, the stored body is always decoded
+_DROPPED_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+_original_send = requests.Session.send
+_original_sleep = time.sleep
+# a replay that skips this much sleep without asking for a recorded response is stuck,
+# e.g. waiting for an update minute of the wall clock
+REPLAY_IDLE_SECONDS = 3 * 60 * 60
+
+
+class CassetteMiss(requests.exceptions.ConnectionError):
+    """Raised in replay mode for a request that is not on the cassette."""
+
+
+def body_bytes(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    return bytes(body)
+
+
+def request_key(method, url, body):
+    return (method, url, hashlib.sha1(body_bytes(body)).hexdigest())
+
+
+def read_cassette(path):
+    """Load every entry of a gzip JSONL cassette, in the order the requests were made."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class CassetteWriter:
+    """Append request/response entries to a gzip JSONL file as they happen."""
+
+    def __init__(self, path):
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        atexit.register(self.close)
+
+    def write(self, request, status, headers, content, elapsed):
+        entry = {
+            "t": round(time.monotonic() - self.start, 4),
+            "method": request.method,
+            "url": request.url,
+            "body_sha1": request_key(request.method, request.url, request.body)[2],
+            "request_body": base64.b64encode(body_bytes(request.body)).decode(),
+            "status": status,
+            "headers": {
+                k: v for k, v in headers.items() if k.lower() not in _DROPPED_HEADERS
+            },
+            "body": base64.b64encode(content or b"").decode(),
+            "elapsed": elapsed,
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class Player:
+    """Serve recorded responses back for matching requests.
+    Processing Logic:
+        - A request is matched on method, url and an exact hash of its body first.
+        - Only webhook requests fall back to method and url alone, so their time stamped
+          bodies still match, an api request with a different body is a `CassetteMiss`.
+        - Entries are used up in recording order, repeated requests get successive responses.
+        - With `timed` the recorded response time is slept before each response is returned.
+    """
+
+    def __init__(self, entries, timed=False):
+        self.timed = timed
+        self.lock = threading.Lock()
+        self.exact = collections.defaultdict(collections.deque)
+        self.by_url = collections.defaultdict(collections.deque)
+        self.total = 0
+        for entry in entries:
+            self.total += 1
+            self.exact[(entry["method"], entry["url"], entry["body_sha1"])].append(
+                entry
+            )
+            self.by_url[(entry["method"], entry["url"])].append(entry)
+        self.served = 0
+
+    @staticmethod
+    def pop_unused(queue):
+        while queue:
+            entry = queue.popleft()
+            if not entry.get("used"):
+                entry["used"] = True
+                return entry
+        return None
+
+    def take(self, request):
+        key = request_key(request.method, request.url, request.body)
+        with self.lock:
+            entry = self.pop_unused(self.exact.get(key))
+            if entry is None and not saddlebag_api.is_api_url(request.url):
+                entry = self.pop_unused(self.by_url.get(key[:2]))
+            if entry is None:
+                raise CassetteMiss(
+                    f"No recorded response for {request.method} {request.url}",
+                    request=request,
+                )
+            self.served += 1
+        return entry
+
+    def respond(self, request):
+        entry = self.take(request)
+        if self.timed:
+            _original_sleep(entry["elapsed"])
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = base64.b64decode(entry["body"])
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+        response.reason = "Replayed"
+        return response
+
+
+def install(path, mode, transcript_path=None):
+    """Route every request made through `requests` via a cassette.
+    Parameters:
+        - path (str): Cassette file, gzip compressed JSON lines.
+        - mode (str): "record", "replay" or "replay-timed".
+        - transcript_path (str, optional): In replay modes, also record what this run sends to this file.
+    Returns:
+        - None
+    Processing Logic:
+        - record: real requests are made and each request/response pair is written to `path`.
+        - replay: no network access, responses come from `path` and `time.sleep` is skipped
+          so a recorded hour runs at full speed. The run exits once every recorded response
+          was served, or when it skipped `REPLAY_IDLE_SECONDS` of sleep without asking for
+          one, so a monitor's loop never spins on.
+        - replay-timed: like replay, but each response takes as long as it did when recorded
+          and the scripts sleep as usual.
+        - Replays trace allocations and print the request count, wall time and peak memory on exit.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown cassette mode {mode!r}, expected one of {MODES}")
+
+    if mode == "record":
+        writer = CassetteWriter(path)
+
+        def send(session, request, **kwargs):
+            response = _original_send(session, request, **kwargs)
+            content = response.content
+            writer.write(
+                request,
+                response.status_code,
+                response.headers,
+                content,
+                response.elapsed.total_seconds(),
+            )
+            return response
+
+        requests.Session.send = send
+        print(f"Recording all requests to {path}")
+        return
+
+    player = Player(read_cassette(path), timed=mode == "replay-timed")
+    transcript = CassetteWriter(transcript_path) if transcript_path else None
+
+    def send(session, request, **kwargs):
+        response = player.respond(request)
+        if transcript is not None:
+            transcript.write(
+                request,
+                response.status_code,
+                response.headers,
+                response.content,
+                response.elapsed.total_seconds(),
+            )
+        return response
+
+    requests.Session.send = send
+    if mode == "replay":
+        idle = {"served": 0, "seconds": 0.0}
+
+        def skip_sleep(seconds):
+            # worker threads sleep for rate limits, only the monitor's loop decides to stop
+            if threading.current_thread() is not threading.main_thread():
+                return
+            if player.served == player.total:
+                print(f"cassette replay: all {player.total} recorded responses served")
+                sys.exit(0)
+            if player.served != idle["served"]:
+                idle["served"], idle["seconds"] = player.served, 0.0
+            idle["seconds"] += seconds
+            if idle["seconds"] > REPLAY_IDLE_SECONDS:
+                sys.exit(
+                    f"cassette replay: stuck after {player.served} of {player.total} "
+                    + "responses, the rest waits for the wall clock, use replay-timed"
+                )
+
+        time.sleep = skip_sleep
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    def summary():
+        _, peak = tracemalloc.get_traced_memory()
+        print(
+            f"cassette replay: {player.served} requests served in "
+            + f"{time.perf_counter() - start:.3f}s, peak traced memory {peak / 1024:.1f} KiB"
+        )
+
+    atexit.register(summary)
+    print(f"Replaying requests from {path} ({mode})")
+
+
+def install_from_env():
+    """Install a cassette if AETHERYTE_CASSETTE is set.
+    Processing Logic:
+        - AETHERYTE_CASSETTE_MODE picks "record", "replay" (the default) or "replay-timed".
+        - AETHERYTE_CASSETTE_TRANSCRIPT optionally records what a replayed run sends."""
+    path = os.environ.get("AETHERYTE_CASSETTE")
+    if path:
+        install(
+            path,
+            os.environ.get("AETHERYTE_CASSETTE_MODE", "replay"),
+            os.environ.get("AETHERYTE_CASSETTE_TRANSCRIPT"),
+        )
+
+
+def alert_bodies(entries):
+    """Return the request bodies sent to webhooks, with embed footers (the send time) removed."""
+    bodies = []
+    for entry in entries:
+        if saddlebag_api.is_api_url(entry["url"]) or entry["method"] != "POST":
+            continue
+        body = base64.b64decode(entry["request_body"])
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            bodies.append(body)
+            continue
+        for embed in payload.get("embeds", []):
+            embed.pop("footer", None)
+        bodies.append(json.dumps(payload, sort_keys=True).encode("utf-8"))
+    return bodies
+
+
+def diff(expected_path, actual_path):
+    """Compare the alerts of two cassettes byte for byte and print the first difference.
+    Returns:
+        - bool: True if both cassettes sent exactly the same alerts in the same order.
+    """
+    expected = alert_bodies(read_cassette(expected_path))
+    actual = alert_bodies(read_cassette(actual_path))
+    for index, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            print(f"alert {index} differs:\n- {a.decode()}\n+ {b.decode()}")
+            return False
+    if len(expected) != len(actual):
+        print(f"alert count differs: {len(expected)} != {len(actual)}")
+        return False
+    print(f"{len(expected)} alerts identical")
+    return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "diff":
+        exit(0 if diff(sys.argv[2], sys.argv[3]) else 1)
+    print("usage: python cassette.py diff EXPECTED.jsonl.gz ACTUAL.jsonl.gz")
+    exit(2)
@@ -0,0 +1,114 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import sys
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# editors often save by writing a new file and renaming it over the old one,
+# so the directories are watched rather than the files themselves
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+class ConfigError(ValueError):
+    """A config file is missing or invalid, the message says what to fix."""
+
+
+def load_json(path):
+    """Load a JSON config file, raising ConfigError if it is missing or not valid JSON."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ConfigError(f"Error: {path} not found")
+    except json.JSONDecodeError as ex:
+        raise ConfigError(f"Error: {path} is not valid JSON: {ex}")
+
+
+class ConfigWatcher:
+    """Report which config files changed since the last check, without blocking.
+    Parameters:
+        - paths (list): Files to watch, they do not have to exist yet.
+    Processing Logic:
+        - On Linux the directories of the files are watched with inotify through ctypes,
+          events are read from a non blocking descriptor when `changed` is called.
+        - Elsewhere, or if inotify is not available, the size and modification time of
+          each file is compared with the last check instead."""
+
+    def __init__(self, paths):
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.fd = None
+        self.watches = {}
+        self.stats = {path: self.stat(path) for path in self.paths}
+        if sys.platform.startswith("linux"):
+            self.start_inotify()
+
+    @staticmethod
+    def stat(path):
+        try:
+            result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (result.st_mtime_ns, result.st_size)
+
+    def start_inotify(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                # e.g. the directory does not exist yet, polling still notices it later
+                os.close(fd)
+                return
+            self.watches[wd] = directory
+        self.fd = fd
+
+    def read_events(self):
+        """Return the watched files named in pending inotify events."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos + _EVENT.size <= len(data):
+                wd, _, _, length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = data[pos : pos + length].rstrip(b"\0")
+                pos += length
+                path = os.path.join(self.watches.get(wd, ""), os.fsdecode(name))
+                if path in self.paths:
+                    changed.add(path)
+
+    def changed(self):
+        """Return the set of watched paths that changed since the last call."""
+        if self.fd is not None:
+            changed = self.read_events()
+            # keep the stats current too so a later switch to polling does not fire
+            for path in changed:
+                self.stats[path] = self.stat(path)
+            return changed
+        changed = set()
+        for path in self.paths:
+            stat = self.stat(path)
+            if stat != self.stats[path]:
+                self.stats[path] = stat
+                changed.add(path)
+        return changed
@@ -0,0 +1,66 @@
+import time
+import metrics
+
+
+class Deadline:
+    """The time by which a scan cycle has to be done, taken from its schedule.
+    Parameters:
+        - seconds (float): Time from now until the deadline.
+    Processing Logic:
+        - Kept on the monotonic clock, so a deadline can be handed to a shard process
+          on the same machine and still mean the same moment.
+        - Requests made under a deadline use the time left as their timeout, see
+          `saddlebag_api.request_timeout`."""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def at(cls, timestamp):
+        """Return a deadline at the unix time `timestamp`."""
+        return cls(timestamp - time.time())
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+def window_deadline(update_minute, last_offset):
+    """Return a deadline at the end of this hour's WoW check window, which runs up to
+    `last_offset` minutes after the upload minute."""
+    now = time.time()
+    return Deadline.at(now - now % 3600 + (update_minute + last_offset + 1) * 60)
+
+
+def carried_first(items, carried, key):
+    """Return `items` with the ones whose key is in `carried` first, otherwise in order."""
+    return sorted(items, key=lambda item: key(item) not in carried)
+
+
+def check_until(entries, check, deadline=None):
+    """Check (filename, entry) pairs in order until one asks to stop or the deadline passes.
+    Parameters:
+        - entries (list): (filename, entry) tuples.
+        - check (function): Called with filename and entry, returns False to stop the cycle.
+        - deadline (Deadline, optional): When to stop checking.
+    Returns:
+        - list: The entries that were not checked, including the one that stopped the cycle.
+    """
+    for index, (filename, entry) in enumerate(entries):
+        if deadline is not None and deadline.expired():
+            return entries[index:]
+        if not check(filename, entry):
+            return entries[index:]
+    return []
+
+
+def record_skipped(keys):
+    """Count the work a cycle skipped and return its keys, to check them first next cycle."""
+    carried = set(keys)
+    if carried:
+        print(f"Cycle stopped early, {len(carried)} skipped checks go first next cycle")
+        metrics.incr("cycle_skipped", len(carried))
+    metrics.set_gauge("cycle_carried", len(carried))
+    return carried
@@ -0,0 +1,180 @@
+import sys
+import time
+import metrics
+
+# how long an alert is remembered after it was last seen, when its entry does not say
+DEFAULT_KEEP_HOURS = 24
+# seconds between two sweeps for entries that were not seen for their keep time
+EVICT_INTERVAL = 60
+
+
+class Debounce:
+    """When a changed alert is worth sending again, to stop two sellers undercutting
+    each other by 1 gil from sending an alert every cycle.
+    Parameters:
+        - min_change (float, optional): Smallest relative move of a price from the last
+          alert, e.g. 0.02 for 2%, any other change is never held back by it.
+        - hold_seconds (float, optional): How long new values have to stay the same.
+        - cooldown_seconds (float, optional): Shortest time between two alerts of a key.
+    """
+
+    __slots__ = ("min_change", "hold_seconds", "cooldown_seconds")
+
+    def __init__(self, min_change=0.0, hold_seconds=0, cooldown_seconds=0):
+        self.min_change = min_change
+        self.hold_seconds = hold_seconds
+        self.cooldown_seconds = cooldown_seconds
+
+
+def near(old, new, min_change):
+    """Return True if `new` equals `old`, or both are prices less than `min_change` apart."""
+    if old == new:
+        return True
+    if not all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in (old, new)
+    ):
+        return False
+    return bool(old) and abs(new - old) < min_change * abs(old)
+
+
+class Seen:
+    """What was last alerted for one key, what is waiting to be alerted and until when
+    to remember it."""
+
+    __slots__ = (
+        "state",
+        "last_seen",
+        "keep_seconds",
+        "alerted_at",
+        "pending",
+        "pending_since",
+    )
+
+    def __init__(self, state, last_seen, keep_seconds):
+        self.state = state
+        self.last_seen = last_seen
+        self.keep_seconds = keep_seconds
+        self.alerted_at = None
+        self.pending = None
+        self.pending_since = None
+
+    def __setstate__(self, state):
+        # records saved before debouncing only have the first three slots, and older
+        # debounced records still have the alerted price on its own
+        self.__init__(None, 0.0, 0.0)
+        for name, value in state[1].items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
+    def alert(self, state, now):
+        self.state = state
+        self.alerted_at = now
+        self.pending = None
+        self.pending_since = None
+
+    def held_back(self, state, debounce, now):
+        """Return True if `debounce` suppresses alerting `state`, which differs from the
+        last alerted state."""
+        if (
+            self.state is not None
+            and len(state) == len(self.state)
+            and all(
+                near(old, new, debounce.min_change)
+                for old, new in zip(self.state, state)
+            )
+        ):
+            # back near the alerted price, whatever was waiting is churn as well
+            self.pending = None
+            return True
+        if self.pending != state:
+            self.pending = state
+            self.pending_since = now
+        if now - self.pending_since < debounce.hold_seconds:
+            return True
+        if (
+            self.alerted_at is not None
+            and now - self.alerted_at < debounce.cooldown_seconds
+        ):
+            return True
+        return False
+
+
+class DedupeState:
+    """Repeat suppression for alerts, bounded by the listings that are still active.
+    Processing Logic:
+        - Keys are (item, server, detail) tuples of interned strings and ints, so the
+          same server or retainer name is stored once however many items it has.
+        - Each key holds a `Seen` record with the alerted values as a tuple, an alert is
+          new if its key is unknown or its values changed.
+        - With a `Debounce` a change is only new once it passes its thresholds, until
+          then the key keeps its last alerted values and the change waits in `pending`.
+          `min_change` only holds back a change if every number moved less than it and
+          every other value is unchanged.
+        - A key that has not been seen for its entry's `ignore_data_after_hours` is
+          dropped, listings that are gone stop taking up memory."""
+
+    def __init__(self):
+        self.entries = {}
+        self.next_evict = 0.0
+
+    @staticmethod
+    def key(item, server, detail=None):
+        if isinstance(detail, str):
+            detail = sys.intern(detail)
+        if isinstance(item, str):
+            item = sys.intern(item)
+        return (item, sys.intern(str(server)), detail)
+
+    def is_new(self, key, state, keep_hours=None, now=None, debounce=None):
+        """Record `state` for `key` and return True if it differs from the last one.
+        Parameters:
+            - key (tuple): From `DedupeState.key`.
+            - state (tuple): The values that make an alert new when they change.
+            - keep_hours (float, optional): Hours to remember the key after it was last seen.
+            - now (float, optional): Current unix time.
+            - debounce (Debounce, optional): Thresholds a change has to pass to be new.
+        Returns:
+            - bool: True if the key is new or its state changed and was not held back.
+        """
+        now = time.time() if now is None else now
+        keep_seconds = (keep_hours or DEFAULT_KEEP_HOURS) * 3600
+        if now >= self.next_evict:
+            self.evict(now)
+        seen = self.entries.get(key)
+        if seen is None:
+            seen = self.entries[key] = Seen(None, now, keep_seconds)
+        seen.last_seen = now
+        seen.keep_seconds = keep_seconds
+        if seen.state == state:
+            seen.pending = None
+            return False
+        if debounce is not None and seen.held_back(state, debounce, now):
+            metrics.incr("alerts_debounced")
+            return False
+        seen.alert(state, now)
+        return True
+
+    def evict(self, now=None):
+        """Drop every key that was not seen for its keep time, returning how many were dropped."""
+        now = time.time() if now is None else now
+        self.next_evict = now + EVICT_INTERVAL
+        expired = [
+            key
+            for key, seen in self.entries.items()
+            if now - seen.last_seen > seen.keep_seconds
+        ]
+        for key in expired:
+            del self.entries[key]
+        metrics.set_gauge("dedupe_entries", len(self.entries))
+        return len(expired)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        return self.entries
+
+    def __setstate__(self, entries):
+        self.entries = entries
+        self.next_evict = 0.0
@@ -0,0 +1,170 @@
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+import requests
+import metrics
+
+# Discord allows roughly 5 webhook executions per 2 seconds per webhook,
+# the real limits are read back from the response headers once we have them
+DEFAULT_BUCKET_LIMIT = 5
+DEFAULT_BUCKET_WINDOW = 2.0
+MAX_SEND_ATTEMPTS = 3
+
+
+class RateLimitBucket:
+    """Track the Discord rate limit for a single webhook.
+    Parameters:
+        - limit (int): Number of requests allowed per window before the first response is seen.
+        - window (float): Length of the window in seconds.
+    Processing Logic:
+        - Starts with a local estimate and switches to the X-RateLimit headers Discord sends back.
+        - A 429 response blocks the bucket for the `retry_after` time Discord asks for.
+    """
+
+    def __init__(self, limit=DEFAULT_BUCKET_LIMIT, window=DEFAULT_BUCKET_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.remaining <= 0:
+            time.sleep(max(self.reset_at - now, 0))
+            self.remaining = self.limit
+            self.reset_at = time.monotonic() + self.window
+        self.remaining -= 1
+
+    def update(self, response):
+        headers = response.headers
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset-After" in headers:
+                self.reset_at = time.monotonic() + float(
+                    headers["X-RateLimit-Reset-After"]
+                )
+        except ValueError:
+            pass
+
+    def block_for(self, seconds):
+        self.remaining = 0
+        self.reset_at = time.monotonic() + seconds
+
+
+class WebhookWorker(threading.Thread):
+    """Deliver queued payloads to a single webhook, one at a time, within its own rate limit.
+    Payloads waiting for the rate limit are sent highest priority first, and a payload
+    queued with a future gets the result of `deliver` set on it once it went out."""
+
+    def __init__(self, webhook_url):
+        super().__init__(daemon=True)
+        self.webhook_url = webhook_url
+        self.bucket = RateLimitBucket()
+        self.queue = queue.PriorityQueue()
+
+    def run(self):
+        while True:
+            _, _, payload, result = self.queue.get()
+            sent = False
+            try:
+                sent = self.deliver(payload)
+            except requests.exceptions.RequestException as ex:
+                print(f"Failed to send embed to discord: {ex}")
+                metrics.incr("errors")
+            except Exception as ex:
+                # keep the worker alive, otherwise its queue never drains and flush hangs
+                print(f"Unexpected error sending embed to discord: {ex!r}")
+                metrics.incr("errors")
+            finally:
+                if result is not None:
+                    result.set_result(sent)
+                self.queue.task_done()
+
+    def deliver(self, payload):
+        """Post one payload to the webhook, retrying when Discord answers with a 429.
+        Parameters:
+            - payload (dict): JSON body for the webhook, e.g. {"embeds": [...], "content": ""}.
+        Returns:
+            - bool: True if the payload was accepted by Discord.
+        Processing Logic:
+            - Waits for the bucket before every attempt.
+            - On a 429 the bucket is blocked for `retry_after` seconds and the payload is retried.
+            - Any other non 200/204 status is logged and dropped."""
+        for _ in range(MAX_SEND_ATTEMPTS):
+            self.bucket.wait()
+            req = requests.post(self.webhook_url, json=payload)
+            self.bucket.update(req)
+            if req.status_code == 429:
+                try:
+                    retry_after = float(req.json().get("retry_after", 1))
+                except ValueError:
+                    retry_after = 1.0
+                print(f"Rate limited by discord, retrying in {retry_after}s")
+                self.bucket.block_for(retry_after)
+                continue
+            if req.status_code != 204 and req.status_code != 200:
+                print(
+                    f"Failed to send embed to discord: {req.status_code} - {req.text}"
+                )
+                metrics.incr("errors")
+                return False
+            print(f"Embed sent successfully")
+            metrics.incr("webhook_messages_sent")
+            return True
+        print(f"Failed to send embed to discord: still rate limited, giving up")
+        metrics.incr("errors")
+        return False
+
+
+class WebhookDispatcher:
+    """Fan out webhook deliveries to one worker thread per webhook url.
+    Processing Logic:
+        - Each webhook gets its own queue and rate limit bucket so a slow or limited
+          channel never holds up messages for the other channels.
+        - Messages for the same webhook waiting on its rate limit go out highest priority
+          first, messages with the same priority in the order they were submitted.
+        - `flush` blocks until everything submitted so far has been delivered, `send`
+          only until its own payload has."""
+
+    def __init__(self):
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.order = itertools.count()
+
+    def worker_for(self, webhook_url):
+        with self.lock:
+            worker = self.workers.get(webhook_url)
+            if worker is None:
+                worker = WebhookWorker(webhook_url)
+                worker.start()
+                self.workers[webhook_url] = worker
+            return worker
+
+    def submit(self, webhook_url, payload, priority=0):
+        """Queue `payload` for `webhook_url`, e.g. with the value of its alerts as `priority`."""
+        self.worker_for(webhook_url).queue.put(
+            (-priority, next(self.order), payload, None)
+        )
+
+    def send(self, webhook_url, payload, priority=0):
+        """Queue `payload` like `submit` and return a future that is set to True once
+        Discord accepted it, so callers can wait on it without racing the worker."""
+        result = concurrent.futures.Future()
+        self.worker_for(webhook_url).queue.put(
+            (-priority, next(self.order), payload, result)
+        )
+        return result
+
+    def flush(self):
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.queue.join()
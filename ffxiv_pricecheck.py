@@ -1,8 +1,27 @@
-import requests
 import json
 import os
+import sys
 import time
-from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
+import alert_sinks
+from message_templates import PRICECHECK_FIELDS, compile_template
+from config_watch import ConfigError, ConfigWatcher, load_json
+from dedupe import DedupeState, Debounce
+from item_index import items
+from models import decode_pricecheck
+import cassette
+from deadline import Deadline, carried_first, check_until, record_skipped
+import metrics
+from poll_schedule import PollSchedule
+import query_api
+from price_history import PriceHistory
+import saddlebag_api
+import sharding
+import snapshot
+import state_store
+
+# record or replay every request when AETHERYTE_CASSETTE is set
+cassette.install_from_env()
+
 check_path = "pricecheck"
 
 ###### CONFIGURATION ITEMS
@@ -11,8 +30,80 @@ check_path = "pricecheck"
 discordTag = ""
 # Option to 'remember' last undercut and NOT repeat undercut messages
 suppressRepeats = True
+# Format to be used for each price alert. This accepts markdown formatting.
+# Accepted variables:
+# - {item_name} - Name of the item
+# - {link} - Universalis link to the item
+# - {item_id} - Item ID
+# - {server} - Server the listing is on
+# - {dc} - Data center of the server
+# - {min_price} - Lowest price found, use {min_price:,} for thousands separators
+# - {quantity} - Quantity of the lowest listing
+# - {hq} - Whether the listing is HQ
+# Unknown placeholders are reported when the script starts.
+pricecheck_message_template = (
+    "[Universalis Link]({link})\n"
+    + "Server: {server}\n"
+    + "DC: {dc}\n"
+    + "Lowest Price: {min_price:,}\n"
+    + "Quantity: {quantity}\n"
+    + "HQ: {hq}"
+)
+# Order in which price alerts are sent while discord is rate limiting, most valuable first:
+# - "value" - highest {min_price} times {quantity} first
+# - "price" - highest {min_price} first
+# - "none" - in the order they were found
+alert_priority = "value"
+# Where alerts go:
+# - "discord" - the webhooks in the user data
+# - "jsonl" - appended to state/alerts/ffxiv_pricecheck.jsonl, or "jsonl:<file>" for another file
+# - "stdout" - printed instead of sent
+# - "null" - dropped, to measure the scans without any delivery
+# AETHERYTE_ALERT_SINK overrides this for every script.
+alert_sink = "discord"
+# Each server entry is polled as often as its results change, from every
+# poll_min_seconds for busy markets to every poll_max_seconds for quiet ones.
+poll_min_seconds = 60
+poll_max_seconds = 30 * 60
+# Optional limit on saddlebag requests per hour across all entries, None for no limit
+poll_requests_per_hour = None
+# A changed price match is only alerted again once it passes all of these, so two sellers
+# undercutting each other by 1 gil do not send an alert every cycle:
+# - alert_min_change - smallest price or quantity move from the last alert, 0.02 is 2%
+# - alert_hold_seconds - how long the new prices have to stay the same
+# - alert_cooldown_seconds - shortest time between two alerts for the same item and server
+# Set all three to 0 to alert on every change.
+alert_min_change = 0.02
+alert_hold_seconds = 0
+alert_cooldown_seconds = 10 * 60
+# compiled once on load so every row is rendered without re-parsing the template
+render_pricecheck = compile_template(
+    pricecheck_message_template, PRICECHECK_FIELDS, attributes=True
+)
 
-localdata = {}
+# edits are picked up between cycles while main() runs
+webhooks_path = f"./ffxiv_user_data/config/{check_path}/webhooks.json"
+# last match alerted per item, server and quality, see dedupe.py
+localdata = DedupeState()
+# thresholds a changed alert has to pass before it is sent again
+debounce = Debounce(alert_min_change, alert_hold_seconds, alert_cooldown_seconds)
+# where alerts are delivered, the discord sink has one worker per webhook so each
+# server channel has its own rate limit
+sink = alert_sinks.make_sink(alert_sink, "ffxiv_pricecheck", discordTag)
+# one saddlebag request per second, shared by every shard when sharded
+request_budget = sharding.RateBudget()
+# last successful api response per request, reloaded on restart to seed localdata
+responses = snapshot.Snapshot("ffxiv_pricecheck")
+# every lowest price seen, see price_history.py
+history = PriceHistory("ffxiv_pricecheck")
+# latest matches per request, served read only when AETHERYTE_QUERY_PORT is set
+current_results = query_api.results_for("ffxiv_pricecheck")
+# how often each entry's results change and when it is due, see poll_schedule.py
+schedule = PollSchedule(poll_min_seconds, poll_max_seconds, poll_requests_per_hour)
+# seconds between two checks for due entries, also the deadline of each check
+CYCLE_SECONDS = 60
+# keys of the entries the last cycle skipped at its deadline, checked first next cycle
+carried = set()
 
 
 def create_embed(title, description, fields):
@@ -40,37 +131,31 @@ def create_embed(title, description, fields):
     return embed
 
 
-def send_to_discord(embed: dict, webhook_url: str) -> None:
-    # Send message
-    """Send an embed message to a Discord channel using a webhook.
-    Parameters:
-        - embed (dict): The embed object containing message information to be sent to Discord.
-        - webhook_url (str): The URL of the Discord webhook where the message will be sent.
-    Returns:
-        - None: This function does not return any value.
-    Processing Logic:
-        - Performs an HTTP POST request to the specified webhook URL with the embed data.
-        - Checks if the response status code indicates success (either 204 or 200) and prints a success message.
-        - Prints an error message if the response status code is not indicative of success.
-    """
-    print(f"sending embed to discord...")
-    req = requests.post(webhook_url, json={"embeds": [embed], "content": discordTag})
-    if req.status_code != 204 and req.status_code != 200:
-        print(f"Failed to send embed to discord: {req.status_code} - {req.text}")
-    else:
-        print(f"Embed sent successfully")
+def alert_value(match):
+    """Return how valuable a price match is, according to `alert_priority`."""
+    if alert_priority == "value":
+        return (match.min_price or 0) * (match.quantity or 0)
+    if alert_priority == "price":
+        return match.min_price or 0
+    return 0
 
 
-def check_for_new_matches(matches):
+def check_for_new_matches(matches, debounced=True):
     """Check for new matches against existing data.
     Parameters:
-        - matches (list): A list of dictionaries containing details of items, such as itemID, itemName, server, minPrice, minListingQuantity, and match_desire.
+        - matches (list): PriceMatch records, see models.py.
+        - debounced (bool, optional): Hold back small or frequent changes, see `debounce`.
     Returns:
         - list: A list containing new matches that differ from already existing items in local data.
     Processing Logic:
         - If suppressRepeats is False, the function returns the provided matches unchanged.
-        - If suppression is enabled, the function checks each match against stored data to identify new or updated matches.
-        - Updates localdata with the latest information for all item IDs in the matches list.
+        - If suppression is enabled, each match is compared with the last one stored for the same
+          item, server and quality, so one item on several servers is tracked separately.
+        - Updates localdata with the latest information for all matches, matches that are not seen
+          for a day are forgotten.
+        - A change whose numbers moved less than `alert_min_change`, that did not hold for
+          `alert_hold_seconds` or came within `alert_cooldown_seconds` of the last alert is
+          held back, before any message is rendered for it.
     """
     if not suppressRepeats:
         # Do not perform filter checks if suppression is disabled
@@ -79,91 +164,90 @@ def check_for_new_matches(matches):
     new_alerts = []
 
     for match in matches:
-        itemId = match["itemID"]
-        itemName = match["itemName"]
-        server = match["server"]
-        minPrice = match["minPrice"]
-        minListingQuantity = match["minListingQuantity"]
-        match_desire = match["match_desire"]
-
-        if itemId in localdata:
-            existing = localdata[itemId]
-            if (
-                existing["server"] == server
-                and existing["minPrice"] == minPrice
-                and existing["minListingQuantity"] == minListingQuantity
-                and existing["match_desire"] == match_desire
-            ):
-                print(f"{itemName} -- Exact match found")
-            else:
-                print(f"{itemName} -- New sale alert")
-                new_alerts.append(match)
+        key = localdata.key(match.item_id, match.server, match.hq)
+        state = (match.min_price, match.quantity, match.match_desire)
+        if key not in localdata.entries:
+            print(f"{match.item_name} -- First sale alert")
+        elif localdata.entries[key].state == state:
+            print(f"{match.item_name} -- Exact match found")
         else:
-            print(f"{itemName} -- First sale alert")
+            print(f"{match.item_name} -- New sale alert")
+        if localdata.is_new(
+            key,
+            state,
+            debounce=debounce if debounced else None,
+        ):
             new_alerts.append(match)
-
-        # Update localdata with the latest information
-        localdata[itemId] = {
-            "server": server,
-            "minPrice": minPrice,
-            "minListingQuantity": minListingQuantity,
-            "match_desire": match_desire,
-        }
+        elif localdata.entries[key].state != state:
+            print(f"{match.item_name} -- Held back by debounce")
 
     return new_alerts
 
 
-def create_pricecheck_message(json_response, webhook_url):
+def result_rows(matches):
+    """Flatten the price matches of a response into one row per match for the query api."""
+    return [
+        {
+            "item_id": match.item_id,
+            "item_name": match.item_name,
+            "server": match.server,
+            "dc": match.dc,
+            "min_price": match.min_price,
+            "quantity": match.quantity,
+            "hq": match.hq,
+        }
+        for match in matches
+    ]
+
+
+def create_pricecheck_message(matches, webhook_url):
     """Generate a message containing items that match specified price alert criteria and send it to a Discord webhook.
     Parameters:
-        - json_response (dict): Contains information about the items, including whether they match the alert settings.
+        - matches (list): PriceMatch records decoded from the response, see models.py,
+          with the names the api left out filled in from the item index, see item_index.py.
         - webhook_url (str): The URL of the Discord webhook where the message will be sent.
     Returns:
         - None: The function does not return anything explicitly.
     Processing Logic:
-        - Filters out items without a name from the matching list.
+        - Records the lowest price of every match in the price history.
         - Checks for any new matches after applying suppression checks.
-        - Constructs and sends a Discord message only if there are matching items."""
+        - Renders each match with `pricecheck_message_template`, most valuable first, see `alert_value`.
+        - Constructs and sends a Discord message only if there are matching items,
+          prioritized by its most valuable match."""
     title = "Price Alert"
     description = f"List of items that match your price alert settings"
     fields = []
 
-    matching = json_response.get("matching", [])
-    # Get rid of "itemName": false
-    matching = list(filter(lambda x: x["itemName"], matching))
-
+    history.append(
+        (match.item_id, match.server, match.min_price, match.quantity)
+        for match in matches
+    )
     # Perform suppression checks
-    matching = check_for_new_matches(matching)
+    matching = check_for_new_matches(matches)
 
     if len(matching) == 0:
         return
 
+    matching.sort(key=alert_value, reverse=True)
+    priority = alert_value(matching[0])
     for match in matching:
-        item_name = match.pop("itemName")
-        desc = (
-            f"[Universalis Link](https://universalis.app/market/{match['itemID']})\n"
-            + f"Server: {match['server']}\n"
-            + f"DC: {match['dc']}\n"
-            + f"Lowest Price: {'{:,}'.format(match['minPrice'])}\n"
-            + f"Quantity: {match['minListingQuantity']}\n"
-            + f"HQ: {match['hq']}"
-        )
-        fields.append({"name": f"**{item_name}**", "value": desc, "inline": True})
+        desc = render_pricecheck(match)
+        fields.append({"name": f"**{match.item_name}**", "value": desc, "inline": True})
 
     embed = create_embed(title, description, fields)
-    send_to_discord(embed, webhook_url)
+    sink.submit(webhook_url, [embed], priority)
+    metrics.incr("alerts", len(fields))
 
 
-def run_undercut(webhooks):
-    """Processes files to perform price checks and sends results via webhooks.
+def iter_entries(webhooks):
+    """Yield every price check entry in the JSON files of ./ffxiv_user_data/pricecheck.
     Parameters:
         - webhooks (dict): A dictionary mapping filenames to corresponding webhook URLs.
     Returns:
-        - None: This function does not return any value.
+        - generator: (filename, entry) tuples.
     Processing Logic:
         - Skips processing for filenames not present in the webhooks dictionary or with the name "example.json".
         - Validates that each file is a JSON list and that each entry contains required fields with correct types.
-        - Performs API requests for valid entries and sends results to appropriate webhooks.
         - Prints error messages for various situations, such as missing webhooks or invalid data types.
     """
     for filename in os.listdir(f"./ffxiv_user_data/{check_path}"):
@@ -185,41 +269,157 @@ def run_undercut(webhooks):
                     print(f"Error: Failed to decode {filename}")
                     continue
 
-                for entry in data:
-                    pricecheck_fields = {
-                        "home_server": str,
-                        "user_auctions": list,
-                    }
-                    for field, field_type in pricecheck_fields.items():
-                        if field not in entry:
-                            print(f"Error: {filename} is missing {field}")
-                            continue
-                        if not isinstance(entry[field], field_type):
-                            print(f"Error: {filename} has an invalid {field} type")
-                            continue
-
-                    time.sleep(1)
-                    response = requests.post(
-                        f"{URL_BASE}/pricecheck",
-                        headers={
-                            **SADDLEBAG_REQUEST_HEADERS,
-                            "Accept": "application/json",
-                        },
-                        json=entry,
-                    )
-                    if response.status_code == 200:
-                        webhook = webhooks.get(filename.split(".")[0], None)
-                        if webhook is None:
-                            print(f"Error: No webhook found for {entry['server']}")
-                            continue
-                        elif not response.json():
-                            print(
-                                f"No listings found matching prices for | {json.dumps(entry)}"
-                            )
-                            continue
-                        create_pricecheck_message(response.json(), webhook)
-                    else:
-                        print(f"Error: Failed to get a valid response for {filename}")
+            for entry in data:
+                pricecheck_fields = {
+                    "home_server": str,
+                    "user_auctions": list,
+                }
+                for field, field_type in pricecheck_fields.items():
+                    if field not in entry:
+                        print(f"Error: {filename} is missing {field}")
+                        continue
+                    if not isinstance(entry[field], field_type):
+                        print(f"Error: {filename} has an invalid {field} type")
+                        continue
+                yield filename, entry
+
+
+def shard_key(filename, entry):
+    """Return the webhook name an entry is sharded by, see sharding.py.
+    Every entry of a file goes to the file's webhook, so one shard owns its rate limit.
+    """
+    return filename.split(".")[0]
+
+
+def entry_key(entry):
+    """Return the key an entry's response is saved under, it also identifies skipped entries."""
+    return snapshot.request_key("/pricecheck", entry)
+
+
+def check_entry(filename, entry, webhooks, deadline=None):
+    """Request the price matches of one entry and send any new ones to the file's webhook.
+    Parameters:
+        - filename (str): The file the entry came from, its name picks the webhook.
+        - entry (dict): The price check request.
+        - webhooks (dict): A dictionary mapping filenames to corresponding webhook URLs.
+        - deadline (Deadline, optional): The cycle's deadline, see deadline.py.
+    Returns:
+        - bool: False if the api is unavailable or the deadline has passed, and the rest of the
+          cycle should be skipped.
+    Processing Logic:
+        - Returns False without finishing the entry once the deadline has passed.
+        - Waits for a slot of `request_budget` before sending the request.
+        - Tells `schedule` whether the response changed since the last one.
+    """
+    # skip the rest of the cycle without waiting while the api is down
+    if saddlebag_api.is_open("/pricecheck"):
+        print("Saddlebag api is unavailable, skipping this cycle")
+        return False
+    request_budget.wait()
+    try:
+        response_json = saddlebag_api.post_json("/pricecheck", entry, deadline)
+    except saddlebag_api.DeadlineExceeded as ex:
+        print(ex)
+        return False
+    except saddlebag_api.CircuitOpenError:
+        print("Saddlebag api is unavailable, skipping this cycle")
+        return False
+    except saddlebag_api.SaddlebagError as ex:
+        print(f"Error: Failed to get a valid response for {filename}: {ex}")
+        metrics.incr("errors")
+        return True
+    key = entry_key(entry)
+    schedule.record(key, responses.get(key) != response_json)
+    responses.put(key, response_json)
+    matches = items.fill_names("ffxiv", decode_pricecheck(response_json))
+    current_results.publish(key, result_rows(matches))
+    webhook = webhooks.get(filename.split(".")[0], None)
+    if webhook is None:
+        print(f"Error: No webhook found for {entry['server']}")
+        return True
+    elif not response_json:
+        print(f"No listings found matching prices for | {json.dumps(entry)}")
+        return True
+    create_pricecheck_message(matches, webhook)
+    return True
+
+
+def run_undercut(webhooks, deadline=None, only_due=False):
+    """Processes files to perform price checks and sends results via webhooks.
+    Parameters:
+        - webhooks (dict): A dictionary mapping filenames to corresponding webhook URLs.
+        - deadline (Deadline, optional): When the cycle has to stop.
+        - only_due (bool): Only check the entries `schedule` says are due.
+    Returns:
+        - None: This function does not return any value.
+    Processing Logic:
+        - Reads and validates every entry with `iter_entries`.
+        - With `only_due`, only the due entries are checked, most volatile first.
+        - Entries skipped by the previous cycle are checked first.
+        - Checks each entry with `check_entry`, stopping the cycle if the api is unavailable
+          or the deadline has passed. What was found until then is still delivered, and the
+          skipped entries are counted and carried into the next cycle, see deadline.py.
+    """
+    global carried
+    entries = list(iter_entries(webhooks))
+    if only_due:
+        entries = schedule.due_entries(entries, entry_key)
+    entries = carried_first(entries, carried, lambda item: entry_key(item[1]))
+    skipped = check_until(
+        entries,
+        lambda filename, entry: check_entry(filename, entry, webhooks, deadline),
+        deadline,
+    )
+    carried = record_skipped(entry_key(entry) for _, entry in skipped)
+
+
+def warm_start():
+    """Seed the repeat suppression from the responses saved before the last restart.
+    Parameters:
+        - None
+    Returns:
+        - int: The number of saved responses used.
+    Processing Logic:
+        - Runs each saved response through the repeat check without sending anything,
+          so the first scan after a restart only reports what changed while it was down.
+    """
+    keys = responses.keys()
+    for key in keys:
+        json_response = responses.get(key)
+        matches = decode_pricecheck(json_response)
+        check_for_new_matches(matches, debounced=False)
+    if keys:
+        print(f"Warm start from {len(keys)} saved responses")
+    return len(keys)
+
+
+def read_webhooks():
+    """Read the webhook URLs from `webhooks_path`.
+    Parameters:
+        - None
+    Returns:
+        - dict: Webhook URL for each name.
+    Processing Logic:
+        - Raises ConfigError if the file is missing, not JSON or not a map of names to URLs.
+    """
+    webhooks = load_json(webhooks_path)
+    if not isinstance(webhooks, dict) or not all(
+        isinstance(url, str) and url.startswith("http") for url in webhooks.values()
+    ):
+        raise ConfigError(f"Error: {webhooks_path} should map names to webhook urls")
+    return webhooks
+
+
+def reload_webhooks(webhooks):
+    """Return the edited webhooks, or `webhooks` unchanged if the edit is invalid."""
+    try:
+        new_webhooks = read_webhooks()
+    except ConfigError as ex:
+        print(f"{ex}\nKeeping the last good webhooks")
+        metrics.incr("errors")
+        return webhooks
+    print(f"Reloaded {webhooks_path}")
+    return new_webhooks
 
 
 def main():
@@ -231,15 +431,72 @@ def main():
         - None
     Processing Logic:
         - Loads webhook URLs from a JSON file within a specified config directory.
+        - Reloads them before a cycle when the file changes, an invalid edit keeps the old ones.
+        - Seeds the repeat suppression from the last saved responses, see `warm_start`.
+        - With AETHERYTE_SHARDS set the servers are checked by that many worker processes,
+          see sharding.py, each with its own repeat suppression.
         - Continuously runs the `run_undercut` function using these URLs.
-        - Sleeps for 5 minutes between each iteration to prevent constant execution."""
+        - Every `CYCLE_SECONDS` the entries that are due are checked, each entry is polled as
+          often as its results change, see poll_schedule.py.
+        - Each cycle has to finish within `CYCLE_SECONDS`, entries it did not get to go first
+          in the next cycle.
+        - Waits for all queued webhook deliveries to finish and saves the responses before sleeping.
+        - Sleeps `CYCLE_SECONDS` between each iteration to prevent constant execution.
+    """
+    query_api.start_from_env()
+    try:
+        webhooks = read_webhooks()
+    except ConfigError as ex:
+        print(ex)
+        exit(1)
+    watcher = ConfigWatcher([webhooks_path])
+
+    shards = sharding.shard_count_from_env()
+    if shards:
+        pool = sharding.ShardPool("ffxiv_pricecheck", sys.modules[__name__], shards)
+        print(f"Checking the servers in {shards} shards")
+    else:
+        pool = None
+        warm_start()
+    while True:
+        if watcher.changed():
+            webhooks = reload_webhooks(webhooks)
+        deadline = Deadline(CYCLE_SECONDS)
+        if pool:
+            pool.run_cycle(webhooks, deadline)
+        else:
+            run_undercut(webhooks, deadline, only_due=True)
+            sink.flush()
+            responses.save()
+            items.save()
+        metrics.report()
+        print(f"Checking for due entries again in {CYCLE_SECONDS} seconds...")
+        time.sleep(CYCLE_SECONDS)
+
+
+def run_once():
+    """Run a single scan and delivery pass, for cron jobs and systemd timers.
+    Parameters:
+        - None
+    Returns:
+        - None
+    Processing Logic:
+        - Restores the dedupe state saved by the previous run so repeats stay suppressed.
+        - Waits until every queued webhook message is delivered.
+        - Saves the dedupe state for the next run."""
+    global localdata
     with open(f"./ffxiv_user_data/config/{check_path}/webhooks.json") as f:
         webhooks = json.load(f)
 
-    while True:
-        run_undercut(webhooks)
-        print("Sleeping for 5 minutes...")
-        time.sleep(300)
+    localdata = state_store.load("ffxiv_pricecheck", DedupeState())
+    if not isinstance(localdata, DedupeState):
+        # saved by an older version as a plain dict keyed by itemID
+        localdata = DedupeState()
+    run_undercut(webhooks)
+    sink.flush()
+    responses.save()
+    items.save()
+    state_store.save("ffxiv_pricecheck", localdata)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,27 @@
-import requests
 import json
 import os
+import sys
 import time
-from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
+import alert_sinks
+from message_templates import UNDERCUT_FIELDS, compile_template
+from config_watch import ConfigError, ConfigWatcher, load_json
+from dedupe import DedupeState, Debounce
+from item_index import items
+from models import decode_undercut
+import cassette
+from deadline import Deadline, carried_first, check_until, record_skipped
+import metrics
+from poll_schedule import PollSchedule
+import query_api
+from price_history import PriceHistory
+import saddlebag_api
+import sharding
+import snapshot
+import state_store
+
+# record or replay every request when AETHERYTE_CASSETTE is set
+cassette.install_from_env()
+
 ###### CONFIGURATION ITEMS
 # Option to @mention target user or role
 # Populate with your own discord tag e.g. "<@114321431933142431>\n"
@@ -16,11 +35,68 @@ suppressRepeats = True
 # - {my_ppu} - Your current price per unit
 # - {ppu} - The undercut price per unit
 # - {undercut_retainer} - The retainer that undercut you
-# DEFAULT FORMAT: "[{item_name}]({link})"
-# Example: "[{item_name}]({link}) — Mine: {my_ppu}, {undercut_retainer}: {ppu}"
-undercut_message_template = "[{item_name}]({link})"
+# DEFAULT FORMAT: "[{item_name}]({link}) — Mine: {my_ppu}, {undercut_retainer}: {ppu}"
+# Example: "[{item_name}]({link})"
+# Unknown placeholders are reported when the script starts.
+undercut_message_template = (
+    "[{item_name}]({link}) — Mine: {my_ppu}, {undercut_retainer}: {ppu}"
+)
+# Order in which undercuts are sent while discord is rate limiting, most valuable first:
+# - "value" - highest {my_ppu} first
+# - "gap" - biggest difference between {my_ppu} and the undercut {ppu} first
+# - "none" - in the order they were found
+alert_priority = "value"
+# Where alerts go:
+# - "discord" - the webhooks in the user data
+# - "jsonl" - appended to state/alerts/ffxiv_undercut.jsonl, or "jsonl:<file>" for another file
+# - "stdout" - printed instead of sent
+# - "null" - dropped, to measure the scans without any delivery
+# AETHERYTE_ALERT_SINK overrides this for every script.
+alert_sink = "discord"
+# Each server entry is polled as often as its results change, from every
+# poll_min_seconds for busy markets to every poll_max_seconds for quiet ones.
+poll_min_seconds = 60
+poll_max_seconds = 30 * 60
+# Optional limit on saddlebag requests per hour across all entries, None for no limit
+poll_requests_per_hour = None
+# A changed undercut is only alerted again once it passes all of these, so two sellers
+# undercutting each other by 1 gil do not send an alert every cycle:
+# - alert_min_change - smallest price move from the last alert, 0.02 is 2%, a new
+#   undercutting retainer is always alerted
+# - alert_hold_seconds - how long the new prices have to stay the same
+# - alert_cooldown_seconds - shortest time between two alerts for the same item and retainer
+# Set all three to 0 to alert on every change.
+alert_min_change = 0.02
+alert_hold_seconds = 0
+alert_cooldown_seconds = 10 * 60
+# compiled once on load so every row is rendered without re-parsing the template
+render_undercut = compile_template(
+    undercut_message_template, UNDERCUT_FIELDS, attributes=True
+)
 
-localdata = {}
+# edits are picked up between cycles while main() runs
+webhooks_path = "./ffxiv_user_data/config/undercut/webhooks.json"
+# last undercut alerted per item, server and retainer, see dedupe.py
+localdata = DedupeState()
+# thresholds a changed alert has to pass before it is sent again
+debounce = Debounce(alert_min_change, alert_hold_seconds, alert_cooldown_seconds)
+# where alerts are delivered, the discord sink has one worker per webhook so each
+# server channel has its own rate limit
+sink = alert_sinks.make_sink(alert_sink, "ffxiv_undercut", discordTag)
+# one saddlebag request per second, shared by every shard when sharded
+request_budget = sharding.RateBudget()
+# last successful api response per request, reloaded on restart to seed localdata
+responses = snapshot.Snapshot("ffxiv_undercut")
+# every competing price seen, see price_history.py
+history = PriceHistory("ffxiv_undercut")
+# latest auctions per request, served read only when AETHERYTE_QUERY_PORT is set
+current_results = query_api.results_for("ffxiv_undercut")
+# how often each entry's results change and when it is due, see poll_schedule.py
+schedule = PollSchedule(poll_min_seconds, poll_max_seconds, poll_requests_per_hour)
+# seconds between two checks for due entries, also the deadline of each check
+CYCLE_SECONDS = 60
+# keys of the entries the last cycle skipped at its deadline, checked first next cycle
+carried = set()
 
 
 def create_embed(title, description, fields):
@@ -48,131 +124,130 @@ def create_embed(title, description, fields):
     return embed
 
 
-def organize_by_retainer(auction_data):
-    """Organizes auction data by retainer name.
+def organize_by_retainer(auctions):
+    """Organizes auctions by retainer name.
     Parameters:
-        - auction_data (dict): A dictionary containing auction item details, where each key is an item ID, and each value is another dictionary with auction information including the retainer's name.
+        - auctions (list): UndercutAuction records, see models.py.
     Returns:
-        - dict: A dictionary where each key is a retainer name and each value is a list of auction details corresponding to that retainer.
+        - dict: A dictionary where each key is a retainer name and each value is a list of the auctions of that retainer.
     Processing Logic:
-        - Iterates over each auction item in `auction_data`.
-        - Groups auction details under the key corresponding to the retainer's name.
+        - Iterates over each auction in `auctions`.
+        - Groups the auctions under the key corresponding to the retainer's name.
         - Creates an entry for the retainer if it does not exist in the result dictionary.
     """
     auctions_by_retainer = {}
-    for item_id, details in auction_data.items():
-        retainer_name = details["my_retainer"]
-        if retainer_name not in auctions_by_retainer:
-            auctions_by_retainer[retainer_name] = []
-        auctions_by_retainer[retainer_name].append(details)
+    for auction in auctions:
+        if auction.retainer not in auctions_by_retainer:
+            auctions_by_retainer[auction.retainer] = []
+        auctions_by_retainer[auction.retainer].append(auction)
     return auctions_by_retainer
 
 
-def send_to_discord(embed, webhook_url):
-    # Send message
-    """Send an embed message to a Discord channel using a webhook.
-    Parameters:
-        - embed (dict): JSON-serializable dictionary representing the Discord embed to be sent.
-        - webhook_url (str): URL of the Discord webhook through which the embed message will be sent.
-    Returns:
-        - None
-    Processing Logic:
-        - The function sends the provided embed to the specified Discord webhook URL.
-        - A successful request will result in console output indicating success.
-        - If the request fails, it logs the status code and error message to the console.
-    """
-    print(f"sending embed to discord...")
-    req = requests.post(webhook_url, json={"embeds": [embed], "content": discordTag})
-    if req.status_code != 204 and req.status_code != 200:
-        print(f"Failed to send embed to discord: {req.status_code} - {req.text}")
-    else:
-        print(f"Embed sent successfully")
+def alert_value(auction):
+    """Return how valuable an undercut is to deal with, according to `alert_priority`."""
+    if alert_priority == "value":
+        return auction.my_ppu
+    if alert_priority == "gap":
+        return auction.my_ppu - auction.ppu
+    return 0
 
 
-def check_auction_is_new(auction, server):
+def check_auction_is_new(auction, server, keep_hours=None, debounced=True):
     """Check if the auction data is new or suppressed from repeats based on the existing local data.
     Parameters:
-        - auction (dict): Auction details including 'real_name', 'my_ppu', 'ppu', and 'undercut_retainer'.
+        - auction (UndercutAuction): The auction, see models.py.
         - server (str): The name of the server where the auction is hosted.
+        - keep_hours (float, optional): The entry's `ignore_data_after_hours`, how long the auction
+          is remembered after it was last seen.
+        - debounced (bool, optional): Hold back small or frequent changes, see `debounce`.
     Returns:
         - bool: Indicates if the auction data is new or not, where 'True' means it's new.
     Processing Logic:
-        - Compares the given auction data with existing data stored locally using a composed key.
+        - Compares the given auction data with the last data stored for the item, server and retainer.
         - Updates the local storage if the auction data is new.
         - Returns 'True' if entry is not found in local data, or if the auction attributes do not match existing entries. Returns 'False' if all attributes match and suppressRepeats is enabled.
+        - A change whose prices moved less than `alert_min_change`, that did not hold
+          for `alert_hold_seconds` or came within `alert_cooldown_seconds` of the last alert
+          is held back, before any message is rendered for it.
         - Always returns 'True' if suppressRepeats is disabled."""
-    if suppressRepeats:
-        real_name = auction["real_name"]
-        my_ppu = auction["my_ppu"]
-        ppu = auction["ppu"]
-        undercut_retainer = auction["undercut_retainer"]
-        localdataKey = f"{real_name}-{server}"
-
-        # Check if the entry exists in localdata
-        if localdataKey in localdata:
-            # Get the existing entry
-            existing_entry = localdata[localdataKey]
-
-            # Check if all attributes match
-            if (
-                existing_entry["my_ppu"] == my_ppu
-                and existing_entry["ppu"] == ppu
-                and existing_entry["undercut_retainer"] == undercut_retainer
-            ):
-                print(f"{real_name} -- Exact match found")
-                is_new_undercut = False
-            else:
-                is_new_undercut = True
-                print(f"{real_name} -- New undercut data")
-        else:
-            is_new_undercut = True
-            print(f"{real_name} -- First undercut")
-
-        # Update localdata with the latest information
-        localdata[localdataKey] = {
-            "my_ppu": my_ppu,
-            "ppu": ppu,
-            "undercut_retainer": undercut_retainer,
-        }
-
-        return is_new_undercut
-    else:
+    if not suppressRepeats:
         # Always return True if suppressing repeats is disabled
         return True
+    key = localdata.key(auction.item_id, server, auction.retainer)
+    state = (auction.my_ppu, auction.ppu, auction.undercut_retainer)
+    if key not in localdata.entries:
+        print(f"{auction.item_name} -- First undercut")
+    elif localdata.entries[key].state == state:
+        print(f"{auction.item_name} -- Exact match found")
+    else:
+        print(f"{auction.item_name} -- New undercut data")
+    if localdata.is_new(
+        key,
+        state,
+        keep_hours,
+        debounce=debounce if debounced else None,
+    ):
+        return True
+    if localdata.entries[key].state != state:
+        print(f"{auction.item_name} -- Held back by debounce")
+    return False
 
 
-def create_undercut_message(json_response, webhook_url):
-    """Create a formatted message identifying undercut auctions from a JSON response and send it to a specified Discord webhook.
+def result_rows(server, auctions):
+    """Flatten the undercut auctions of a server into one row per auction for the query api."""
+    return [
+        {
+            "item_id": auction.item_id,
+            "item_name": auction.item_name,
+            "server": server,
+            "retainer": auction.retainer,
+            "my_ppu": auction.my_ppu,
+            "ppu": auction.ppu,
+            "undercut_retainer": auction.undercut_retainer,
+            "link": auction.link,
+        }
+        for auction in auctions
+    ]
+
+
+def create_undercut_message(server, auctions, webhook_url, keep_hours=None):
+    """Create a formatted message identifying undercut auctions of a server and send it to a specified Discord webhook.
     Parameters:
-        - json_response (dict): The JSON data containing auction and server information.
+        - server (str): The server of the auctions.
+        - auctions (list): UndercutAuction records decoded from the response, see models.py.
         - webhook_url (str): The Discord webhook URL for sending the message.
+        - keep_hours (float, optional): The request's `ignore_data_after_hours`, see `check_auction_is_new`.
     Returns:
         - None: This function does not return any value.
     Processing Logic:
-        - Organizes auction data by retainer name from the provided JSON data.
-        - Generates a list of undercut auctions per retainer, including auction details and links.
-        - Creates and sends an embedded message to a Discord channel if undercuts are found.
+        - Records the undercut price of every auction in the price history.
+        - Organizes the auctions by retainer name.
+        - Generates a list of undercut auctions per retainer, rendered with `undercut_message_template`
+          and sorted by `alert_value`.
+        - Creates and sends an embedded message to a Discord channel if undercuts are found,
+          prioritized by its most valuable undercut.
     """
-    server = json_response["server"]
+    history.append((auction.item_id, server, auction.ppu, None) for auction in auctions)
     title = f"Undercuts - {server}"
     description = "List of items that are being undercut!"
     fields = []
+    priority = 0
 
-    auctions_by_retainer = organize_by_retainer(json_response.get("auction_data", {}))
+    auctions_by_retainer = organize_by_retainer(auctions)
 
     for retainer, details in auctions_by_retainer.items():
         values = []
-        for auction in details:
-            if check_auction_is_new(auction, server):
-                values.append(
-                    f"[{auction['real_name']}]({auction['link']}) — Mine: {auction['my_ppu']}, {auction['undercut_retainer']}: {auction['ppu']}"
-                )
+        for auction in sorted(details, key=alert_value, reverse=True):
+            if check_auction_is_new(auction, server, keep_hours):
+                priority = max(priority, alert_value(auction))
+                values.append(render_undercut(auction))
         value = "\n".join(values)
         if values:
             fields.append({"name": f"**{retainer}**", "value": value, "inline": True})
+            metrics.incr("alerts", len(values))
     if fields:
         embed = create_embed(title, description, fields)
-        send_to_discord(embed, webhook_url)
+        sink.submit(webhook_url, [embed], priority)
 
 
 ## not using embeds, but handles case of too much text
@@ -206,17 +281,15 @@ def create_undercut_message(json_response, webhook_url):
 #         send_to_discord(message_content + message_content_body, webhook_url, server)
 
 
-def run_undercut(webhooks):
-    """Run undercut processing for files in a specific directory, sending requests to a predefined API based on the data from JSON files.
+def iter_entries(webhooks):
+    """Yield every undercut entry in the JSON files of ./ffxiv_user_data/undercut.
     Parameters:
-        - webhooks (dict): A dictionary mapping server names to webhook URLs. Used to determine where to send notifications.
+        - webhooks (dict): A dictionary mapping server names to webhook URLs.
     Returns:
-        - None
+        - generator: (filename, entry) tuples.
     Processing Logic:
         - Skips processing for files named "example.json" and those not present in the webhooks list.
         - Validates that JSON files contain a list and each list entry has required fields of specific types.
-        - Sends a POST request to an API endpoint for processing data in valid entries.
-        - Fetches the appropriate webhook from the provided dictionary to send notifications based on the server name.
     """
     for filename in os.listdir("./ffxiv_user_data/undercut"):
         if filename == "example.json":
@@ -237,44 +310,164 @@ def run_undercut(webhooks):
                     print(f"Error: Failed to decode {filename}")
                     continue
 
-                for entry in data:
-                    undercut_fields = {
-                        "retainer_names": list,
-                        "server": str,
-                        "ignore_ids": list,
-                        "add_ids": list,
-                        "hq_only": bool,
-                    }
-                    for field, field_type in undercut_fields.items():
-                        if field not in entry:
-                            print(f"Error: {filename} is missing {field}")
-                            continue
-                        if not isinstance(entry[field], field_type):
-                            print(f"Error: {filename} has an invalid {field} type")
-                            continue
-
-                    time.sleep(1)
-                    response = requests.post(
-                        f"{URL_BASE}/undercut",
-                        headers={
-                            **SADDLEBAG_REQUEST_HEADERS,
-                            "Accept": "application/json",
-                        },
-                        json=entry,
-                    )
-                    if response.status_code == 200:
-                        webhook = webhooks.get(entry["server"], None)
-                        if webhook is None:
-                            print(f"Error: No webhook found for {entry['server']}")
-                            continue
-                        elif not response.json():
-                            print(
-                                f"No auctions found or not undercut at all for | {json.dumps(entry)}"
-                            )
-                            continue
-                        create_undercut_message(response.json(), webhook)
-                    else:
-                        print(f"Error: Failed to get a valid response for {filename}")
+            for entry in data:
+                undercut_fields = {
+                    "retainer_names": list,
+                    "server": str,
+                    "ignore_ids": list,
+                    "add_ids": list,
+                    "hq_only": bool,
+                }
+                for field, field_type in undercut_fields.items():
+                    if field not in entry:
+                        print(f"Error: {filename} is missing {field}")
+                        continue
+                    if not isinstance(entry[field], field_type):
+                        print(f"Error: {filename} has an invalid {field} type")
+                        continue
+                yield filename, entry
+
+
+def shard_key(filename, entry):
+    """Return the server an entry is sharded by, see sharding.py, it also picks the webhook."""
+    return entry["server"]
+
+
+def entry_key(entry):
+    """Return the key an entry's response is saved under, it also identifies skipped entries."""
+    return snapshot.request_key("/undercut", entry)
+
+
+def check_entry(filename, entry, webhooks, deadline=None):
+    """Request the undercuts of one entry and send any new ones to its server's webhook.
+    Parameters:
+        - filename (str): The file the entry came from, for error messages.
+        - entry (dict): The undercut request.
+        - webhooks (dict): A dictionary mapping server names to webhook URLs.
+        - deadline (Deadline, optional): The cycle's deadline, see deadline.py.
+    Returns:
+        - bool: False if the api is unavailable or the deadline has passed, and the rest of the
+          cycle should be skipped.
+    Processing Logic:
+        - Returns False without finishing the entry once the deadline has passed.
+        - Waits for a slot of `request_budget` before sending the request.
+        - Tells `schedule` whether the response changed since the last one.
+        - Fetches the appropriate webhook from the provided dictionary to send notifications based on the server name.
+    """
+    # skip the rest of the cycle without waiting while the api is down
+    if saddlebag_api.is_open("/undercut"):
+        print("Saddlebag api is unavailable, skipping this cycle")
+        return False
+    request_budget.wait()
+    try:
+        response_json = saddlebag_api.post_json("/undercut", entry, deadline)
+    except saddlebag_api.DeadlineExceeded as ex:
+        print(ex)
+        return False
+    except saddlebag_api.CircuitOpenError:
+        print("Saddlebag api is unavailable, skipping this cycle")
+        return False
+    except saddlebag_api.SaddlebagError as ex:
+        print(f"Error: Failed to get a valid response for {filename}: {ex}")
+        metrics.incr("errors")
+        return True
+    key = entry_key(entry)
+    schedule.record(key, responses.get(key) != response_json)
+    responses.put(key, response_json)
+    auctions = items.fill_names("ffxiv", decode_undercut(response_json))
+    current_results.publish(key, result_rows(entry["server"], auctions))
+    webhook = webhooks.get(entry["server"], None)
+    if webhook is None:
+        print(f"Error: No webhook found for {entry['server']}")
+        return True
+    elif not response_json:
+        print(f"No auctions found or not undercut at all for | {json.dumps(entry)}")
+        return True
+    create_undercut_message(
+        response_json["server"],
+        auctions,
+        webhook,
+        entry.get("ignore_data_after_hours"),
+    )
+    return True
+
+
+def run_undercut(webhooks, deadline=None, only_due=False):
+    """Run undercut processing for files in a specific directory, sending requests to a predefined API based on the data from JSON files.
+    Parameters:
+        - webhooks (dict): A dictionary mapping server names to webhook URLs. Used to determine where to send notifications.
+        - deadline (Deadline, optional): When the cycle has to stop.
+        - only_due (bool): Only check the entries `schedule` says are due.
+    Returns:
+        - None
+    Processing Logic:
+        - Reads and validates every entry with `iter_entries`.
+        - With `only_due`, only the due entries are checked, most volatile first.
+        - Entries skipped by the previous cycle are checked first.
+        - Checks each entry with `check_entry`, stopping the cycle if the api is unavailable
+          or the deadline has passed. What was found until then is still delivered, and the
+          skipped entries are counted and carried into the next cycle, see deadline.py.
+    """
+    global carried
+    entries = list(iter_entries(webhooks))
+    if only_due:
+        entries = schedule.due_entries(entries, entry_key)
+    entries = carried_first(entries, carried, lambda item: entry_key(item[1]))
+    skipped = check_until(
+        entries,
+        lambda filename, entry: check_entry(filename, entry, webhooks, deadline),
+        deadline,
+    )
+    carried = record_skipped(entry_key(entry) for _, entry in skipped)
+
+
+def warm_start():
+    """Seed the repeat suppression from the responses saved before the last restart.
+    Parameters:
+        - None
+    Returns:
+        - int: The number of saved responses used.
+    Processing Logic:
+        - Runs each saved response through the repeat check without sending anything,
+          so the first scan after a restart only reports what changed while it was down.
+    """
+    keys = responses.keys()
+    for key in keys:
+        json_response = responses.get(key)
+        for auction in decode_undercut(json_response):
+            check_auction_is_new(auction, json_response["server"], debounced=False)
+    if keys:
+        print(f"Warm start from {len(keys)} saved responses")
+    return len(keys)
+
+
+def read_webhooks():
+    """Read the webhook URLs from `webhooks_path`.
+    Parameters:
+        - None
+    Returns:
+        - dict: Webhook URL for each name.
+    Processing Logic:
+        - Raises ConfigError if the file is missing, not JSON or not a map of names to URLs.
+    """
+    webhooks = load_json(webhooks_path)
+    if not isinstance(webhooks, dict) or not all(
+        isinstance(url, str) and url.startswith("http") for url in webhooks.values()
+    ):
+        raise ConfigError(f"Error: {webhooks_path} should map names to webhook urls")
+    return webhooks
+
+
+def reload_webhooks(webhooks):
+    """Return the edited webhooks, or `webhooks` unchanged if the edit is invalid."""
+    try:
+        new_webhooks = read_webhooks()
+    except ConfigError as ex:
+        print(f"{ex}\nKeeping the last good webhooks")
+        metrics.incr("errors")
+        return webhooks
+    print(f"Reloaded {webhooks_path}")
+    return new_webhooks
 
 
 def main():
@@ -286,15 +479,72 @@ def main():
         - None
     Processing Logic:
         - Loads webhook URLs from './ffxiv_user_data/config/undercut/webhooks.json'.
+        - Reloads them before a cycle when the file changes, an invalid edit keeps the old ones.
+        - Seeds the repeat suppression from the last saved responses, see `warm_start`.
+        - With AETHERYTE_SHARDS set the servers are checked by that many worker processes,
+          see sharding.py, each with its own repeat suppression.
         - The `run_undercut` function is called with the loaded webhooks.
-        - The function enters a loop that waits for 5 minutes between each execution."""
+        - Every `CYCLE_SECONDS` the entries that are due are checked, each entry is polled as
+          often as its results change, see poll_schedule.py.
+        - Each cycle has to finish within `CYCLE_SECONDS`, entries it did not get to go first
+          in the next cycle.
+        - Waits for all queued webhook deliveries to finish and saves the responses before sleeping.
+        - The function enters a loop that waits `CYCLE_SECONDS` between each execution.
+    """
+    query_api.start_from_env()
+    try:
+        webhooks = read_webhooks()
+    except ConfigError as ex:
+        print(ex)
+        exit(1)
+    watcher = ConfigWatcher([webhooks_path])
+
+    shards = sharding.shard_count_from_env()
+    if shards:
+        pool = sharding.ShardPool("ffxiv_undercut", sys.modules[__name__], shards)
+        print(f"Checking the servers in {shards} shards")
+    else:
+        pool = None
+        warm_start()
+    while True:
+        if watcher.changed():
+            webhooks = reload_webhooks(webhooks)
+        deadline = Deadline(CYCLE_SECONDS)
+        if pool:
+            pool.run_cycle(webhooks, deadline)
+        else:
+            run_undercut(webhooks, deadline, only_due=True)
+            sink.flush()
+            responses.save()
+            items.save()
+        metrics.report()
+        print(f"Checking for due entries again in {CYCLE_SECONDS} seconds...")
+        time.sleep(CYCLE_SECONDS)
+
+
+def run_once():
+    """Run a single scan and delivery pass, for cron jobs and systemd timers.
+    Parameters:
+        - None
+    Returns:
+        - None
+    Processing Logic:
+        - Restores the dedupe state saved by the previous run so repeats stay suppressed.
+        - Waits until every queued webhook message is delivered.
+        - Saves the dedupe state for the next run."""
+    global localdata
     with open("./ffxiv_user_data/config/undercut/webhooks.json") as f:
         webhooks = json.load(f)
 
-    while True:
-        run_undercut(webhooks)
-        print("Sleeping for 5 minutes...")
-        time.sleep(300)
+    localdata = state_store.load("ffxiv_undercut", DedupeState())
+    if not isinstance(localdata, DedupeState):
+        # saved by an older version as a plain dict
+        localdata = DedupeState()
+    run_undercut(webhooks)
+    sink.flush()
+    responses.save()
+    items.save()
+    state_store.save("ffxiv_undercut", localdata)
 
 
 if __name__ == "__main__":
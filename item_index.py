@@ -0,0 +1,259 @@
+import contextlib
+import csv
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import metrics
+from state_store import STATE_DIR
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+# file layout: header, a hash table of (kind, item id, name offset, name length) slots,
+# then the UTF-8 names. Empty slots have kind 0.
+MAGIC = b"AEITEM1\0"
+_HEADER = struct.Struct("<8sI")
+_SLOT = struct.Struct("<IIII")
+MIN_SLOTS = 64
+# item ids of both games and wow battle pet species ids, which overlap with item ids
+KINDS = {"ffxiv": 1, "wow": 2, "wow_pet": 3}
+
+
+def slot_hash(code, item_id):
+    return (item_id * 0x9E3779B1 + code) & 0xFFFFFFFF
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on `path` against other processes, e.g. other monitors."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ItemIndex:
+    """Item names by game and id, kept in a memory mapped hash table on disk.
+    Parameters:
+        - path (str, optional): Index file, defaults to `state/items.index`.
+    Processing Logic:
+        - A lookup hashes the id to its slot and reads only that slot and the name, the
+          file is never read as a whole, so a lookup costs the same however many items
+          the index holds.
+        - Names the api sends are remembered in memory and written by `save`, which also
+          merges in whatever another monitor saved in the meantime. Saves of several
+          monitors or shards take turns through a lock file next to the index.
+        - Names can also be imported in bulk from a CSV file, see `import_csv`.
+        - A missing or unreadable file is treated as an empty index."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(STATE_DIR, "items.index")
+        self.lock = threading.Lock()
+        self.mm = None
+        self.slot_count = None
+        self.added = {}
+
+    def open(self):
+        if self.slot_count is not None:
+            return
+        self.slot_count = 0
+        try:
+            with open(self.path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError, OSError):
+            # ValueError is an empty file, which cannot be mapped
+            return
+        try:
+            magic, slot_count = _HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC:
+                raise ValueError("not an item index file")
+            if _HEADER.size + slot_count * _SLOT.size > len(self.mm):
+                raise ValueError("item index file is truncated")
+            self.slot_count = slot_count
+        except (struct.error, ValueError) as ex:
+            print(f"Error: could not read item index {self.path}, starting empty: {ex}")
+            self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.slot_count = None
+
+    def lookup(self, code, item_id):
+        """Return the saved name of one item, the lock must be held and the file open."""
+        if not self.slot_count:
+            return None
+        mask = self.slot_count - 1
+        slot = slot_hash(code, item_id) & mask
+        for _ in range(self.slot_count):
+            slot_code, slot_id, offset, length = _SLOT.unpack_from(
+                self.mm, _HEADER.size + slot * _SLOT.size
+            )
+            if slot_code == 0:
+                return None
+            if slot_code == code and slot_id == item_id:
+                return self.mm[offset : offset + length].decode("utf-8")
+            slot = (slot + 1) & mask
+        return None
+
+    def saved_items(self):
+        """Yield ((kind code, item id), name) for every saved item."""
+        for slot in range(self.slot_count or 0):
+            code, item_id, offset, length = _SLOT.unpack_from(
+                self.mm, _HEADER.size + slot * _SLOT.size
+            )
+            if code:
+                yield (code, item_id), self.mm[offset : offset + length].decode("utf-8")
+
+    def name(self, kind, item_id):
+        """Return the name of an item, or None if it was never seen.
+        Parameters:
+            - kind (str): One of `KINDS`, e.g. "ffxiv".
+            - item_id (int): Item id, or battle pet species id for "wow_pet"."""
+        key = (KINDS[kind], int(item_id))
+        with self.lock:
+            if key in self.added:
+                return self.added[key]
+            self.open()
+            return self.lookup(*key)
+
+    def remember(self, kind, item_id, name):
+        """Record the name of an item, written to disk by the next `save`."""
+        if not name or not isinstance(name, str):
+            return
+        key = (KINDS[kind], int(item_id))
+        with self.lock:
+            if self.added.get(key) == name:
+                return
+            self.open()
+            if self.lookup(*key) != name:
+                self.added[key] = name
+
+    def fill_names(self, kind, records):
+        """Remember the item names the api sent and fill in the ones it left out.
+        Parameters:
+            - kind (str): One of `KINDS`.
+            - records (list): Records with `item_id` and `item_name` fields, see models.py.
+        Returns:
+            - list: The records, an item that was never named gets "Item <id>"."""
+        filled = []
+        for record in records:
+            if record.item_name:
+                self.remember(kind, record.item_id, record.item_name)
+            else:
+                name = self.name(kind, record.item_id) or f"Item {record.item_id}"
+                record = record._replace(item_name=name)
+            filled.append(record)
+        return filled
+
+    def save(self):
+        """Write the remembered names together with the saved ones, replacing the file atomically.
+        A save that fails is reported and the names are kept for the next one."""
+        with self.lock:
+            if not self.added:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with file_lock(f"{self.path}.lock"):
+                    self.write()
+            except OSError as ex:
+                print(f"Error: could not save item index {self.path}: {ex}")
+                metrics.incr("errors")
+                return
+            self.added = {}
+
+    def write(self):
+        """Merge the remembered names into the file, the lock and the file lock must be held."""
+        # map the file again, another monitor may have saved names since it was opened
+        self.close()
+        self.open()
+        names = dict(self.saved_items())
+        names.update(self.added)
+
+        slot_count = MIN_SLOTS
+        while slot_count < 2 * len(names):
+            slot_count *= 2
+        mask = slot_count - 1
+        slots = bytearray(slot_count * _SLOT.size)
+        blob = bytearray()
+        offset = _HEADER.size + len(slots)
+        for (code, item_id), name in names.items():
+            encoded = name.encode("utf-8")
+            slot = slot_hash(code, item_id) & mask
+            while _SLOT.unpack_from(slots, slot * _SLOT.size)[0]:
+                slot = (slot + 1) & mask
+            _SLOT.pack_into(
+                slots,
+                slot * _SLOT.size,
+                code,
+                item_id,
+                offset + len(blob),
+                len(encoded),
+            )
+            blob += encoded
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".",
+            prefix=f"{os.path.basename(self.path)}.",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, slot_count))
+                f.write(slots)
+                f.write(blob)
+            # the old file has to be unmapped before it can be replaced on windows
+            self.close()
+            os.replace(tmp_path, self.path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def import_csv(self, path):
+        """Remember every row of a CSV file with the columns kind, item_id and name, then save.
+        Returns:
+            - int: The number of rows read."""
+        count = 0
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                self.remember(row["kind"], row["item_id"], row["name"])
+                count += 1
+        self.save()
+        return count
+
+
+# shared by every monitor in the process
+items = ItemIndex()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        print(f"Imported {items.import_csv(sys.argv[2])} names into {items.path}")
+        exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == "lookup" and sys.argv[2] in KINDS:
+        print(items.name(sys.argv[2], sys.argv[3]))
+        exit(0)
+    print(
+        "usage: python item_index.py import ITEMS.csv\n"
+        + f"       python item_index.py lookup {{{','.join(KINDS)}}} ID"
+    )
+    exit(2)
@@ -0,0 +1,105 @@
+import codecs
+import json
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """Buffer decoded text from an iterable of byte chunks, dropping what has been consumed."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def read_more(self):
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            text = self.text_decoder.decode(chunk)
+            if text:
+                # drop everything already parsed so the buffer only holds the current value
+                self.buf = self.buf[self.pos :] + text
+                self.pos = 0
+                return True
+        self.buf = self.buf[self.pos :] + self.text_decoder.decode(b"", final=True)
+        self.pos = 0
+        self.exhausted = True
+        return False
+
+    def next_char(self):
+        """Skip whitespace and return the next character without consuming it, or None at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return None
+
+    def expect(self, chars):
+        char = self.next_char()
+        if char is None or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON stream, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value, reading more chunks until it is complete.
+        Processing Logic:
+            - A decode is only trusted when text follows the value, so a number split
+              across two chunks is never cut short.
+            - On a failed decode the buffer is grown to at least double its size before
+              retrying, which keeps the re-parsing of large values linear overall."""
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            target = 2 * (len(self.buf) - self.pos)
+            while len(self.buf) - self.pos < target and self.read_more():
+                pass
+
+
+def iter_member_items(chunks, member):
+    """Stream the key/value pairs of one object member of a top level JSON object.
+    Parameters:
+        - chunks (iterable): Raw bytes of the JSON document, e.g. `response.iter_content(65536)`.
+        - member (str): Top level key of the object to stream, e.g. "results_by_realm".
+    Returns:
+        - generator: Yields (key, value) tuples one at a time while the document is still being read.
+    Processing Logic:
+        - Other top level members are decoded and discarded as they are passed.
+        - Only the pair currently being decoded is held in memory.
+        - Raises ValueError if the document is not an object or the member is missing.
+    """
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.next_char() == "}":
+        raise ValueError(f"{member} not found in JSON stream")
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == member:
+            break
+        reader.value()
+        if reader.expect(",}") == "}":
+            raise ValueError(f"{member} not found in JSON stream")
+
+    reader.expect("{")
+    if reader.next_char() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        yield key, reader.value()
+        if reader.expect(",}") == "}":
+            return
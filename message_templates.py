@@ -0,0 +1,114 @@
+from string import Formatter
+
+# Placeholders each formatter fills in, user templates may only use these
+UNDERCUT_FIELDS = ("item_name", "link", "my_ppu", "ppu", "undercut_retainer")
+PRICECHECK_FIELDS = (
+    "item_name",
+    "link",
+    "item_id",
+    "server",
+    "dc",
+    "min_price",
+    "quantity",
+    "hq",
+)
+WOW_UNDERCUT_FIELDS = ("item_name", "link", "item_id", "lowest_price", "user_price")
+WOW_PRICECHECK_FIELDS = (
+    "item_name",
+    "link",
+    "item_id",
+    "ah_price",
+    "desired_state",
+    "realm_names",
+)
+
+_CONVERSIONS = {"s": "str", "r": "repr", "a": "ascii"}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def parse_template(template, fields):
+    """Split a message template into literal text and placeholders, validating every placeholder.
+    Parameters:
+        - template (str): Template using str.format syntax, e.g. "[{item_name}]({link})".
+        - fields (tuple): Placeholder names the formatter supplies.
+    Returns:
+        - list: (literal, field_name, format_spec, conversion) tuples, field_name is None for trailing text.
+    Processing Logic:
+        - Collects every unknown placeholder and raises a single TemplateError listing them.
+        - Rejects positional "{}" placeholders, attribute/index access and nested format specs.
+    """
+    try:
+        parsed = list(Formatter().parse(template))
+    except ValueError as ex:
+        raise TemplateError(f"Invalid template {template!r}: {ex}")
+
+    unknown = []
+    for _, field_name, format_spec, conversion in parsed:
+        if field_name is None:
+            continue
+        if field_name not in fields:
+            unknown.append("{" + field_name + "}")
+        elif conversion and conversion not in _CONVERSIONS:
+            raise TemplateError(
+                f"Invalid template {template!r}: unknown conversion !{conversion}"
+            )
+        elif format_spec and "{" in format_spec:
+            raise TemplateError(
+                f"Invalid template {template!r}: nested placeholders in format specs are not supported"
+            )
+    if unknown:
+        raise TemplateError(
+            f"Unknown placeholders {', '.join(unknown)} in template {template!r}, "
+            + f"accepted placeholders are: {', '.join('{' + f + '}' for f in fields)}"
+        )
+    return parsed
+
+
+def format_value(value, format_spec):
+    """Format a value with a template's format spec, a missing (None) value is shown as is."""
+    if value is None:
+        return "None"
+    return format(value, format_spec)
+
+
+def compile_template(template, fields, attributes=False):
+    """Compile a message template once into a render function.
+    Parameters:
+        - template (str): Template using str.format syntax.
+        - fields (tuple): Placeholder names the formatter supplies.
+        - attributes (bool, optional): Read the fields as attributes of a record, see models.py,
+          instead of as dict keys.
+    Returns:
+        - function: render(values) taking a dict (or record) with the template fields and returning the message text.
+    Processing Logic:
+        - Validates the template up front, so bad placeholders fail at startup and not per message.
+        - Generates a function that joins the literal text with the formatted values,
+          so rendering a row never re-parses the template.
+        - A field that is None is shown as is whatever its format spec, e.g. a listing
+          without a price under `{min_price:,}`."""
+    parsed = parse_template(template, fields)
+    pieces = []
+    for literal, field_name, format_spec, conversion in parsed:
+        if literal:
+            pieces.append(repr(literal))
+        if field_name is None:
+            continue
+        value = f"v.{field_name}" if attributes else f"v[{field_name!r}]"
+        if conversion:
+            value = f"{_CONVERSIONS[conversion]}({value})"
+        if format_spec:
+            pieces.append(f"format_value({value}, {format_spec!r})")
+        else:
+            pieces.append(f"format({value}, '')")
+
+    source = "def render(v):\n    return " + (
+        "".join(["''.join((", ", ".join(pieces), ",))"]) if pieces else "''"
+    )
+    namespace = {"format_value": format_value}
+    exec(compile(source, f"<template {template!r}>", "exec"), namespace)
+    render = namespace["render"]
+    render.template = template
+    return render
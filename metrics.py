@@ -0,0 +1,60 @@
+import threading
+
+# process wide counters and gauges, printed at the end of each cycle
+_lock = threading.Lock()
+counters = {}
+gauges = {}
+
+
+def incr(name, value=1):
+    """Add `value` to the counter `name`, creating it at zero if needed."""
+    with _lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """Set the gauge `name` to its latest `value`."""
+    with _lock:
+        gauges[name] = value
+
+
+def snapshot():
+    """Return a copy of all counters and gauges as a single dict."""
+    with _lock:
+        return {**counters, **gauges}
+
+
+def drain():
+    """Return (counters, gauges) and reset the counters, for handing them to another process."""
+    global counters
+    with _lock:
+        drained = (counters, dict(gauges))
+        counters = {}
+        return drained
+
+
+def merge(drained):
+    """Add counters and set gauges returned by `drain` in another process."""
+    drained_counters, drained_gauges = drained
+    with _lock:
+        for name, value in drained_counters.items():
+            counters[name] = counters.get(name, 0) + value
+        gauges.update(drained_gauges)
+
+
+def report(title="metrics"):
+    """Print every counter and gauge on one line, sorted by name.
+    Parameters:
+        - title (str): Label printed in front of the values.
+    Returns:
+        - None"""
+    values = snapshot()
+    if not values:
+        return
+    formatted = []
+    for name in sorted(values):
+        value = values[name]
+        if isinstance(value, float):
+            value = round(value, 4)
+        formatted.append(f"{name}={value}")
+    print(f"{title}: {' '.join(formatted)}")
@@ -0,0 +1,143 @@
+from typing import NamedTuple, Optional, Union
+
+# Saddlebag responses are decoded into these records once, as soon as they arrive.
+# Dedupe, message templates, price history, the query api and metrics all read the
+# same records, which are immutable tuples without a per-instance __dict__.
+# Field names match the message template placeholders in message_templates.py.
+
+Number = Union[int, float]
+
+
+def number(value):
+    """Parse a price or quantity from the api, keeping whole numbers as int."""
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value
+    parsed = float(value)
+    return int(parsed) if parsed.is_integer() else parsed
+
+
+class UndercutAuction(NamedTuple):
+    """One of our FFXIV listings that is undercut, from /undercut."""
+
+    item_id: int
+    item_name: str
+    retainer: str
+    my_ppu: Number
+    ppu: Number
+    undercut_retainer: str
+    link: str
+
+    @classmethod
+    def from_json(cls, item_id, auction):
+        return cls(
+            int(item_id),
+            auction["real_name"],
+            auction["my_retainer"],
+            number(auction["my_ppu"]),
+            number(auction["ppu"]),
+            auction["undercut_retainer"],
+            auction["link"],
+        )
+
+
+def decode_undercut(json_response):
+    """Return the auctions of an /undercut response as UndercutAuction records."""
+    if not json_response:
+        return []
+    return [
+        UndercutAuction.from_json(item_id, auction)
+        for item_id, auction in json_response.get("auction_data", {}).items()
+    ]
+
+
+class PriceMatch(NamedTuple):
+    """A FFXIV listing that meets a price alert, from /pricecheck.
+    `item_name`, `min_price` and `quantity` are None when the api did not send them."""
+
+    item_id: int
+    item_name: Optional[str]
+    server: str
+    dc: str
+    min_price: Optional[Number]
+    quantity: Optional[Number]
+    hq: bool
+    match_desire: object
+
+    @property
+    def link(self):
+        return f"https://universalis.app/market/{self.item_id}"
+
+    @classmethod
+    def from_json(cls, match):
+        return cls(
+            int(match["itemID"]),
+            match["itemName"] or None,
+            match["server"],
+            match["dc"],
+            number(match.get("minPrice")),
+            number(match.get("minListingQuantity")),
+            match["hq"],
+            match["match_desire"],
+        )
+
+
+def decode_pricecheck(json_response):
+    """Return the matches of a /pricecheck response as PriceMatch records."""
+    if not json_response:
+        return []
+    return [PriceMatch.from_json(match) for match in json_response.get("matching", [])]
+
+
+class WowUndercut(NamedTuple):
+    """An undercut or not found item of a realm, from /wow/regionundercut."""
+
+    item_id: int
+    item_name: str
+    link: str
+    lowest_price: Optional[Number]
+    user_price: Optional[Number]
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(
+            int(value["item_id"]),
+            value["item_name"],
+            value["link"],
+            number(value["lowest_price"]),
+            number(value["user_price"]),
+        )
+
+
+class WowSnipe(NamedTuple):
+    """An auction that meets a WoW price alert, from /wow/regionpricecheck or /wow/pricecheck."""
+
+    item_id: int
+    item_name: str
+    link: str
+    ah_price: Optional[Number]
+    desired_state: str
+    realm_names: str
+
+    @classmethod
+    def from_json(cls, auction, realm_names=None):
+        """`realm_names` replaces the realms of the auction, e.g. with the requested realm."""
+        return cls(
+            int(auction["item_id"]),
+            auction["item_name"],
+            auction["link"],
+            number(auction["ah_price"]),
+            auction["desired_state"],
+            auction["realm_names"] if realm_names is None else realm_names,
+        )
+
+
+def decode_snipes(json_response, realm_names=None):
+    """Return the matches of a WoW price check response as WowSnipe records."""
+    if not json_response:
+        return []
+    return [
+        WowSnipe.from_json(auction, realm_names)
+        for auction in json_response.get("matching", [])
+    ]
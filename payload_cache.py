@@ -0,0 +1,96 @@
+import gzip
+import json
+import time
+import requests
+import metrics
+
+# status codes a server uses to turn down a gzip encoded request body
+GZIP_REJECTED_STATUS = (400, 411, 413, 415)
+# urls that refused gzip once, these get plain bodies from then on
+gzip_rejected = set()
+
+
+class EncodedPayload:
+    """A request body serialized once, kept as compact JSON and as gzip."""
+
+    __slots__ = ("body", "gzip_body", "encode_seconds")
+
+    def __init__(self, body, gzip_body, encode_seconds):
+        self.body = body
+        self.gzip_body = gzip_body
+        self.encode_seconds = encode_seconds
+
+
+class PayloadCache:
+    """Reuse an encoded request body until its source changes.
+    Processing Logic:
+        - `key` identifies the source data, e.g. a hash of the file the payload is built from.
+        - The payload is only rebuilt and re-encoded when a different key is passed to `get`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = None
+        self.payload = None
+
+    def get(self, key, build):
+        """Return the encoded payload for `key`, calling `build()` for the payload dict on a miss.
+        Parameters:
+            - key (hashable): Identity of the source data.
+            - build (function): Returns the JSON-serializable payload.
+        Returns:
+            - EncodedPayload: Compact JSON bytes, gzip bytes and the time it took to encode them.
+        """
+        if self.payload is not None and key == self.key:
+            metrics.incr(f"{self.name}_payload_cache_hits")
+            return self.payload
+        start = time.perf_counter()
+        body = json.dumps(build(), separators=(",", ":")).encode("utf-8")
+        # mtime=0 keeps the bytes identical for identical payloads
+        gzip_body = gzip.compress(body, mtime=0)
+        encode_seconds = time.perf_counter() - start
+        self.key = key
+        self.payload = EncodedPayload(body, gzip_body, encode_seconds)
+        metrics.set_gauge(f"{self.name}_payload_encode_seconds", encode_seconds)
+        metrics.set_gauge(f"{self.name}_payload_json_bytes", len(body))
+        metrics.set_gauge(f"{self.name}_payload_gzip_bytes", len(gzip_body))
+        return self.payload
+
+
+def post_payload(name, url, payload, headers, **kwargs):
+    """POST an encoded payload, gzip compressed unless the server has refused gzip before.
+    Parameters:
+        - name (str): Metrics prefix for this payload.
+        - url (str): Endpoint to post to.
+        - payload (EncodedPayload): The cached request body.
+        - headers (dict): Extra request headers.
+        - kwargs: Passed through to `requests.post`, e.g. stream=True.
+    Returns:
+        - requests.Response: The response to the accepted request.
+    Processing Logic:
+        - Sends the gzip body with `Content-Encoding: gzip`.
+        - If the server answers with a rejection status the plain body is sent instead,
+          and the url is remembered so later calls go straight to plain JSON.
+        - Bytes put on the wire are added to the `<name>_payload_bytes_sent` counter."""
+    headers = {**headers, "Content-Type": "application/json"}
+    if url not in gzip_rejected:
+        response = requests.post(
+            url,
+            headers={**headers, "Content-Encoding": "gzip"},
+            data=payload.gzip_body,
+            **kwargs,
+        )
+        metrics.incr(f"{name}_payload_bytes_sent", len(payload.gzip_body))
+        if response.status_code not in GZIP_REJECTED_STATUS:
+            return response
+        response.close()
+        print(f"gzip request body rejected by {url}, retrying with plain JSON")
+        response = requests.post(url, headers=headers, data=payload.body, **kwargs)
+        metrics.incr(f"{name}_payload_bytes_sent", len(payload.body))
+        # only stop compressing if the plain body is what made the difference
+        if response.status_code not in GZIP_REJECTED_STATUS:
+            gzip_rejected.add(url)
+        return response
+    response = requests.post(url, headers=headers, data=payload.body, **kwargs)
+    metrics.incr(f"{name}_payload_bytes_sent", len(payload.body))
+    return response
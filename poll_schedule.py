@@ -0,0 +1,103 @@
+import time
+import metrics
+
+# weight of the latest poll in the change rate, higher reacts faster to a market waking up
+ALPHA = 0.3
+# change rate assumed for an entry that was never polled, about the old fixed 5 minutes
+INITIAL_RATE = 0.5
+
+
+class PollState:
+    """How often one entry's results changed and when to poll it next."""
+
+    __slots__ = ("rate", "next_poll")
+
+    def __init__(self, rate, next_poll):
+        self.rate = rate
+        self.next_poll = next_poll
+
+
+class PollSchedule:
+    """Poll each server entry as often as its results actually change.
+    Parameters:
+        - min_seconds (float): Shortest time between two polls of an entry.
+        - max_seconds (float): Longest time between two polls of an entry.
+        - requests_per_hour (int, optional): Global limit on polls, unlimited if None.
+    Processing Logic:
+        - Each poll updates an exponentially weighted moving average of whether the
+          response changed, from 0 (never changes) to 1 (changes every poll).
+        - The next poll is `max_seconds * (min_seconds / max_seconds) ** rate` later, so a
+          market that always changes is polled every `min_seconds` and a quiet one every
+          `max_seconds`.
+        - Due entries come most volatile first, and with `requests_per_hour` set only as
+          many as the budget allows are handed out, the rest stay due.
+        - Entries that are no longer configured are forgotten."""
+
+    def __init__(self, min_seconds, max_seconds, requests_per_hour=None):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.requests_per_hour = requests_per_hour
+        self.entries = {}
+        self.tokens = self.capacity()
+        self.refilled_at = None
+
+    def capacity(self):
+        """Polls the budget can save up, enough to poll every entry once per `max_seconds`."""
+        if self.requests_per_hour is None:
+            return None
+        return max(self.requests_per_hour * self.max_seconds / 3600, 1)
+
+    def rate(self, key):
+        state = self.entries.get(key)
+        return INITIAL_RATE if state is None else state.rate
+
+    def due(self, keys, now=None):
+        """Return the keys that should be polled now, most volatile first.
+        Parameters:
+            - keys (list): Keys of every configured entry.
+            - now (float, optional): Current unix time.
+        Returns:
+            - list: The due keys, at most what the request budget allows."""
+        now = time.time() if now is None else now
+        configured = set(keys)
+        for key in [key for key in self.entries if key not in configured]:
+            del self.entries[key]
+        due = [
+            key
+            for key in keys
+            if key not in self.entries or self.entries[key].next_poll <= now
+        ]
+        due.sort(key=self.rate, reverse=True)
+        if self.requests_per_hour is not None:
+            if self.refilled_at is not None:
+                self.tokens = min(
+                    self.tokens
+                    + (now - self.refilled_at) * self.requests_per_hour / 3600,
+                    self.capacity(),
+                )
+            self.refilled_at = now
+            due = due[: int(self.tokens)]
+            self.tokens -= len(due)
+        metrics.set_gauge("poll_due", len(due))
+        metrics.set_gauge("poll_entries", len(configured))
+        return due
+
+    def due_entries(self, entries, key):
+        """Return the (filename, entry) pairs that are due, see `due`, `key` maps an entry to its key."""
+        by_key = {key(entry): (filename, entry) for filename, entry in entries}
+        return [by_key[due_key] for due_key in self.due(list(by_key))]
+
+    def record(self, key, changed, now=None):
+        """Update the change rate of `key` after a poll and schedule its next one.
+        Parameters:
+            - key (str): The polled entry.
+            - changed (bool): Whether the response differed from the previous one.
+            - now (float, optional): Current unix time."""
+        now = time.time() if now is None else now
+        rate = ALPHA * bool(changed) + (1 - ALPHA) * self.rate(key)
+        interval = self.max_seconds * (self.min_seconds / self.max_seconds) ** rate
+        self.entries[key] = PollState(rate, now + interval)
+        if changed:
+            metrics.incr("polls_changed")
+        else:
+            metrics.incr("polls_unchanged")
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+import array
+import bisect
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from state_store import STATE_DIR
+
+HISTORY_DIR = os.path.join(STATE_DIR, "price_history")
+# one file per column in every day partition, with its array type code
+COLUMNS = (
+    ("timestamp", "d"),
+    ("item", "q"),
+    ("server", "i"),
+    ("price", "d"),
+    ("quantity", "q"),
+)
+# days older than this are reduced to the lowest price per item, server and hour
+DOWNSAMPLE_AFTER_DAYS = 7
+# days older than this are deleted
+RETENTION_DAYS = 90
+# marks a partition that has been downsampled and sorted by item
+DOWNSAMPLED_MARKER = "downsampled"
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def read_partition(path):
+    """Read every column of a day partition into arrays, cut to the length of the shortest column."""
+    columns = {}
+    for name, code in COLUMNS:
+        values = array.array(code)
+        column_path = os.path.join(path, name)
+        with open(column_path, "rb") as f:
+            values.fromfile(f, os.path.getsize(column_path) // values.itemsize)
+        columns[name] = values
+    # a crash between column writes leaves some columns a row longer than others
+    rows = min(len(values) for values in columns.values())
+    for name, values in columns.items():
+        del values[rows:]
+    return columns
+
+
+def write_partition(path, columns):
+    """Replace a day partition with `columns`, writing to a new directory first."""
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, _ in COLUMNS:
+        with open(os.path.join(tmp_path, name), "wb") as f:
+            columns[name].tofile(f)
+    open(os.path.join(tmp_path, DOWNSAMPLED_MARKER), "w").close()
+    old_path = f"{path}.old"
+    os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path)
+
+
+class PriceHistory:
+    """Append-only price history of one monitor, stored by day with one file per column.
+    Parameters:
+        - name (str): Monitor name, each monitor appends to its own files so rows never interleave.
+    Processing Logic:
+        - Each cycle's prices are appended to the current day's column files with `array.tofile`.
+        - Server and realm names are stored as indexes into `servers.txt`.
+        - On the first append of a day, days older than `DOWNSAMPLE_AFTER_DAYS` are reduced to the
+          lowest price per item, server and hour and sorted by item, days older than
+          `RETENTION_DAYS` are deleted.
+        - Queries read the column files of the days asked for, sorted days are searched with bisect.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(HISTORY_DIR, name)
+        self.lock = threading.Lock()
+        self.servers = None
+        self.server_ids = None
+        self.last_day = None
+
+    def load_servers(self):
+        if self.servers is not None:
+            return
+        try:
+            with open(os.path.join(self.path, "servers.txt"), encoding="utf-8") as f:
+                self.servers = f.read().splitlines()
+        except FileNotFoundError:
+            self.servers = []
+        self.server_ids = {name: index for index, name in enumerate(self.servers)}
+
+    def server_id(self, name):
+        name = str(name)
+        if name not in self.server_ids:
+            with open(
+                os.path.join(self.path, "servers.txt"), "a", encoding="utf-8"
+            ) as f:
+                f.write(f"{name}\n")
+            self.server_ids[name] = len(self.servers)
+            self.servers.append(name)
+        return self.server_ids[name]
+
+    def append(self, rows, timestamp=None):
+        """Record the prices seen in one cycle.
+        Parameters:
+            - rows (iterable): (item_id, server, price, quantity) tuples, quantity may be None.
+            - timestamp (float, optional): Unix time the prices were seen, defaults to now.
+        Returns:
+            - int: The number of rows written."""
+        timestamp = time.time() if timestamp is None else timestamp
+        day = day_of(timestamp)
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            self.load_servers()
+            if day != self.last_day:
+                self.last_day = day
+                self.compact(timestamp)
+            columns = {name: array.array(code) for name, code in COLUMNS}
+            for item_id, server, price, quantity in rows:
+                if price is None:
+                    continue
+                columns["timestamp"].append(timestamp)
+                columns["item"].append(int(item_id))
+                columns["server"].append(self.server_id(server))
+                columns["price"].append(float(price))
+                columns["quantity"].append(int(quantity or 0))
+            if not columns["item"]:
+                return 0
+            partition = os.path.join(self.path, day)
+            os.makedirs(partition, exist_ok=True)
+            for name, _ in COLUMNS:
+                with open(os.path.join(partition, name), "ab") as f:
+                    columns[name].tofile(f)
+            return len(columns["item"])
+
+    def partitions(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if len(name) == 10 and name[4] == "-")
+
+    def compact(self, now=None):
+        """Downsample and delete old days, see the class docstring."""
+        now = time.time() if now is None else now
+        downsample_before = day_of(now - DOWNSAMPLE_AFTER_DAYS * 86400)
+        delete_before = day_of(now - RETENTION_DAYS * 86400)
+        for day in self.partitions():
+            path = os.path.join(self.path, day)
+            if day < delete_before:
+                shutil.rmtree(path)
+            elif day < downsample_before and not os.path.exists(
+                os.path.join(path, DOWNSAMPLED_MARKER)
+            ):
+                self.downsample(path)
+
+    def downsample(self, path):
+        columns = read_partition(path)
+        lowest = {}
+        for timestamp, item_id, server, price, quantity in zip(
+            *(columns[name] for name, _ in COLUMNS)
+        ):
+            key = (item_id, server, int(timestamp // 3600))
+            if key not in lowest or price < lowest[key][0]:
+                lowest[key] = (price, quantity)
+        downsampled = {name: array.array(code) for name, code in COLUMNS}
+        for (item_id, server, hour), (price, quantity) in sorted(lowest.items()):
+            downsampled["timestamp"].append(hour * 3600.0)
+            downsampled["item"].append(item_id)
+            downsampled["server"].append(server)
+            downsampled["price"].append(price)
+            downsampled["quantity"].append(quantity)
+        write_partition(path, downsampled)
+        print(
+            f"price history: downsampled {path} from {len(columns['item'])} "
+            + f"to {len(downsampled['item'])} rows"
+        )
+
+    def history(self, item_id, server=None, since=None, until=None):
+        """Return the recorded prices of one item, oldest first.
+        Parameters:
+            - item_id (int): Item to look up.
+            - server (str, optional): Only return prices from this server or realm.
+            - since (float, optional): Unix time of the oldest price to return.
+            - until (float, optional): Unix time of the newest price to return.
+        Returns:
+            - list: (timestamp, server, price, quantity) tuples."""
+        item_id = int(item_id)
+        with self.lock:
+            self.load_servers()
+            server_id = self.server_ids.get(str(server)) if server is not None else None
+            if server is not None and server_id is None:
+                return []
+            results = []
+            for day in self.partitions():
+                if since is not None and day < day_of(since):
+                    continue
+                if until is not None and day > day_of(until):
+                    continue
+                path = os.path.join(self.path, day)
+                columns = read_partition(path)
+                items = columns["item"]
+                if os.path.exists(os.path.join(path, DOWNSAMPLED_MARKER)):
+                    indexes = range(
+                        bisect.bisect_left(items, item_id),
+                        bisect.bisect_right(items, item_id),
+                    )
+                else:
+                    indexes = [i for i, value in enumerate(items) if value == item_id]
+                for i in indexes:
+                    timestamp = columns["timestamp"][i]
+                    if since is not None and timestamp < since:
+                        continue
+                    if until is not None and timestamp > until:
+                        continue
+                    if server_id is not None and columns["server"][i] != server_id:
+                        continue
+                    results.append(
+                        (
+                            timestamp,
+                            self.servers[columns["server"][i]],
+                            columns["price"][i],
+                            columns["quantity"][i],
+                        )
+                    )
+            results.sort()
+            return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("usage: python price_history.py MONITOR ITEM_ID [SERVER]")
+        print("e.g. python price_history.py ffxiv_pricecheck 5057 Cactuar")
+        exit(2)
+    start = time.perf_counter()
+    rows = PriceHistory(sys.argv[1]).history(
+        sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None
+    )
+    for timestamp, server, price, quantity in rows:
+        seen = datetime.fromtimestamp(timestamp).strftime("%m/%d/%Y %I:%M %p")
+        print(f"{seen}  {server}  {price:,.2f}  x{quantity}")
+    print(f"{len(rows)} prices in {(time.perf_counter() - start) * 1000:.1f} ms")
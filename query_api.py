@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+# the latest results of each monitor running in this process, by monitor name
+results = {}
+_results_lock = threading.Lock()
+# limit on the request line and headers, nothing here needs more
+MAX_REQUEST_BYTES = 16 * 1024
+
+
+class _Group:
+    """The rows of one publish, encoded as JSON with their lookup keys on first use."""
+
+    __slots__ = ("rows", "encoded", "keys")
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.encoded = None
+        self.keys = None
+
+    def encode(self):
+        """Encode the rows once, with the (server, retainer, items) keys of each row."""
+        if self.encoded is not None:
+            return
+        self.keys = [
+            (
+                None if row.get("server") is None else str(row["server"]).lower(),
+                None if row.get("retainer") is None else str(row["retainer"]).lower(),
+                [
+                    str(item).lower()
+                    for item in (row.get("item_id"), row.get("item_name"))
+                    if item is not None
+                ],
+            )
+            for row in self.rows
+        ]
+        self.encoded = [
+            json.dumps(row, separators=(",", ":")).encode() for row in self.rows
+        ]
+
+
+class _Index:
+    """An immutable view of all published rows with their lookup tables, swapped in whole."""
+
+    def __init__(self, groups):
+        self.rows = []
+        self.by_server = {}
+        self.by_retainer = {}
+        self.by_item = {}
+        for group in groups.values():
+            group.encode()
+            for encoded, (server, retainer, items) in zip(group.encoded, group.keys):
+                number = len(self.rows)
+                self.rows.append(encoded)
+                if server is not None:
+                    self.by_server.setdefault(server, set()).add(number)
+                if retainer is not None:
+                    self.by_retainer.setdefault(retainer, set()).add(number)
+                for item in items:
+                    self.by_item.setdefault(item, set()).add(number)
+
+    def select(self, server=None, retainer=None, item=None):
+        matches = None
+        for table, value in (
+            (self.by_server, server),
+            (self.by_retainer, retainer),
+            (self.by_item, item),
+        ):
+            if value is None:
+                continue
+            found = table.get(value.lower(), set())
+            matches = found if matches is None else matches & found
+        if matches is None:
+            return self.rows
+        return [self.rows[number] for number in sorted(matches)]
+
+
+class MonitorResults:
+    """The latest results of one monitor, indexed by server, retainer and item.
+    Processing Logic:
+        - Results are published per group, e.g. per request or per account, and a new
+          publish of a group replaces its old rows.
+        - A publish only stores the rows, so a monitor pays nothing for indexing while no
+          query server runs.
+        - The first query after a publish builds a new index, encoding as JSON only the
+          groups that were published since the last query, the other groups keep theirs.
+          Later queries only look up and join bytes."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.updated = None
+        self.index = _Index({})
+        self.stale = False
+
+    def publish(self, group, rows):
+        """Replace the rows of `group` with `rows`, a list of JSON-serializable dicts."""
+        with self.lock:
+            self.groups[group] = _Group(rows)
+            self.updated = time.time()
+            self.stale = True
+
+    def current_index(self):
+        """Return the index of the published rows, building it if a publish came since."""
+        with self.lock:
+            if self.stale:
+                self.index = _Index(self.groups)
+                self.stale = False
+            return self.index
+
+    def count(self):
+        with self.lock:
+            return sum(len(group.rows) for group in self.groups.values())
+
+    def query(self, server=None, retainer=None, item=None):
+        """Return the JSON response body for the rows matching every given filter."""
+        rows = self.current_index().select(server, retainer, item)
+        return (
+            b'{"monitor":'
+            + json.dumps(self.name).encode()
+            + b',"updated":'
+            + json.dumps(self.updated).encode()
+            + b',"count":'
+            + str(len(rows)).encode()
+            + b',"results":['
+            + b",".join(rows)
+            + b"]}"
+        )
+
+
+def results_for(name):
+    """Return the results of monitor `name`, creating them on first use."""
+    with _results_lock:
+        if name not in results:
+            results[name] = MonitorResults(name)
+        return results[name]
+
+
+def publish(name, group, rows):
+    results_for(name).publish(group, rows)
+
+
+def handle_path(target):
+    """Return (status, body) for a request target such as "/ffxiv_undercut?server=Cactuar"."""
+    url = urlsplit(target)
+    name = url.path.strip("/")
+    if not name:
+        listing = {
+            name: {"updated": monitor.updated, "count": monitor.count()}
+            for name, monitor in list(results.items())
+        }
+        return 200, json.dumps(listing).encode()
+    if name not in results:
+        return 404, json.dumps({"error": f"unknown monitor {name}"}).encode()
+    params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    return 200, results[name].query(
+        params.get("server"), params.get("retainer"), params.get("item")
+    )
+
+
+async def handle_connection(reader, writer):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        method, target, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+        if method not in ("GET", "HEAD"):
+            status, body = 405, b'{"error":"read only, use GET"}'
+        else:
+            status, body = handle_path(target)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+        status, body, method = 400, b'{"error":"bad request"}', "GET"
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(
+        status, "Method Not Allowed"
+    )
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n".encode()
+        + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+        + (body if method != "HEAD" else b"")
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def start(port, host="127.0.0.1"):
+    """Serve the results read only over HTTP from a background thread.
+    Parameters:
+        - port (int): Port to listen on.
+        - host (str): Address to bind, only this machine by default.
+    Returns:
+        - threading.Thread: The daemon thread running the event loop.
+    Processing Logic:
+        - GET / lists the monitors with their last update time and row count.
+        - GET /<monitor> returns the monitor's latest results, filtered by the optional
+          `server`, `retainer` and `item` (id or name) query parameters.
+        - Nothing is requested upstream, answers come from the published indexes only.
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        asyncio.start_server(handle_connection, host, port, limit=MAX_REQUEST_BYTES)
+    )
+    print(f"Serving results on http://{host}:{server.sockets[0].getsockname()[1]}/")
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_from_env():
+    """Start the query server if AETHERYTE_QUERY_PORT is set, AETHERYTE_QUERY_HOST picks the address."""
+    port = os.environ.get("AETHERYTE_QUERY_PORT")
+    if port:
+        start(int(port), os.environ.get("AETHERYTE_QUERY_HOST", "127.0.0.1"))
@@ -0,0 +1,99 @@
+import numpy as np
+
+BELOW = "below"
+ABOVE = "above"
+
+
+class RuleConflictError(ValueError):
+    """The same item has a "below" rule and an "above" rule, which cannot be sent as one rule."""
+
+
+class RuleSet:
+    """Price alert rules kept as NumPy arrays sorted by itemID, one rule per item.
+    Parameters:
+        - user_auctions (list): `{"itemID", "price", "desired_state"}` dicts from snipe.json.
+    Processing Logic:
+        - Rules for the same item are combined into the loosest one, the highest "below"
+          price or the lowest "above" price, which matches whenever any of them would.
+        - Raises RuleConflictError if an item has both "below" and "above" rules.
+        - Raises ValueError for any other desired_state."""
+
+    def __init__(self, user_auctions):
+        count = len(user_auctions)
+        item_ids = np.fromiter(
+            (int(rule["itemID"]) for rule in user_auctions), np.int64, count
+        )
+        prices = np.fromiter(
+            (float(rule["price"]) for rule in user_auctions), np.float64, count
+        )
+        states = [rule["desired_state"] for rule in user_auctions]
+        unknown = set(states) - {BELOW, ABOVE}
+        if unknown:
+            raise ValueError(f"Unknown desired_state {sorted(unknown)}")
+        below = np.fromiter((state == BELOW for state in states), bool, count)
+        self.item_ids, self.prices, self.below = self.combine(item_ids, prices, below)
+
+    @staticmethod
+    def combine(item_ids, prices, below):
+        if not len(item_ids):
+            return item_ids, prices, below
+        order = np.lexsort((prices, item_ids))
+        item_ids, prices, below = item_ids[order], prices[order], below[order]
+        unique_ids, starts = np.unique(item_ids, return_index=True)
+        # every rule of an item must point the same way
+        any_below = np.logical_or.reduceat(below, starts)
+        all_below = np.logical_and.reduceat(below, starts)
+        conflicts = unique_ids[any_below != all_below]
+        if len(conflicts):
+            raise RuleConflictError(
+                f"itemIDs {conflicts.tolist()} have both below and above rules"
+            )
+        # prices are sorted within each item, so the ends of each run are its min and max
+        ends = np.append(starts[1:], len(prices)) - 1
+        loosest = np.where(all_below, prices[ends], prices[starts])
+        return unique_ids, loosest, all_below
+
+    @classmethod
+    def merge(cls, rule_sets):
+        """Combine several rule sets into one, see the class docstring."""
+        merged = cls([])
+        merged.item_ids, merged.prices, merged.below = cls.combine(
+            np.concatenate([rules.item_ids for rules in rule_sets]),
+            np.concatenate([rules.prices for rules in rule_sets]),
+            np.concatenate([rules.below for rules in rule_sets]),
+        )
+        return merged
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def evaluate(self, item_ids, prices):
+        """Check a price snapshot against every rule in one pass.
+        Parameters:
+            - item_ids (sequence): Item of each price.
+            - prices (sequence): Current price of each item, in the same unit as the rule prices.
+        Returns:
+            - numpy.ndarray: Boolean mask, True where the price meets its item's rule.
+              Items without a rule are False."""
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        if not len(self.item_ids):
+            return np.zeros(len(item_ids), dtype=bool)
+        index = np.minimum(
+            np.searchsorted(self.item_ids, item_ids), len(self.item_ids) - 1
+        )
+        has_rule = self.item_ids[index] == item_ids
+        threshold = self.prices[index]
+        meets = np.where(self.below[index], prices <= threshold, prices >= threshold)
+        return has_rule & meets
+
+    def to_user_auctions(self):
+        """Return the rules in the snipe.json `user_auctions` format for an api request."""
+        return [
+            {
+                "itemID": int(item_id),
+                "price": int(price) if float(price).is_integer() else float(price),
+                "desired_state": BELOW if below else ABOVE,
+            }
+            for item_id, price, below in zip(self.item_ids, self.prices, self.below)
+        ]
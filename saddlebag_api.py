@@ -0,0 +1,499 @@
+import os
+import threading
+import time
+import requests
+import metrics
+from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
+
+# seconds to wait for the saddlebag api before counting the request as failed
+REQUEST_TIMEOUT = 60
+# consecutive failures before an endpoint's circuit opens
+FAILURE_THRESHOLD = 3
+# how long an open circuit waits before a half open probe, doubled on every failed probe
+OPEN_SECONDS = 60
+MAX_OPEN_SECONDS = 30 * 60
+# weight of the latest request in an endpoint's latency and error averages
+ENDPOINT_ALPHA = 0.2
+# how much an endpoint's error rate weighs against its latency when picking one
+ERROR_PENALTY = 10
+# seconds a failed endpoint is passed over while another one is still healthy
+ENDPOINT_DOWN_SECONDS = 30
+# an endpoint without requests for this long gets the next one, to refresh its stats
+ENDPOINT_PROBE_SECONDS = 5 * 60
+# api requests allowed in flight at once, adapted between these bounds, see ConcurrencyLimiter
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 16
+# the limit grows while the average response time stays under this
+LATENCY_TARGET_SECONDS = 5
+# share of the limit kept after a timeout, 429 or 5xx
+CONCURRENCY_DECREASE = 0.5
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class SaddlebagError(Exception):
+    """The saddlebag api could not be reached or sent back something that is not valid JSON."""
+
+
+class CircuitOpenError(SaddlebagError):
+    """The endpoint has failed repeatedly and is not being called until its circuit closes again."""
+
+
+class DeadlineExceeded(SaddlebagError):
+    """The cycle's deadline passed before the request was sent or answered."""
+
+
+class CircuitBreaker:
+    """Stop calling an endpoint after repeated failures and probe it again with backoff.
+    Parameters:
+        - name (str): Endpoint name, used in metrics and messages.
+    Processing Logic:
+        - Closed: requests go through, `FAILURE_THRESHOLD` failures in a row open the circuit.
+        - Open: requests are refused without any network call until the open time has passed.
+        - Half open: a single probe request is let through, success closes the circuit and
+          failure opens it again for twice as long, up to `MAX_OPEN_SECONDS`.
+        - The state and failure counts are exported as metrics."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probing = False
+        metrics.set_gauge(f"breaker_{name}_state", CLOSED)
+
+    def is_open(self):
+        """Return True while requests would be refused, without changing any state."""
+        with self.lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at < self.open_seconds
+            return self.state == HALF_OPEN and self.probing
+
+    def before_request(self):
+        """Reserve a request, raising CircuitOpenError if the circuit does not allow one."""
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    metrics.incr(f"breaker_{self.name}_skipped")
+                    raise CircuitOpenError(f"{self.name} circuit is open")
+                self.set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    metrics.incr(f"breaker_{self.name}_skipped")
+                    raise CircuitOpenError(f"{self.name} circuit is half open")
+                self.probing = True
+
+    def release(self):
+        """Give back a request reserved by `before_request` that was cancelled by a deadline,
+        it counts neither as a success nor as a failure."""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                print(f"{self.name} is responding again, closing its circuit")
+                self.open_seconds = OPEN_SECONDS
+                self.set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            metrics.incr(f"breaker_{self.name}_failures")
+            if self.state == HALF_OPEN:
+                self.open_seconds = min(self.open_seconds * 2, MAX_OPEN_SECONDS)
+            elif self.failures < FAILURE_THRESHOLD:
+                return
+            self.probing = False
+            self.opened_at = time.monotonic()
+            print(
+                f"{self.name} failed {self.failures} times in a row, "
+                + f"pausing requests for {self.open_seconds}s"
+            )
+            self.set_state(OPEN)
+
+    def set_state(self, state):
+        self.state = state
+        metrics.set_gauge(f"breaker_{self.name}_state", state)
+
+
+class Endpoint:
+    """Response time and error rate of one api base url."""
+
+    def __init__(self, index, url):
+        self.name = f"endpoint_{index}"
+        self.url = url.rstrip("/")
+        self.latency = None
+        self.error_rate = 0.0
+        self.down_until = 0.0
+        self.last_used = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def score(self):
+        """Lower is healthier, the average response time weighed up by recent errors."""
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+
+class EndpointPool:
+    """Route each api request to the healthiest of several base urls.
+    Parameters:
+        - urls (list): Base urls, e.g. a local caching proxy and the public api.
+    Processing Logic:
+        - Each endpoint keeps moving averages of its response time and of how often it
+          failed, the endpoint with the lowest `Endpoint.score` is picked.
+        - An endpoint that was never called, or not for `ENDPOINT_PROBE_SECONDS`, is picked
+          once, so a slow endpoint that recovered is noticed.
+        - A failed endpoint is passed over for `ENDPOINT_DOWN_SECONDS` while another one is
+          up, and `call` fails over to the next endpoint within the same request.
+        - The stats of each endpoint are exported as metrics, e.g. `endpoint_0_latency_ms`.
+    """
+
+    def __init__(self, urls):
+        self.lock = threading.Lock()
+        self.endpoints = [Endpoint(index, url) for index, url in enumerate(urls)]
+
+    def pick(self, tried=()):
+        """Return the endpoint for the next attempt, None once every endpoint was tried."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [
+                endpoint for endpoint in self.endpoints if endpoint not in tried
+            ]
+            if not candidates:
+                return None
+            up = [endpoint for endpoint in candidates if endpoint.down_until <= now]
+            if not up:
+                up = [min(candidates, key=lambda endpoint: endpoint.down_until)]
+            stale = [
+                endpoint
+                for endpoint in up
+                if endpoint.latency is None
+                or now - endpoint.last_used >= ENDPOINT_PROBE_SECONDS
+            ]
+            endpoint = stale[0] if stale else min(up, key=Endpoint.score)
+            endpoint.last_used = now
+            return endpoint
+
+    def record(self, endpoint, seconds, ok):
+        """Update an endpoint's averages after a request that took `seconds`."""
+        with self.lock:
+            if endpoint.latency is None:
+                endpoint.latency = seconds
+            else:
+                endpoint.latency += ENDPOINT_ALPHA * (seconds - endpoint.latency)
+            endpoint.error_rate += ENDPOINT_ALPHA * ((not ok) - endpoint.error_rate)
+            endpoint.requests += 1
+            if not ok:
+                endpoint.failures += 1
+                endpoint.down_until = time.monotonic() + ENDPOINT_DOWN_SECONDS
+        metrics.incr(f"{endpoint.name}_requests")
+        if not ok:
+            metrics.incr(f"{endpoint.name}_failures")
+        metrics.set_gauge(f"{endpoint.name}_latency_ms", round(endpoint.latency * 1000))
+        metrics.set_gauge(f"{endpoint.name}_error_rate", round(endpoint.error_rate, 3))
+
+    def stats(self):
+        """Return the url, average latency, error rate and counts of every endpoint."""
+        with self.lock:
+            return [
+                {
+                    "name": endpoint.name,
+                    "url": endpoint.url,
+                    "latency_ms": (
+                        None
+                        if endpoint.latency is None
+                        else round(endpoint.latency * 1000)
+                    ),
+                    "error_rate": round(endpoint.error_rate, 3),
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                }
+                for endpoint in self.endpoints
+            ]
+
+
+def api_urls():
+    """Return the base urls from AETHERYTE_API_URLS (comma separated), or the public api."""
+    urls = [
+        url.strip()
+        for url in os.environ.get("AETHERYTE_API_URLS", "").split(",")
+        if url.strip()
+    ]
+    return urls or [URL_BASE]
+
+
+# every request of the process picks its base url from here
+pool = EndpointPool(api_urls())
+
+
+def is_api_url(url):
+    """Return True if `url` is on one of the api base urls rather than e.g. a webhook."""
+    return url.startswith(URL_BASE) or any(
+        url.startswith(endpoint.url) for endpoint in pool.endpoints
+    )
+
+
+def _state_field(index):
+    """Return a property stored in slot `index` of the limiter's `state`."""
+    return property(
+        lambda self: self.state[index],
+        lambda self, value: self.state.__setitem__(index, value),
+    )
+
+
+class ConcurrencyLimiter:
+    """Adapt how many api requests are in flight at once to how well the api copes.
+    Parameters:
+        - context (multiprocessing context, optional): Keep the state in shared memory so
+          every process it is passed to shares one limit, e.g. all shards of a monitor.
+        - holders (int, optional): Number of processes sharing it, each one sets its
+          `holder` so the slots of a process that died can be given back.
+    Processing Logic:
+        - A request waits for a free slot before it is sent, or until its deadline.
+        - Additive increase: while the moving average response time stays under
+          `LATENCY_TARGET_SECONDS`, every answered request adds 1 / limit, so the limit
+          grows by about one per round of requests, up to `CONCURRENCY_MAX`.
+        - Multiplicative decrease: a timeout, 429 or 5xx multiplies the limit by
+          `CONCURRENCY_DECREASE`, down to `CONCURRENCY_MIN`. Failures of requests that
+          were already in flight during the last cut do not cut it again.
+        - The limit, requests in flight and average response time are exported as
+          metrics."""
+
+    limit = _state_field(0)
+    in_flight = _state_field(1)
+    # moving average response time in seconds, negative until the first response
+    latency = _state_field(2)
+    cut_at = _state_field(3)
+
+    def __init__(self, context=None, holders=0):
+        # after the four fields, the slots taken by each holder
+        state = [float(CONCURRENCY_INITIAL), 0.0, -1.0, 0.0] + [0.0] * holders
+        self.holder = None
+        if context is None:
+            self.condition = threading.Condition()
+            self.state = state
+        else:
+            self.condition = context.Condition()
+            self.state = context.RawArray("d", state)
+
+    def acquire(self, deadline=None):
+        """Take a request slot, returning False if the deadline passed while waiting."""
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                metrics.incr("api_concurrency_waits")
+            while self.in_flight >= int(self.limit):
+                if deadline is not None and deadline.expired():
+                    return False
+                self.condition.wait(None if deadline is None else deadline.remaining())
+            self.in_flight += 1
+            if self.holder is not None:
+                self.state[4 + self.holder] += 1
+            metrics.set_gauge("api_in_flight", int(self.in_flight))
+            return True
+
+    def release(self, started=None, congested=False):
+        """Give back a slot taken at monotonic time `started`, None for a cancelled request.
+        Parameters:
+            - started (float, optional): When the request was sent.
+            - congested (bool, optional): The request timed out or got a 429 or 5xx."""
+        with self.condition:
+            self.in_flight -= 1
+            if self.holder is not None:
+                self.state[4 + self.holder] -= 1
+            if started is not None:
+                seconds = time.monotonic() - started
+                if self.latency < 0:
+                    self.latency = seconds
+                else:
+                    self.latency += ENDPOINT_ALPHA * (seconds - self.latency)
+                if congested:
+                    if started >= self.cut_at:
+                        self.limit = max(
+                            self.limit * CONCURRENCY_DECREASE, CONCURRENCY_MIN
+                        )
+                        self.cut_at = time.monotonic()
+                        metrics.incr("api_concurrency_cuts")
+                elif self.latency <= LATENCY_TARGET_SECONDS:
+                    self.limit = min(self.limit + 1 / self.limit, CONCURRENCY_MAX)
+                metrics.set_gauge("api_latency_ms", round(self.latency * 1000))
+            metrics.set_gauge("api_concurrency_limit", int(self.limit))
+            metrics.set_gauge("api_in_flight", int(self.in_flight))
+            self.condition.notify_all()
+
+    def release_holder(self, holder):
+        """Give back every slot a process that died still held."""
+        with self.condition:
+            self.in_flight -= self.state[4 + holder]
+            self.state[4 + holder] = 0.0
+            self.condition.notify_all()
+
+
+# every api request of the process takes a slot here, see `call`, shards of a
+# monitor replace it with one limiter shared by all of them, see sharding.py
+limiter = ConcurrencyLimiter()
+
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(path):
+    """Return the circuit breaker for an api path such as "/undercut", creating it on first use."""
+    with _breakers_lock:
+        if path not in breakers:
+            breakers[path] = CircuitBreaker(path.strip("/").replace("/", "_"))
+        return breakers[path]
+
+
+def is_open(path):
+    return breaker_for(path).is_open()
+
+
+def request_timeout(deadline=None):
+    """Return the timeout for a request, never longer than the time left until `deadline`."""
+    if deadline is None:
+        return REQUEST_TIMEOUT
+    return min(REQUEST_TIMEOUT, max(deadline.remaining(), 0.001))
+
+
+def response_error(path, response):
+    """Return why a response counts as a failure of the endpoint, or None if it does not."""
+    if response.status_code == 429 or response.status_code >= 500:
+        return f"{path} returned {response.status_code}"
+    content_type = response.headers.get("Content-Type", "")
+    if response.status_code < 300 and "json" not in content_type:
+        return f"{path} returned {content_type or 'no content type'}"
+    return None
+
+
+def call(path, send, deadline=None, stream=False, decode=False):
+    """Make a request to the saddlebag api through the endpoint's circuit breaker.
+    Parameters:
+        - path (str): Api path, e.g. "/wow/regionundercut".
+        - send (function): Makes the request to the base url it is called with and returns
+          the `requests.Response`, using `request_timeout(deadline)` as its timeout.
+        - deadline (Deadline, optional): The cycle's deadline, see deadline.py.
+        - stream (bool, optional): The body is read after `call` returns, the response then
+          keeps its request slot until it is handed to `finish_stream`.
+        - decode (bool, optional): Decode the JSON body as part of the request.
+    Returns:
+        - requests.Response: A 2xx response with a JSON content type, or with `decode`
+          its decoded body.
+    Processing Logic:
+        - Raises DeadlineExceeded without calling `send` once the deadline has passed, and
+          when the request times out because the deadline passed while it was waiting.
+          Neither counts against the endpoint.
+        - Raises CircuitOpenError without calling `send` while the circuit is open.
+        - Connection errors, timeouts, 429s, 5xx responses and non JSON bodies (such as an
+          HTML error page, or with `decode` a body that does not decode) count as failures
+          and raise SaddlebagError.
+        - Other 4xx responses raise SaddlebagError but do not count against the endpoint.
+        - The base url is picked from `pool`, after a failure the request is sent again to
+          the next healthiest base url, and only counts as failed once all of them failed.
+        - Every attempt waits for a slot from `limiter`, raising DeadlineExceeded if none
+          is free before the deadline.
+    """
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded(f"{path} request skipped, the cycle deadline has passed")
+    breaker = breaker_for(path)
+    breaker.before_request()
+    tried = []
+    while True:
+        endpoint = pool.pick(tried)
+        tried.append(endpoint)
+        if not limiter.acquire(deadline):
+            breaker.release()
+            raise DeadlineExceeded(
+                f"{path} request skipped, no request slot was free before the deadline"
+            )
+        started = time.monotonic()
+        response = None
+        congested = False
+        try:
+            response = send(endpoint.url)
+            error = response_error(path, response)
+            congested = response.status_code == 429 or response.status_code >= 500
+            if decode and error is None and response.status_code < 300:
+                try:
+                    body = response.json()
+                except ValueError as ex:
+                    error = f"{path} returned invalid JSON: {ex}"
+        except requests.exceptions.Timeout as ex:
+            if deadline is not None and deadline.expired():
+                limiter.release()
+                breaker.release()
+                raise DeadlineExceeded(
+                    f"{path} request cancelled at the cycle deadline"
+                )
+            error = f"{path} request failed: {ex}"
+            congested = True
+        except requests.exceptions.RequestException as ex:
+            error = f"{path} request failed: {ex}"
+        except BaseException:
+            limiter.release()
+            breaker.release()
+            raise
+        if error is not None or not stream:
+            limiter.release(started, congested)
+        pool.record(endpoint, time.monotonic() - started, error is None)
+        if error is None:
+            break
+        if response is not None:
+            response.close()
+        if len(tried) == len(pool.endpoints) or (
+            deadline is not None and deadline.expired()
+        ):
+            breaker.record_failure()
+            raise SaddlebagError(error)
+        print(f"{error} from {endpoint.url}, trying the next api url")
+        metrics.incr("api_failovers")
+    breaker.record_success()
+    if response.status_code >= 300:
+        if stream:
+            limiter.release(started)
+        raise SaddlebagError(f"{path} returned {response.status_code}")
+    if stream:
+        response.slot_started = started
+    return body if decode else response
+
+
+def finish_stream(response, congested=False, cancelled=False):
+    """Close a response from `call(..., stream=True)` and give back its request slot.
+    Parameters:
+        - response (requests.Response): The streamed response.
+        - congested (bool, optional): Reading the body timed out or broke off.
+        - cancelled (bool, optional): Reading stopped at a deadline, the time it took
+          says nothing about the api."""
+    response.close()
+    limiter.release(None if cancelled else response.slot_started, congested)
+
+
+def post_json(path, payload, deadline=None):
+    """POST a JSON payload to the saddlebag api and return the decoded response.
+    Parameters:
+        - path (str): Api path, e.g. "/undercut".
+        - payload (dict): JSON-serializable request body.
+        - deadline (Deadline, optional): The cycle's deadline, see `call`.
+    Returns:
+        - The decoded JSON response.
+    Processing Logic:
+        - See `call`, a body that fails to decode also counts as a failure."""
+    return call(
+        path,
+        lambda base: requests.post(
+            f"{base}{path}",
+            headers={**SADDLEBAG_REQUEST_HEADERS, "Accept": "application/json"},
+            json=payload,
+            timeout=request_timeout(deadline),
+        ),
+        deadline,
+        decode=True,
+    )
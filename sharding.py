@@ -0,0 +1,262 @@
+import bisect
+import hashlib
+import importlib
+import multiprocessing
+import os
+import queue
+import time
+from deadline import carried_first, check_until, record_skipped
+import metrics
+import saddlebag_api
+import snapshot
+from item_index import items
+
+# points per shard on the hash ring, more points spread the servers more evenly
+RING_POINTS = 64
+# seconds between two saddlebag requests, shared by every shard of a monitor
+REQUEST_INTERVAL = 1.0
+# spawned workers import the monitor fresh, which also works on Windows
+_context = multiprocessing.get_context("spawn")
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of server names onto shards.
+    Parameters:
+        - shard_count (int): Number of shards.
+    Processing Logic:
+        - Each shard owns `RING_POINTS` points on the ring, a key belongs to the shard of
+          the first point at or after its hash.
+        - The same key always lands on the same shard, and changing the shard count only
+          moves the keys next to the added or removed points."""
+
+    def __init__(self, shard_count):
+        points = sorted(
+            (ring_hash(f"shard-{shard}-{point}"), shard)
+            for shard in range(shard_count)
+            for point in range(RING_POINTS)
+        )
+        self.hashes = [point_hash for point_hash, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect_left(self.hashes, ring_hash(str(key)))
+        return self.shards[index % len(self.shards)]
+
+
+class RateBudget:
+    """Space out requests to at most one per `interval` seconds across processes.
+    Parameters:
+        - interval (float): Minimum seconds between the start of two requests.
+    Processing Logic:
+        - The next free request slot is kept in shared memory, every `wait` takes the
+          next slot under its lock and sleeps until it comes up.
+        - Pass the same budget to every worker process so they share one limit."""
+
+    def __init__(self, interval=REQUEST_INTERVAL):
+        self.interval = interval
+        self.next_slot = _context.Value("d", 0.0)
+
+    def wait(self):
+        with self.next_slot.get_lock():
+            now = time.monotonic()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ShardResults:
+    """Stands in for a worker's price history, query api results and poll schedule, the
+    rows are sent to the parent process at the end of each cycle so it stays the only writer.
+    """
+
+    def __init__(self):
+        self.history_rows = []
+        self.published = []
+        self.polls = []
+
+    def append(self, rows, timestamp=None):
+        rows = list(rows)
+        self.history_rows.append(
+            (rows, time.time() if timestamp is None else timestamp)
+        )
+        return len(rows)
+
+    def publish(self, group, rows):
+        self.published.append((group, list(rows)))
+
+    def record(self, key, changed, timestamp=None):
+        self.polls.append(
+            (key, changed, time.time() if timestamp is None else timestamp)
+        )
+
+    def drain(self):
+        drained = (self.history_rows, self.published, self.polls)
+        self.history_rows, self.published, self.polls = [], [], []
+        return drained
+
+
+def shard_worker(monitor_name, shard, budget, limiter, tasks, results):
+    """Run one shard of a monitor until it is sent None.
+    Parameters:
+        - monitor_name (str): Module of the monitor, e.g. "ffxiv_undercut".
+        - shard (int): Number of this shard.
+        - budget (RateBudget): The rate limit shared by every shard.
+        - limiter (ConcurrencyLimiter): The api concurrency limit shared by every shard.
+        - tasks (Queue): Receives (webhooks, entries, deadline) once per cycle.
+        - results (Queue): Gets (shard, history rows, published rows, polls, metrics,
+          skipped keys) after each cycle.
+    Processing Logic:
+        - The monitor's dedupe state only holds the servers of this shard and is warm
+          started from the shard's own snapshot.
+        - Checks every entry with the monitor's `check_entry`, stopping early if it
+          returns False or the deadline passes, then waits for this shard's webhook
+          deliveries. The keys of the entries it did not get to are sent back."""
+    monitor = importlib.import_module(monitor_name)
+    collected = ShardResults()
+    monitor.request_budget = budget
+    limiter.holder = shard
+    saddlebag_api.limiter = limiter
+    monitor.responses = snapshot.Snapshot(f"{monitor_name}.shard{shard}")
+    monitor.history = collected
+    monitor.current_results = collected
+    monitor.schedule = collected
+    monitor.warm_start()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        webhooks, entries, deadline = task
+        skipped = check_until(
+            entries,
+            lambda filename, entry: monitor.check_entry(
+                filename, entry, webhooks, deadline
+            ),
+            deadline,
+        )
+        monitor.sink.flush()
+        monitor.responses.save()
+        items.save()
+        skipped_keys = [monitor.entry_key(entry) for _, entry in skipped]
+        results.put((shard, *collected.drain(), metrics.drain(), skipped_keys))
+
+
+class ShardPool:
+    """Spread a monitor's server configs over worker processes.
+    Parameters:
+        - monitor_name (str): Module of the monitor the workers import, e.g. "ffxiv_undercut".
+        - monitor (module): The monitor running in this process, it provides `iter_entries`,
+          `check_entry`, `shard_key`, `entry_key`, the `carried` entry keys and the globals
+          `shard_worker` replaces.
+        - shard_count (int): Number of worker processes.
+    Processing Logic:
+        - Each cycle the parent reads the config files and sends every entry its poll
+          schedule says is due to the shard its `shard_key` hashes to. The key is the
+          entry's webhook, so a webhook and its rate limit stay on the same shard across
+          cycles.
+        - All shards take their request slots from one `RateBudget`, and their api
+          requests in flight count against one `ConcurrencyLimiter` in shared memory, so
+          its limit adapts to the requests of every shard together.
+        - The parent writes the price history and query api rows the shards send back,
+          updates its poll schedule with their polls and adds their metrics to its own.
+        - Entries skipped at the deadline, or lost with a shard that died, are carried into
+          the next cycle first.
+        - A shard that died is reported and started again for the next cycle."""
+
+    def __init__(self, monitor_name, monitor, shard_count):
+        self.monitor_name = monitor_name
+        self.monitor = monitor
+        self.ring = HashRing(shard_count)
+        self.budget = RateBudget()
+        self.limiter = saddlebag_api.ConcurrencyLimiter(_context, shard_count)
+        self.results = _context.Queue()
+        self.tasks = {}
+        self.processes = {}
+        for shard in range(shard_count):
+            self.start_shard(shard)
+
+    def start_shard(self, shard):
+        self.tasks[shard] = _context.Queue()
+        process = _context.Process(
+            target=shard_worker,
+            args=(
+                self.monitor_name,
+                shard,
+                self.budget,
+                self.limiter,
+                self.tasks[shard],
+                self.results,
+            ),
+            name=f"{self.monitor_name}-shard{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def run_cycle(self, webhooks, deadline=None):
+        """Check every due entry once across the shards and wait for all of them to finish,
+        or to stop at `deadline`."""
+        entries = carried_first(
+            self.monitor.schedule.due_entries(
+                list(self.monitor.iter_entries(webhooks)), self.monitor.entry_key
+            ),
+            self.monitor.carried,
+            lambda item: self.monitor.entry_key(item[1]),
+        )
+        by_shard = {}
+        for filename, entry in entries:
+            shard = self.ring.shard_for(self.monitor.shard_key(filename, entry))
+            by_shard.setdefault(shard, []).append((filename, entry))
+        for shard, entries in by_shard.items():
+            self.tasks[shard].put((webhooks, entries, deadline))
+        metrics.set_gauge("shards_busy", len(by_shard))
+
+        waiting = set(by_shard)
+        skipped = []
+        while waiting:
+            try:
+                shard, history_rows, published, polls, values, skipped_keys = (
+                    self.results.get(timeout=1)
+                )
+            except queue.Empty:
+                for shard in list(waiting):
+                    if not self.processes[shard].is_alive():
+                        print(f"Error: shard {shard} stopped, restarting it")
+                        metrics.incr("errors")
+                        waiting.discard(shard)
+                        self.limiter.release_holder(shard)
+                        skipped += [
+                            self.monitor.entry_key(entry)
+                            for _, entry in by_shard[shard]
+                        ]
+                        self.start_shard(shard)
+                continue
+            waiting.discard(shard)
+            skipped += skipped_keys
+            for rows, timestamp in history_rows:
+                self.monitor.history.append(rows, timestamp)
+            for group, rows in published:
+                self.monitor.current_results.publish(group, rows)
+            for key, changed, timestamp in polls:
+                self.monitor.schedule.record(key, changed, timestamp)
+            metrics.merge(values)
+        self.monitor.carried = record_skipped(skipped)
+
+    def close(self):
+        for tasks in self.tasks.values():
+            tasks.put(None)
+        for process in self.processes.values():
+            process.join()
+
+
+def shard_count_from_env():
+    """Return the number of shards from AETHERYTE_SHARDS, 0 runs everything in this process.
+    "auto" uses one shard per CPU core."""
+    shards = os.environ.get("AETHERYTE_SHARDS", "")
+    if shards == "auto":
+        return os.cpu_count() or 1
+    return int(shards) if shards else 0
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from state_store import STATE_DIR
+
+# file layout: header, index of (key, offset, length, saved_at), then the JSON bodies
+MAGIC = b"AESNAP1\0"
+_HEADER = struct.Struct("<8sI")
+_INDEX_ENTRY = struct.Struct("<HQQd")
+# responses not refreshed for this long are dropped on save, e.g. after a config change
+MAX_AGE_SECONDS = 24 * 60 * 60
+
+
+def request_key(path, payload):
+    """Return a snapshot key for an api path and request payload, so edited requests never match old responses."""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return f"{path}:{hashlib.blake2b(body, digest_size=8).hexdigest()}"
+
+
+class Snapshot:
+    """The last successful api responses of one monitor, kept on disk between restarts.
+    Parameters:
+        - name (str): Snapshot name, usually the monitor name.
+    Processing Logic:
+        - The saved file is memory mapped on first use, only the index is read up front
+          and a response is decoded when it is asked for.
+        - `put` records new responses in memory, `save` writes them together with the
+          untouched saved responses, which are copied over as raw bytes.
+        - A missing or unreadable file is treated as an empty snapshot."""
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(STATE_DIR, f"{name}.snapshot")
+        self.lock = threading.Lock()
+        self.mm = None
+        self.index = None
+        self.updated = {}
+
+    def open(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        try:
+            with open(self.path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError, OSError):
+            # ValueError is an empty file, which cannot be mapped
+            return
+        try:
+            magic, count = _HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC:
+                raise ValueError("not a snapshot file")
+            pos = _HEADER.size
+            for _ in range(count):
+                key_length, offset, length, saved_at = _INDEX_ENTRY.unpack_from(
+                    self.mm, pos
+                )
+                pos += _INDEX_ENTRY.size
+                key = self.mm[pos : pos + key_length].decode("utf-8")
+                pos += key_length
+                if offset + length > len(self.mm):
+                    raise ValueError("snapshot file is truncated")
+                self.index[key] = (offset, length, saved_at)
+        except (struct.error, ValueError) as ex:
+            print(f"Error: could not read snapshot {self.path}, starting cold: {ex}")
+            self.close()
+            self.index = {}
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def keys(self):
+        with self.lock:
+            self.open()
+            return set(self.index) | set(self.updated)
+
+    def get(self, key, default=None):
+        """Return the last response saved under `key`, or `default`."""
+        with self.lock:
+            self.open()
+            if key in self.updated:
+                return json.loads(self.updated[key][1])
+            if key not in self.index:
+                return default
+            offset, length, _ = self.index[key]
+            return json.loads(self.mm[offset : offset + length])
+
+    def saved_at(self, key):
+        """Return the unix time the response under `key` was received, or None."""
+        with self.lock:
+            self.open()
+            if key in self.updated:
+                return self.updated[key][0]
+            if key in self.index:
+                return self.index[key][2]
+            return None
+
+    def get_since(self, key, since):
+        """Return the response saved under `key` if it was received at or after unix time `since`, else None."""
+        saved_at = self.saved_at(key)
+        if saved_at is None or saved_at < since:
+            return None
+        return self.get(key)
+
+    def put(self, key, response):
+        """Record the latest successful `response` for `key`, written out by the next `save`."""
+        body = json.dumps(response, separators=(",", ":")).encode("utf-8")
+        with self.lock:
+            self.updated[key] = (time.time(), body)
+
+    def save(self):
+        """Write every response to disk, replacing the old file atomically."""
+        with self.lock:
+            self.open()
+            if not self.updated:
+                return
+            now = time.time()
+            entries = []
+            for key, (offset, length, saved_at) in self.index.items():
+                if key not in self.updated and now - saved_at < MAX_AGE_SECONDS:
+                    entries.append((key, saved_at, self.mm[offset : offset + length]))
+            for key, (saved_at, body) in self.updated.items():
+                entries.append((key, saved_at, body))
+
+            encoded_keys = [key.encode("utf-8") for key, _, _ in entries]
+            offset = _HEADER.size + sum(
+                _INDEX_ENTRY.size + len(key) for key in encoded_keys
+            )
+            parts = [_HEADER.pack(MAGIC, len(entries))]
+            for key, (_, saved_at, body) in zip(encoded_keys, entries):
+                parts.append(_INDEX_ENTRY.pack(len(key), offset, len(body), saved_at))
+                parts.append(key)
+                offset += len(body)
+            parts.extend(body for _, _, body in entries)
+
+            os.makedirs(STATE_DIR, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(parts))
+            # the old file has to be unmapped before it can be replaced on windows
+            self.close()
+            os.replace(tmp_path, self.path)
+            self.index = None
+            self.updated = {}
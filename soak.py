@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+import argparse
+import collections
+import datetime
+import gzip
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import requests
+from requests.structures import CaseInsensitiveDict
+from aetheryte import MONITORS
+from constants import URL_BASE
+import metrics
+import saddlebag_api
+
+# api paths that are a monitor's actual scan, the rest is bookkeeping like upload timers
+SCAN_PATHS = (
+    "/undercut",
+    "/pricecheck",
+    "/wow/regionpricecheck",
+    "/wow/pricecheck",
+    "/wow/regionundercut",
+)
+# shared modules that read the clock, their `time` is swapped for the virtual clock
+CLOCK_MODULES = (
+    "deadline",
+    "dedupe",
+    "discord_delivery",
+    "poll_schedule",
+    "price_history",
+    "query_api",
+    "saddlebag_api",
+    "sharding",
+    "snapshot",
+)
+# the soak runs every monitor in this process with its own state, so these are unset
+IGNORED_ENV = (
+    "AETHERYTE_ALERT_SINK",
+    "AETHERYTE_API_URLS",
+    "AETHERYTE_CASSETTE",
+    "AETHERYTE_QUERY_PORT",
+    "AETHERYTE_SHARDS",
+)
+USER_DATA_DIRS = ("ffxiv_user_data", "wow_user_data")
+STUB_WEBHOOK = "https://discord.com/api/webhooks/0/soak"
+
+_original_send = requests.Session.send
+
+
+class SoakFinished(Exception):
+    """Raised from the virtual sleep once the simulated time is used up."""
+
+
+class VirtualClock:
+    """Stands in for the `time` module of the monitors, time only moves when they sleep.
+    Parameters:
+        - start (float): Unix time the soak starts at.
+        - end (float): Unix time at which the next sleep raises SoakFinished.
+        - on_hour (callable, optional): Called with each simulated hour number as it starts.
+    Processing Logic:
+        - time(), monotonic() and localtime() read the simulated time, `datetime` is a
+          datetime class whose now() does too.
+        - A sleep on the main thread moves the clock forward at once. Sleeps of the
+          webhook delivery threads return straight away, the schedule is only moved by
+          the monitor's own loop.
+        - Everything else, e.g. perf_counter, is the real `time` module."""
+
+    def __init__(self, start, end, on_hour=None):
+        self.current = start
+        self.end = end
+        self.on_hour = on_hour
+        clock = self
+
+        class VirtualDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return cls.fromtimestamp(clock.current, tz)
+
+        self.datetime = VirtualDatetime
+
+    def time(self):
+        return self.current
+
+    def monotonic(self):
+        return self.current
+
+    def localtime(self, secs=None):
+        return time.localtime(self.current if secs is None else secs)
+
+    def strftime(self, format, t=None):
+        return time.strftime(format, self.localtime() if t is None else t)
+
+    def sleep(self, seconds):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        hour = int(self.current // 3600)
+        self.current += max(seconds, 0)
+        if self.on_hour:
+            for next_hour in range(hour + 1, int(self.current // 3600) + 1):
+                self.on_hour(next_hour)
+        if self.current >= self.end:
+            raise SoakFinished()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class StubUpstream:
+    """Synthetic saddlebag responses and instant webhook deliveries.
+    Parameters:
+        - clock (VirtualClock): Used to count the requests per simulated hour.
+        - seed (int): Seed for the market, the same seed gives the same run.
+        - upload_minute (int, optional): Fixed WoW upload minute, random each request by default.
+        - churn (float): Chance that a listing's price moves in a simulated minute.
+    Processing Logic:
+        - Every listing keeps its price and moves with chance `churn` per simulated minute,
+          so most cycles repeat what was already alerted like the real api does, and
+          polling more often does not make the market busier.
+        - Responses are built from the items in the request, no item metadata is needed.
+        - Anything that is not the saddlebag api is a webhook and gets an empty 204."""
+
+    def __init__(self, clock, seed=0, upload_minute=None, churn=0.002):
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.upload_minute = upload_minute
+        self.churn = churn
+        self.market = {}
+        self.requests = collections.Counter()
+        self.upload_minutes = {}
+
+    def hour(self):
+        return int(self.clock.current // 3600)
+
+    def price(self, key, base):
+        price, moved_at = self.market.get(key, (None, self.clock.current))
+        minutes = (self.clock.current - moved_at) / 60
+        if price is None or self.rng.random() < 1 - (1 - self.churn) ** minutes:
+            price = max(int(base * self.rng.uniform(0.5, 1.5)), 1)
+        self.market[key] = (price, self.clock.current)
+        return price
+
+    def respond(self, request):
+        if not request.url.startswith(URL_BASE):
+            self.requests[(self.hour(), "webhook")] += 1
+            return stub_response(request, 204, b"")
+        path = request.url[len(URL_BASE) :]
+        self.requests[(self.hour(), path)] += 1
+        body = request.body or b"{}"
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        handler = getattr(self, "respond_" + path.strip("/").replace("/", "_"), None)
+        if handler is None:
+            return stub_response(request, 404, b"{}")
+        content = json.dumps(handler(json.loads(body))).encode("utf-8")
+        return stub_response(request, 200, content)
+
+    def respond_undercut(self, entry):
+        server = entry["server"]
+        auction_data = {}
+        for item_id in range(1000, 1020):
+            my_ppu = self.price((server, item_id, "mine"), 10000)
+            ppu = self.price((server, item_id), 10000)
+            if ppu < my_ppu:
+                auction_data[str(item_id)] = {
+                    "real_name": f"Item {item_id}",
+                    "my_retainer": "Soak Retainer",
+                    "my_ppu": my_ppu,
+                    "ppu": ppu,
+                    "undercut_retainer": "Other Retainer",
+                    "link": f"https://universalis.app/market/{item_id}",
+                }
+        return {"server": server, "auction_data": auction_data}
+
+    def respond_pricecheck(self, entry):
+        matching = []
+        for auction in entry["user_auctions"]:
+            min_price = self.price(
+                (entry["home_server"], auction["itemID"]), auction["price"]
+            )
+            if min_price <= auction["price"]:
+                matching.append(
+                    {
+                        "itemID": auction["itemID"],
+                        "itemName": f"Item {auction['itemID']}",
+                        "server": entry["home_server"],
+                        "dc": "Soak",
+                        "minPrice": min_price,
+                        "minListingQuantity": 1,
+                        "hq": auction["hq"],
+                        "match_desire": auction["desired_state"],
+                    }
+                )
+        return {"matching": matching}
+
+    def respond_wow_regionpricecheck(self, payload):
+        realm = payload.get("homeRealmName", "Soak Realm")
+        matching = []
+        for auction in payload["user_auctions"]:
+            ah_price = self.price((realm, auction["itemID"]), auction["price"])
+            if ah_price <= auction["price"]:
+                matching.append(
+                    {
+                        "item_id": auction["itemID"],
+                        "item_name": f"Item {auction['itemID']}",
+                        "link": f"https://undermine.exchange/#eu-{realm}/{auction['itemID']}",
+                        "ah_price": ah_price,
+                        "desired_state": auction["desired_state"],
+                        "realm_names": realm,
+                    }
+                )
+        return {"matching": matching}
+
+    respond_wow_pricecheck = respond_wow_regionpricecheck
+
+    def respond_wow_uploadtimers(self, payload):
+        minute = self.upload_minute
+        if minute is None:
+            minute = self.rng.randrange(60)
+        self.upload_minutes[self.hour()] = minute
+        return {
+            "data": [
+                {
+                    "dataSetID": data_set_id,
+                    "region": payload["region"],
+                    "lastUploadMinute": minute,
+                }
+                for data_set_id in (-1, -2)
+            ]
+        }
+
+    def respond_wow_regionundercut(self, payload):
+        undercuts = []
+        for item_id in range(2000, 2020):
+            user_price = self.price(("wow", item_id, "mine"), 100000)
+            lowest_price = self.price(("wow", item_id), 100000)
+            if lowest_price < user_price:
+                undercuts.append(
+                    {
+                        "item_id": item_id,
+                        "item_name": f"Item {item_id}",
+                        "link": f"https://undermine.exchange/#eu-soak/{item_id}",
+                        "lowest_price": lowest_price,
+                        "user_price": user_price,
+                    }
+                )
+        return {
+            "results_by_realm": {
+                "Soak Realm": {"undercuts": undercuts, "not_found": []}
+            }
+        }
+
+
+def stub_response(request, status, content):
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+    response._content = content
+    response._content_consumed = True
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    response.elapsed = datetime.timedelta(0)
+    response.reason = "Soak"
+    return response
+
+
+def copy_user_data(work_dir):
+    """Copy the user data into `work_dir` and send every webhook to the stub.
+    FFXIV undercut webhooks are looked up by server, so each server gets one too."""
+    source = os.path.dirname(os.path.abspath(__file__))
+    for name in USER_DATA_DIRS:
+        shutil.copytree(os.path.join(source, name), os.path.join(work_dir, name))
+    undercut_dir = os.path.join(work_dir, "ffxiv_user_data", "undercut")
+    servers = set()
+    for filename in os.listdir(undercut_dir):
+        with open(os.path.join(undercut_dir, filename)) as f:
+            servers.update(entry["server"] for entry in json.load(f))
+    webhooks_path = os.path.join(
+        work_dir, "ffxiv_user_data", "config", "undercut", "webhooks.json"
+    )
+    with open(webhooks_path) as f:
+        webhooks = json.load(f)
+    webhooks.update({server: STUB_WEBHOOK for server in servers})
+    with open(webhooks_path, "w") as f:
+        json.dump(webhooks, f)
+
+
+def soak(name, days, start, seed=0, upload_minute=None):
+    """Run one monitor's normal schedule for `days` of simulated time.
+    Parameters:
+        - name (str): Monitor name, as in aetheryte.py.
+        - days (float): Simulated days to run.
+        - start (float): Unix time the simulated run starts at.
+        - seed (int): Seed of the stub market.
+        - upload_minute (int, optional): Fixed WoW upload minute.
+    Returns:
+        - dict: The counts `report` prints.
+    Processing Logic:
+        - The monitor's main() runs unchanged, with the virtual clock swapped in for its
+          `time` and `datetime` and the stub answering every request.
+        - Traced memory is sampled at the start of every simulated hour.
+        - The run ends when a sleep passes the end of the simulated time."""
+    memory = {}
+    clock = VirtualClock(
+        start,
+        start + days * 86400,
+        lambda hour: memory.__setitem__(hour, tracemalloc.get_traced_memory()[0]),
+    )
+    upstream = StubUpstream(clock, seed, upload_minute)
+    requests.Session.send = lambda session, request, **kwargs: upstream.respond(request)
+    for module_name in CLOCK_MODULES:
+        importlib.import_module(module_name).time = clock
+    # every monitor starts with fresh endpoint stats, all on the stubbed public api
+    saddlebag_api.pool = saddlebag_api.EndpointPool([URL_BASE])
+    monitor = importlib.import_module(MONITORS[name])
+    monitor.time = clock
+    if hasattr(monitor, "datetime"):
+        monitor.datetime = clock.datetime
+    metrics.drain()
+
+    outcome = "finished"
+    wall_start = time.perf_counter()
+    try:
+        monitor.main()
+    except SoakFinished:
+        pass
+    except SystemExit as ex:
+        outcome = f"exited with {ex.code} at {clock.datetime.now()}"
+    except Exception as ex:
+        outcome = f"failed at {clock.datetime.now()}: {ex!r}"
+    finally:
+        requests.Session.send = _original_send
+    counters, _ = metrics.drain()
+    return {
+        "outcome": outcome,
+        "wall_seconds": time.perf_counter() - wall_start,
+        "hours": range(int(start // 3600), int(clock.current // 3600)),
+        "requests": upstream.requests,
+        "upload_minutes": upstream.upload_minutes,
+        "memory": memory,
+        "counters": counters,
+    }
+
+
+def missed_hours(result):
+    """Return the simulated hours in which the monitor sent no scan at all."""
+    return [
+        hour
+        for hour in result["hours"]
+        if not any(result["requests"][(hour, path)] for path in SCAN_PATHS)
+    ]
+
+
+def report(name, days, result):
+    """Print requests per hour, alerts, memory growth and missed windows of one soak."""
+    hours = result["hours"]
+    print(
+        f"{name}: {days:g} simulated days in {result['wall_seconds']:.1f}s, {result['outcome']}"
+    )
+    paths = sorted({path for _, path in result["requests"]})
+    for path in paths:
+        per_hour = [result["requests"][(hour, path)] for hour in hours] or [0]
+        print(
+            f"  {path}: {sum(per_hour)} requests, per hour min {min(per_hour)} "
+            + f"mean {sum(per_hour) / len(per_hour):.1f} max {max(per_hour)}"
+        )
+    counters = result["counters"]
+    print(f"  alerts {counters.get('alerts', 0)}, errors {counters.get('errors', 0)}")
+
+    memory = result["memory"]
+    if memory:
+        samples = [memory[hour] for hour in sorted(memory)]
+        daily = " ".join(f"{sample / 1024:.0f}" for sample in samples[::24])
+        print(
+            f"  traced memory KiB, daily: {daily}, last {samples[-1] / 1024:.0f} "
+            + f"({(samples[-1] - samples[0]) / 1024:+.0f} since the first hour)"
+        )
+
+    missed = missed_hours(result)
+    print(f"  missed windows: {len(missed)} of {len(hours)} hours")
+    for hour in missed:
+        minutes = [m for h, m in result["upload_minutes"].items() if h <= hour]
+        detail = f", upload minute {minutes[-1]}" if minutes else ""
+        started = datetime.datetime.fromtimestamp(hour * 3600)
+        print(f"    {started:%Y-%m-%d %H:%M}{detail}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="soak.py",
+        description="Run the monitors' schedules for days of simulated time against a stub api.",
+    )
+    parser.add_argument(
+        "monitors",
+        nargs="*",
+        help=f"monitors to soak, all of them by default: {', '.join(MONITORS)}",
+    )
+    parser.add_argument(
+        "--days", type=float, default=3, help="simulated days per monitor"
+    )
+    parser.add_argument(
+        "--start",
+        default="2024-01-01 00:00",
+        help="simulated local start time, YYYY-MM-DD HH:MM",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the stub market")
+    parser.add_argument(
+        "--upload-minute",
+        type=int,
+        help="fixed WoW upload minute, a random one each time it is asked for by default",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the monitors' output"
+    )
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.monitors if name not in MONITORS]
+    if unknown:
+        parser.error(f"unknown monitors {unknown}, expected some of {list(MONITORS)}")
+    return args
+
+
+def main(argv=None):
+    """Soak each monitor in turn in a scratch copy of the user data.
+    Returns:
+        - int: 1 if a monitor stopped before its simulated time was up, otherwise 0."""
+    args = parse_args(argv)
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d %H:%M").timestamp()
+    for name in IGNORED_ENV:
+        os.environ.pop(name, None)
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="aetheryte-soak-")
+    copy_user_data(work_dir)
+    os.chdir(work_dir)
+    tracemalloc.start()
+    status = 0
+    try:
+        for name in args.monitors or MONITORS:
+            with open(os.devnull, "w") as devnull:
+                stdout = sys.stdout
+                if not args.verbose:
+                    sys.stdout = devnull
+                try:
+                    result = soak(name, args.days, start, args.seed, args.upload_minute)
+                finally:
+                    sys.stdout = stdout
+            report(name, args.days, result)
+            if result["outcome"] != "finished":
+                status = 1
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
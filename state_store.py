@@ -0,0 +1,38 @@
+import os
+import pickle
+
+# dedupe state is kept here between runs, e.g. for --once runs from a timer
+STATE_DIR = "state"
+
+
+def state_path(name):
+    return os.path.join(STATE_DIR, f"{name}.pickle")
+
+
+def load(name, default):
+    """Load the saved state for `name`.
+    Parameters:
+        - name (str): State name, usually the monitor name.
+        - default: Returned when there is no saved state or it cannot be read.
+    Returns:
+        - The saved object, or `default`."""
+    try:
+        with open(state_path(name), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return default
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError) as ex:
+        print(
+            f"Error: could not read saved state {state_path(name)}, starting fresh: {ex}"
+        )
+        return default
+
+
+def save(name, data):
+    """Save the state for `name`, replacing the old file atomically so a crash never leaves half a file."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = state_path(name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
@@ -1,28 +1,75 @@
 import os, json
+from concurrent.futures import ProcessPoolExecutor
 from slpp import slpp as lua
 
+ADDON_CONFIG_PATH = os.path.join("wow_user_data", "undercut", "addon_undercut.json")
+DEFAULT_UNDERCUT_FILE = os.path.join(
+    "wow_user_data", "undercut", "region_undercut.json"
+)
 
-# Safely load the JSON configuration
-try:
+
+def load_accounts():
+    """Load the accounts to check undercuts for from wow_user_data/undercut/addon_undercut.json.
+    Parameters:
+        - None
+    Returns:
+        - list: One dict per account with "name", "base_directory", "webhook" and "undercut_file".
+    Processing Logic:
+        - Accepts the single account format {"base_directory": ...} as well as
+          {"accounts": [{"name": ..., "base_directory": ..., "webhook": ...}, ...]}.
+        - "webhook" is optional, accounts without one use the webhook from the undercut config.
+        - The single account keeps using region_undercut.json, named accounts get
+          region_undercut_<name>.json unless they set "undercut_file".
+        - Without a configuration file there is one account with no base directory,
+          reading region_undercut.json as pasted in by hand."""
     # Specify the base directory and target Lua file name
     #   ex: r"E:\World of Warcraft\_retail_\WTF\Account\12345678#2"
-    config_path = os.path.join(
-        os.getcwd(), "wow_user_data", "undercut", "addon_undercut.json"
-    )
-    with open(config_path, "r", encoding="utf-8") as file:
-        config = json.load(file)
-        base_directory = config.get(
-            "base_directory"
-        )  # Using .get() to avoid KeyError if the key doesn't exist
-except FileNotFoundError:
-    print(
-        f"Configuration file not found at {config_path}. Please check the path and try again."
-    )
-except json.JSONDecodeError:
-    print("Error decoding JSON. Please check the contents of the configuration file.")
-
-# Print the base directory for verification
-print(f"Base directory from configuration: {base_directory}")
+    config_path = os.path.join(os.getcwd(), ADDON_CONFIG_PATH)
+    config = {}
+    try:
+        with open(config_path, "r", encoding="utf-8") as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        print(
+            f"Configuration file not found at {config_path}. Please check the path and try again."
+        )
+    except json.JSONDecodeError:
+        print(
+            "Error decoding JSON. Please check the contents of the configuration file."
+        )
+
+    if "accounts" not in config:
+        accounts = [
+            {
+                "name": "default",
+                "base_directory": config.get("base_directory"),
+                "undercut_file": DEFAULT_UNDERCUT_FILE,
+            }
+        ]
+    else:
+        accounts = []
+        for index, account in enumerate(config["accounts"]):
+            name = str(account.get("name", index))
+            accounts.append(
+                {
+                    "name": name,
+                    "base_directory": account.get("base_directory"),
+                    "webhook": account.get("webhook"),
+                    "undercut_file": account.get(
+                        "undercut_file",
+                        os.path.join(
+                            "wow_user_data", "undercut", f"region_undercut_{name}.json"
+                        ),
+                    ),
+                }
+            )
+
+    # Print the base directories for verification
+    for account in accounts:
+        print(
+            f"Base directory from configuration for {account['name']}: {account['base_directory']}"
+        )
+    return accounts
 
 
 def read_and_parse_lua_file(file_path):
@@ -55,44 +102,71 @@ def read_and_parse_lua_file(file_path):
         print(f"An error occurred: {e}")
 
 
-def update_region_undercut_json():
+def update_region_undercut_json(account):
     # Find the Lua file
-    """Updates the region undercut JSON file by converting Lua table data to a JSON format.
+    """Updates an account's region undercut JSON file by converting Lua table data to a JSON format.
     Parameters:
-        - None
+        - account (dict): Account from `load_accounts`.
     Returns:
         - None
     Processing Logic:
-        - The function searches for a specific Lua file in the defined base directory.
+        - The function searches for a specific Lua file in the account's base directory.
         - It parses the Lua file and converts its data into a JSON format.
-        - The output JSON data is stored in a predefined directory, creating the directory if it doesn't exist.
+        - The output JSON data is stored in the account's undercut file, creating the directory if it doesn't exist.
         - If the Lua file is not found, a message is printed indicating this."""
+    if not account["base_directory"]:
+        print(f"No base_directory set for {account['name']}, skipping the update.")
+        return
     lua_file_path = os.path.join(
-        base_directory, "SavedVariables", "SaddlebagExchangeWoW.lua"
+        account["base_directory"], "SavedVariables", "SaddlebagExchangeWoW.lua"
     )
+    print(f"Found Lua file at: {lua_file_path}")
+    write_region_undercut_json(account, read_and_parse_lua_file(lua_file_path))
 
-    # Check if the file was found and parse it
-    if lua_file_path:
-        print(f"Found Lua file at: {lua_file_path}")
-        addonData = read_and_parse_lua_file(lua_file_path)
 
-        # Convert dictionary to JSON formatted string and print it
-        json_output = json.dumps(addonData, indent=4)
-        print(json_output)
+def write_region_undercut_json(account, addonData):
+    """Write parsed addon data to the account's undercut file as JSON."""
+    # Convert dictionary to JSON formatted string and print it
+    json_output = json.dumps(addonData, indent=4)
+    print(json_output)
 
-        # Define the output directory and file path
-        output_dir = "wow_user_data/undercut"
-        output_file = "region_undercut.json"
-        output_path = os.path.join(output_dir, output_file)
-
-        # Ensure the output directory exists
+    # Ensure the output directory exists
+    output_dir = os.path.dirname(account["undercut_file"])
+    if output_dir:
         os.makedirs(output_dir, exist_ok=True)
 
-        # Write JSON data to the file
-        with open(output_path, "w", encoding="utf-8") as file:
-            file.write(json_output)
-    else:
-        print("Lua file not found.")
+    # Write JSON data to the file
+    with open(account["undercut_file"], "w", encoding="utf-8") as file:
+        file.write(json_output)
 
 
-# update_region_undercut_json()
+def update_all_region_undercut_json(accounts):
+    """Update the undercut files of several accounts, parsing their SavedVariables in parallel.
+    Parameters:
+        - accounts (list): Accounts from `load_accounts`.
+    Returns:
+        - None
+    Processing Logic:
+        - Lua parsing is CPU bound, so each file is parsed in its own worker process.
+        - A single account is parsed in this process to avoid the process start up cost.
+        - Accounts without a base directory are skipped."""
+    accounts = [account for account in accounts if account["base_directory"]]
+    if len(accounts) <= 1:
+        for account in accounts:
+            update_region_undercut_json(account)
+        return
+
+    lua_file_paths = [
+        os.path.join(
+            account["base_directory"], "SavedVariables", "SaddlebagExchangeWoW.lua"
+        )
+        for account in accounts
+    ]
+    with ProcessPoolExecutor(
+        max_workers=min(len(accounts), os.cpu_count() or 1)
+    ) as pool:
+        for account, lua_file_path, addonData in zip(
+            accounts, lua_file_paths, pool.map(read_and_parse_lua_file, lua_file_paths)
+        ):
+            print(f"Found Lua file at: {lua_file_path}")
+            write_region_undercut_json(account, addonData)
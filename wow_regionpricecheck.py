@@ -2,51 +2,172 @@
 from __future__ import print_function
 import os, json, time
 from datetime import datetime
-import requests
-from tenacity import retry, stop_after_attempt
-from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
+from message_templates import WOW_PRICECHECK_FIELDS, compile_template
+from config_watch import ConfigError, ConfigWatcher, load_json
+from deadline import record_skipped, window_deadline
+import alert_sinks
+import cassette
+import metrics
+import query_api
+from item_index import items
+from models import decode_snipes
+from price_history import PriceHistory
+from rule_engine import RuleConflictError, RuleSet
+import saddlebag_api
+import snapshot
 
-print("Sleep 10 sec on start to avoid spamming the api")
-time.sleep(10)
+# record or replay every request when AETHERYTE_CASSETTE is set
+cassette.install_from_env()
 
 WOW_DISCORD_CONSENT = "I have gone to discord and asked the devs about this api and i know it only updates once per hour and will not spam the api like an idiot and there is no point in making more than one request per hour and i will not make request for one item at a time i know many apis support calling multiple items at once"
 
 #### GLOBALS ####
 alert_record = []
-price_alert_data = json.load(open("wow_user_data/regionpricecheck/region_snipe.json"))
-if len(price_alert_data) == 0:
-    print(
-        "Error please generate your snipe data at: https://saddlebagexchange.com/wow/price-alert"
-    )
-    print("Then paste it into wow_user_data/config/regionpricecheck/single_snipe.json")
-    exit(1)
-region = price_alert_data["region"]
-
-try:
-    webhook_url = json.load(
-        open("wow_user_data/config/regionpricecheck/webhooks.json")
-    )["webhook"]
-except FileNotFoundError:
-    print(
-        "Error: No webhook file found for regionpricecheck, add your webhook to wow_user_data/config/regionpricecheck/webhooks.json"
-    )
-    exit(1)
-except KeyError:
-    print(
-        "Error: No webhook found in wow_user_data/config/regionpricecheck/webhooks.json add one in"
-    )
-    exit(1)
+# last successful api response per request, a restart in the same hour picks up from it
+responses = snapshot.Snapshot("wow_regionpricecheck")
+# every auction house price seen, see price_history.py
+history = PriceHistory("wow_regionpricecheck")
+# latest matches per request, served read only when AETHERYTE_QUERY_PORT is set
+current_results = query_api.results_for("wow_regionpricecheck")
+# Format used for each snipe message, accepts markdown formatting.
+# Accepted variables: {item_name}, {link}, {item_id}, {ah_price}, {desired_state}, {realm_names}
+pricecheck_message_template = (
+    "==================================\n"
+    + "`item:` {item_name}\n"
+    + "`price:` {ah_price}\n"
+    + "`desired_state`: {desired_state}\n"
+    + "`itemID:` {item_id}\n"
+    + "[Undermine link]({link})\n"
+    + "realmNames: {realm_names}\n"
+    + "==================================\n"
+)
+# Order in which new matches are sent, most valuable first:
+# - "price" - highest {ah_price} first
+# - "none" - in the order they were found
+alert_priority = "price"
+# Where alerts go:
+# - "discord" - the webhook in the user data
+# - "jsonl" - appended to state/alerts/wow_regionpricecheck.jsonl, or "jsonl:<file>" for another file
+# - "stdout" - printed instead of sent
+# - "null" - dropped, to measure the scans without any delivery
+# AETHERYTE_ALERT_SINK overrides this for every script.
+alert_sink = "discord"
+# rendered matches are handed to the sink as one batch per check
+sink = alert_sinks.make_sink(alert_sink, "wow_regionpricecheck")
+# compiled once on load so every row is rendered without re-parsing the template
+render_pricecheck = compile_template(
+    pricecheck_message_template, WOW_PRICECHECK_FIELDS, attributes=True
+)
 
 
-def simple_snipe(json_data):
-    payload = {"discord_consent": WOW_DISCORD_CONSENT, **json_data}
-    snipe_results = requests.post(
-        f"{URL_BASE}/wow/regionpricecheck",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json=payload,
-    ).json()
+SNIPE_PATH = "wow_user_data/regionpricecheck/region_snipe.json"
+WEBHOOKS_PATH = "wow_user_data/config/regionpricecheck/webhooks.json"
+
+
+def read_config():
+    """Read the price alert data and webhook from wow_user_data/regionpricecheck/region_snipe.json
+    and wow_user_data/config/regionpricecheck/webhooks.json.
+    Parameters:
+        None
+    Returns:
+        - tuple: (price_alert_data, region, webhook_url)
+    Processing Logic:
+        - Raises ConfigError with the reason if the data or the webhook is missing or invalid.
+    """
+    price_alert_data = load_json(SNIPE_PATH)
+    if len(price_alert_data) == 0:
+        raise ConfigError(
+            "Error please generate your snipe data at: https://saddlebagexchange.com/wow/price-alert\n"
+            + "Then paste it into wow_user_data/config/regionpricecheck/single_snipe.json"
+        )
+    if not isinstance(price_alert_data, dict) or not isinstance(
+        price_alert_data.get("user_auctions"), list
+    ):
+        raise ConfigError(
+            f"Error: {SNIPE_PATH} should have the keys ['region', 'user_auctions']"
+        )
+    try:
+        RuleSet(price_alert_data["user_auctions"])
+    except RuleConflictError:
+        pass
+    except (KeyError, TypeError, ValueError) as ex:
+        raise ConfigError(f"Error: invalid rule in {SNIPE_PATH}: {ex!r}")
+    try:
+        region = price_alert_data["region"]
+    except KeyError:
+        raise ConfigError(f"Error: no region in {SNIPE_PATH}")
+
+    try:
+        webhook_url = load_json(WEBHOOKS_PATH)["webhook"]
+    except ConfigError:
+        if os.path.exists(WEBHOOKS_PATH):
+            raise
+        raise ConfigError(
+            "Error: No webhook file found for regionpricecheck, add your webhook to wow_user_data/config/regionpricecheck/webhooks.json"
+        )
+    except KeyError:
+        raise ConfigError(
+            "Error: No webhook found in wow_user_data/config/regionpricecheck/webhooks.json add one in"
+        )
+    return price_alert_data, region, webhook_url
+
 
-    return snipe_results
+def load_config():
+    """Set the globals `price_alert_data`, `region` and `webhook_url` from `read_config`,
+    exiting with the error message if the config is invalid."""
+    global price_alert_data
+    global region
+    global webhook_url
+    try:
+        price_alert_data, region, webhook_url = read_config()
+    except ConfigError as ex:
+        print(ex)
+        exit(1)
+
+
+def reload_config():
+    """Swap in the edited config between checks.
+    Parameters:
+        None
+    Returns:
+        - bool: True if the new config was loaded, False if it was invalid and the last good
+          config is kept."""
+    global price_alert_data
+    global region
+    global webhook_url
+    try:
+        price_alert_data, region, webhook_url = read_config()
+    except ConfigError as ex:
+        print(f"{ex}\nKeeping the last good config")
+        metrics.incr("errors")
+        return False
+    print("Reloaded the price alert config")
+    return True
+
+
+def simple_snipe(json_data, deadline=None):
+    """Request the matching snipes, returning the response and its matches as WowSnipe records.
+    The request is cancelled with DeadlineExceeded once `deadline` passes."""
+    payload = {"discord_consent": WOW_DISCORD_CONSENT, **json_data}
+    snipe_results = saddlebag_api.post_json("/wow/regionpricecheck", payload, deadline)
+    key = snapshot.request_key("/wow/regionpricecheck", json_data)
+    responses.put(key, snipe_results)
+    matches = items.fill_names("wow", decode_snipes(snipe_results))
+    current_results.publish(
+        key,
+        [
+            {
+                "item_id": auction.item_id,
+                "item_name": auction.item_name,
+                "server": auction.realm_names,
+                "ah_price": auction.ah_price,
+                "desired_state": auction.desired_state,
+                "link": auction.link,
+            }
+            for auction in matches
+        ],
+    )
+    return snipe_results, matches
 
 
 def get_update_timers(region):
@@ -61,11 +182,10 @@ def get_update_timers(region):
     """
     print("Getting update timers")
     # get from api every time
-    update_timers = requests.post(
-        f"{URL_BASE}/wow/uploadtimers",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json={"discord_consent": WOW_DISCORD_CONSENT, "region": region},
-    ).json()["data"]
+    update_timers = saddlebag_api.post_json(
+        "/wow/uploadtimers",
+        {"discord_consent": WOW_DISCORD_CONSENT, "region": region},
+    )["data"]
 
     # cover specific realms
     if region == "EU":
@@ -79,70 +199,87 @@ def get_update_timers(region):
     return server_update_times
 
 
-@retry(stop=stop_after_attempt(3))
-def send_discord_message(message, webhook_url):
-    """Send a message to a Discord channel using a webhook.
-    Parameters:
-        - message (str): The message content to be sent to the Discord channel.
-        - webhook_url (str): The webhook URL for the target Discord channel.
-    Returns:
-        - bool: True if the message was sent successfully, False otherwise.
-    Processing Logic:
-        - Introduces a delay of 1 second before attempting to send the message.
-        - Raises an exception for any response with a non-2xx status code.
-        - Catches request exceptions and logs an error message."""
-    try:
-        json_data = {"content": message}
-        time.sleep(1)
-        response = requests.post(webhook_url, json=json_data)
-        response.raise_for_status()  # Raise an exception for non-2xx status codes
-        return True  # Message sent successfully
-    except requests.exceptions.RequestException as ex:
-        print("Error sending Discord message: %s", ex)
-        return False  # Failed to send the message
+def alert_value(auction):
+    """Return how valuable a match is, according to `alert_priority`."""
+    if alert_priority == "price":
+        return auction.ah_price or 0
+    return 0
 
 
-def format_discord_message():
+def format_discord_message(deadline=None):
     """Format and send Discord messages for auction snipes.
     Parameters:
-        - None
+        - deadline (Deadline, optional): When the check window closes, see deadline.py.
     Returns:
         - None
     Processing Logic:
         - Retrieves snipe data using the `simple_snipe` function and `price_alert_data`.
-        - Sends an error message to Discord if the snipe data is empty.
+        - Skips the check if the window closes before the response arrives, and counts it.
+        - Sends an error message to Discord if the snipe data is empty or the request failed.
+        - Skips the check quietly while the api's circuit breaker is open.
         - Checks for "matching" snipes and sends appropriate messages if none are found or the list is empty.
-        - Formats a message for each matching auction and sends it to Discord unless it has been recorded already.
+        - Records the price of every matching auction in the price history.
+        - Formats a message for each matching auction unless it has been recorded already, most valuable
+          first, see `alert_value`, and delivers them to the alert sink as one batch.
     """
     global alert_record
-    snipe_data = simple_snipe(price_alert_data)
+    try:
+        snipe_data, matches = simple_snipe(price_alert_data, deadline)
+    except saddlebag_api.DeadlineExceeded as ex:
+        print(ex)
+        record_skipped(["/wow/regionpricecheck"])
+        return
+    except saddlebag_api.CircuitOpenError:
+        print("Saddlebag api is unavailable, skipping this check")
+        return
+    except saddlebag_api.SaddlebagError as ex:
+        snipe_data = None
+        print(f"Error: {ex}")
     if not snipe_data:
-        send_discord_message(
-            f"An error occured got empty response {snipe_data}", webhook_url
-        )
+        metrics.incr("errors")
+        sink.send(webhook_url, [f"An error occured got empty response {snipe_data}"])
         return
     if "matching" not in snipe_data:
-        send_discord_message(f"No matching snipes found", webhook_url)
+        sink.send(webhook_url, ["No matching snipes found"])
         return
     if len(snipe_data["matching"]) == 0:
-        send_discord_message(f"No matching snipes found", webhook_url)
+        sink.send(webhook_url, ["No matching snipes found"])
         return
+    history.append(
+        (auction.item_id, auction.realm_names, auction.ah_price, None)
+        for auction in matches
+    )
 
-    for auction in snipe_data["matching"]:
-        message = (
-            "==================================\n"
-            + f"`item:` {auction['item_name']}\n"
-            + f"`price:` {auction['ah_price']}\n"
-            + f"`desired_state`: {auction['desired_state']}\n"
-            + f"`itemID:` {auction['item_id']}\n"
-            + f"[Undermine link]({auction['link']})\n"
-            + f"realmNames: {auction['realm_names']}\n"
-            + "==================================\n"
-        )
+    batch = []
+    for auction in sorted(matches, key=alert_value, reverse=True):
         if auction not in alert_record:
-            time.sleep(1)
-            send_discord_message(message, webhook_url)
+            batch.append(render_pricecheck(auction))
             alert_record.append(auction)
+    if batch:
+        sink.submit(webhook_url, batch)
+        sink.flush()
+        metrics.incr("alerts", len(batch))
+
+
+def warm_start():
+    """Restore the alert record from the results saved earlier this hour.
+    Parameters:
+        - None
+    Returns:
+        - bool: True if there are results from this hour, so the start up check can be skipped.
+    Processing Logic:
+        - The data only updates once an hour, so results from the current hour are still current.
+        - Every saved match goes into the alert record so it is not sent again, with its
+          name filled in like a fresh match so the two compare equal."""
+    global alert_record
+    hour_start = datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+    saved = responses.get_since(
+        snapshot.request_key("/wow/regionpricecheck", price_alert_data), hour_start
+    )
+    if saved is None:
+        return False
+    alert_record = items.fill_names("wow", decode_snipes(saved))
+    return True
 
 
 #### MAIN ####
@@ -153,31 +290,72 @@ def main():
     Returns:
         - None
     Processing Logic:
+        - Loads the config, then picks up from the results saved earlier this hour if there are any.
+        - Otherwise waits 10 seconds and sends a starting message, then checks once on start.
+        - Reloads the config when one of its files changes, an invalid edit keeps the last good config.
         - Clears the alert record at the start of each hour.
         - Updates the upload time one minute after the start of each hour.
         - Compares current time to designated upload minutes to trigger alert checks.
-        - Sends a formatted Discord message when the current minute matches the designated update minute range.
+        - Sends a formatted Discord message when the current minute matches the designated update minute range,
+          a check still waiting for the api when the range ends is cancelled.
     """
     global alert_record
+    query_api.start_from_env()
+    load_config()
+    if warm_start():
+        print("Warm start from results saved this hour, skipping the start up check")
+    else:
+        print("Sleep 10 sec on start to avoid spamming the api")
+        time.sleep(10)
+        if not sink.send(webhook_url, ["starting simple alerts"]):
+            print("Failed to send Discord message")
+            exit(1)
+        else:
+            print("Discord message sent successfully")
+
+        # run once on start
+        format_discord_message()
+        responses.save()
+        items.save()
     alert_item_ids = [item["itemID"] for item in price_alert_data["user_auctions"]]
     update_time = get_update_timers(region)[0]["lastUploadMinute"]
+    watcher = ConfigWatcher([SNIPE_PATH, WEBHOOKS_PATH])
     while True:
         current_min = int(datetime.now().minute)
 
+        if watcher.changed():
+            old_region = region
+            if reload_config():
+                alert_item_ids = [
+                    item["itemID"] for item in price_alert_data["user_auctions"]
+                ]
+                if region != old_region:
+                    try:
+                        update_time = get_update_timers(region)[0]["lastUploadMinute"]
+                    except saddlebag_api.SaddlebagError as ex:
+                        print(f"Keeping update minute {update_time}, {ex}")
+                        metrics.incr("errors")
+
         # clear out the alert record once an hour
         if current_min == 0:
             print("\n\nClearing Alert Record\n\n")
             alert_record = []
         # update the update min once per hour
         if current_min == 1:
-            update_time = get_update_timers(region)[0]["lastUploadMinute"]
+            try:
+                update_time = get_update_timers(region)[0]["lastUploadMinute"]
+            except saddlebag_api.SaddlebagError as ex:
+                print(f"Keeping update minute {update_time}, {ex}")
+                metrics.incr("errors")
 
         # check the upload min up 3 to 5 min after the commodities trigger
         if update_time + 3 <= current_min <= update_time + 7:
             print(
                 f"NOW AT MATCHING UPDATE MIN!!! {datetime.now()}, checking for snipes on {alert_item_ids}"
             )
-            format_discord_message()
+            format_discord_message(window_deadline(update_time, 7))
+            responses.save()
+            items.save()
             time.sleep(60)
         else:
             print(
@@ -186,14 +364,22 @@ def main():
             time.sleep(60)
 
 
-if not send_discord_message("starting simple alerts", webhook_url):
-    print("Failed to send Discord message")
-    exit(1)
-else:
-    print("Discord message sent successfully")
+def run_once():
+    """Check for snipes once and deliver the results, for cron jobs and systemd timers.
+    Parameters:
+        - None
+    Returns:
+        - None
+    Processing Logic:
+        - Skips the startup sleep and the starting message.
+        - Restores the alert record from the results a run saved earlier in the same hour,
+          like the scheduled loop after a restart, see `warm_start`."""
+    load_config()
+    warm_start()
+    format_discord_message()
+    responses.save()
+    items.save()
+
 
 if __name__ == "__main__":
-    # run once on start
-    format_discord_message()
-    # run on schedule
     main()
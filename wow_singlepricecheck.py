@@ -2,62 +2,233 @@
 from __future__ import print_function
 import os, json, time
 from datetime import datetime
-import requests
-from tenacity import retry, stop_after_attempt
-from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
+from message_templates import WOW_PRICECHECK_FIELDS, compile_template
+from config_watch import ConfigError, ConfigWatcher, load_json
+from deadline import carried_first, record_skipped, window_deadline
+import alert_sinks
+import cassette
+import metrics
+import query_api
+from item_index import items
+from models import decode_snipes
+from price_history import PriceHistory
+from rule_engine import RuleConflictError, RuleSet
+import saddlebag_api
+import snapshot
 
-print("Sleep 10 sec on start to avoid spamming the api")
-time.sleep(10)
+# record or replay every request when AETHERYTE_CASSETTE is set
+cassette.install_from_env()
 
 WOW_DISCORD_CONSENT = "I have gone to discord and asked the devs about this api and i know it only updates once per hour and will not spam the api like an idiot and there is no point in making more than one request per hour and i will not make request for one item at a time i know many apis support calling multiple items at once"
 
 #### GLOBALS ####
 alert_record = []
-price_alert_data = json.load(open("wow_user_data/singlepricecheck/snipe.json"))
-if len(price_alert_data) == 0:
-    print(
-        "Error please generate your snipe data at: https://saddlebagexchange.com/wow/price-alert"
-    )
-    print("Then paste it into wow_user_data/config/singlepricecheck/single_snipe.json")
-    exit(1)
-# error if not a list
-if not isinstance(price_alert_data, list):
-    print("Error: price_alert_data should be a list of items")
-    exit(1)
-
-if set(price_alert_data[0].keys()) != {"region", "homeRealmName", "user_auctions"}:
-    print(
-        "Error: each json in the list for price_alert_data should be a list of items with keys:"
-        + "['region', 'homeRealmName', 'user_auctions']"
-    )
-    exit(1)
+# last successful api response per request, a restart in the same hour picks up from it
+responses = snapshot.Snapshot("wow_singlepricecheck")
+# every auction house price seen, see price_history.py
+history = PriceHistory("wow_singlepricecheck")
+# latest matches per request, served read only when AETHERYTE_QUERY_PORT is set
+current_results = query_api.results_for("wow_singlepricecheck")
+# keys of the realm requests the last check did not get to, requested first next time
+carried = set()
+# Format used for each snipe message, accepts markdown formatting.
+# Accepted variables: {item_name}, {link}, {item_id}, {ah_price}, {desired_state}, {realm_names}
+pricecheck_message_template = (
+    "==================================\n"
+    + "`item:` {item_name}\n"
+    + "`price:` {ah_price}\n"
+    + "`desired_state`: {desired_state}\n"
+    + "`itemID:` {item_id}\n"
+    + "[link]({link})\n"
+    + "realmNames: {realm_names}\n"
+    + "==================================\n"
+)
+# Order in which new matches are sent, most valuable first:
+# - "price" - highest {ah_price} first
+# - "none" - in the order they were found
+alert_priority = "price"
+# Where alerts go:
+# - "discord" - the webhook in the user data
+# - "jsonl" - appended to state/alerts/wow_singlepricecheck.jsonl, or "jsonl:<file>" for another file
+# - "stdout" - printed instead of sent
+# - "null" - dropped, to measure the scans without any delivery
+# AETHERYTE_ALERT_SINK overrides this for every script.
+alert_sink = "discord"
+# rendered matches are handed to the sink as one batch per check
+sink = alert_sinks.make_sink(alert_sink, "wow_singlepricecheck")
+# compiled once on load so every row is rendered without re-parsing the template
+render_pricecheck = compile_template(
+    pricecheck_message_template, WOW_PRICECHECK_FIELDS, attributes=True
+)
+
+
+SNIPE_PATH = "wow_user_data/singlepricecheck/snipe.json"
+WEBHOOKS_PATH = "wow_user_data/config/singlepricecheck/webhooks.json"
+
+
+def read_config():
+    """Read the price alert data and webhook from wow_user_data/singlepricecheck/snipe.json
+    and wow_user_data/config/singlepricecheck/webhooks.json.
+    Parameters:
+        None
+    Returns:
+        - tuple: (price_alert_data, region, webhook_url)
+    Processing Logic:
+        - Raises ConfigError with the reason if the data or the webhook is missing or invalid.
+    """
+    price_alert_data = load_json(SNIPE_PATH)
+    if len(price_alert_data) == 0:
+        raise ConfigError(
+            "Error please generate your snipe data at: https://saddlebagexchange.com/wow/price-alert\n"
+            + "Then paste it into wow_user_data/config/singlepricecheck/single_snipe.json"
+        )
+    # error if not a list
+    if not isinstance(price_alert_data, list):
+        raise ConfigError("Error: price_alert_data should be a list of items")
+
+    for block in price_alert_data:
+        if not isinstance(block, dict) or set(block.keys()) != {
+            "region",
+            "homeRealmName",
+            "user_auctions",
+        }:
+            raise ConfigError(
+                "Error: each json in the list for price_alert_data should be a list of items with keys:"
+                + "['region', 'homeRealmName', 'user_auctions']"
+            )
+        try:
+            RuleSet(block["user_auctions"])
+        except RuleConflictError:
+            # a block with below and above rules on one item is sent on its own, see realm_requests
+            pass
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ConfigError(
+                f"Error: invalid rule for {block['homeRealmName']} in {SNIPE_PATH}: {ex!r}"
+            )
+
+    region = price_alert_data[0]["region"]
+
+    try:
+        webhook_url = load_json(WEBHOOKS_PATH)["webhook"]
+    except ConfigError:
+        if os.path.exists(WEBHOOKS_PATH):
+            raise
+        raise ConfigError(
+            "Error: No webhook file found for singlepricecheck, add your webhook to wow_user_data/config/singlepricecheck/webhooks.json"
+        )
+    except KeyError:
+        raise ConfigError(
+            "Error: No webhook found in wow_user_data/config/singlepricecheck/webhooks.json add one in"
+        )
+    return price_alert_data, region, webhook_url
+
+
+def load_config():
+    """Set the globals `price_alert_data`, `region` and `webhook_url` from `read_config`,
+    exiting with the error message if the config is invalid."""
+    global price_alert_data
+    global region
+    global webhook_url
+    try:
+        price_alert_data, region, webhook_url = read_config()
+    except ConfigError as ex:
+        print(ex)
+        exit(1)
+
+
+def reload_config():
+    """Swap in the edited config between checks.
+    Parameters:
+        None
+    Returns:
+        - bool: True if the new config was loaded, False if it was invalid and the last good
+          config is kept."""
+    global price_alert_data
+    global region
+    global webhook_url
+    try:
+        price_alert_data, region, webhook_url = read_config()
+    except ConfigError as ex:
+        print(f"{ex}\nKeeping the last good config")
+        metrics.incr("errors")
+        return False
+    print("Reloaded the price alert config")
+    return True
+
 
-region = price_alert_data[0]["region"]
+def realm_key(json_data):
+    """Return the key a realm request's response is saved under."""
+    return snapshot.request_key("/wow/pricecheck", json_data)
 
-try:
-    webhook_url = json.load(
-        open("wow_user_data/config/singlepricecheck/webhooks.json")
-    )["webhook"]
-except FileNotFoundError:
-    print(
-        "Error: No webhook file found for singlepricecheck, add your webhook to wow_user_data/config/singlepricecheck/webhooks.json"
+
+def simple_snipe(json_data, deadline=None):
+    """Request the matching snipes of one realm, returning the response and its matches
+    as WowSnipe records with the requested realm as `realm_names`.
+    The request is cancelled with DeadlineExceeded once `deadline` passes."""
+    payload = {"discord_consent": WOW_DISCORD_CONSENT, **json_data}
+    snipe_results = saddlebag_api.post_json("/wow/pricecheck", payload, deadline)
+    key = realm_key(json_data)
+    responses.put(key, snipe_results)
+    matches = items.fill_names(
+        "wow", decode_snipes(snipe_results, json_data["homeRealmName"])
     )
-    exit(1)
-except KeyError:
-    print(
-        "Error: No webhook found in wow_user_data/config/singlepricecheck/webhooks.json add one in"
+    publish_matches(key, matches)
+    return snipe_results, matches
+
+
+def publish_matches(key, matches):
+    """Replace the results the query api serves for a realm request with `matches`."""
+    current_results.publish(
+        key,
+        [
+            {
+                "item_id": auction.item_id,
+                "item_name": auction.item_name,
+                "server": auction.realm_names,
+                "ah_price": auction.ah_price,
+                "desired_state": auction.desired_state,
+                "link": auction.link,
+            }
+            for auction in matches
+        ],
     )
-    exit(1)
 
 
-def simple_snipe(json_data):
-    payload = {"discord_consent": WOW_DISCORD_CONSENT, **json_data}
-    snipe_results = requests.post(
-        f"{URL_BASE}/wow/pricecheck",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json=payload,
-    ).json()
-    return snipe_results
+def realm_requests():
+    """Group the rule blocks of `price_alert_data` into one request per realm.
+    Parameters:
+        - None
+    Returns:
+        - list: Request dicts in the snipe.json format, one per realm.
+    Processing Logic:
+        - Blocks for the same realm are merged with `RuleSet`, which keeps the loosest rule
+          per item, so the merged request matches exactly what the separate ones would.
+        - Blocks are sent as they are if they are alone on their realm, or if an item
+          has both a below and an above rule on the same realm."""
+    blocks_by_realm = {}
+    for block in price_alert_data:
+        realm = (block["region"], block["homeRealmName"])
+        blocks_by_realm.setdefault(realm, []).append(block)
+
+    realm_requests = []
+    for (region_name, realm_name), blocks in blocks_by_realm.items():
+        if len(blocks) == 1:
+            realm_requests.append(blocks[0])
+            continue
+        try:
+            rules = RuleSet.merge([RuleSet(block["user_auctions"]) for block in blocks])
+        except RuleConflictError as ex:
+            print(f"Not merging the rules for {realm_name}: {ex}")
+            realm_requests += blocks
+            continue
+        realm_requests.append(
+            {
+                "region": region_name,
+                "homeRealmName": realm_name,
+                "user_auctions": rules.to_user_auctions(),
+            }
+        )
+    return realm_requests
 
 
 def get_update_timers(region):
@@ -72,11 +243,10 @@ def get_update_timers(region):
     """
     print("Getting update timers")
     # get from api every time
-    update_timers = requests.post(
-        f"{URL_BASE}/wow/uploadtimers",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json={"discord_consent": WOW_DISCORD_CONSENT, "region": region},
-    ).json()["data"]
+    update_timers = saddlebag_api.post_json(
+        "/wow/uploadtimers",
+        {"discord_consent": WOW_DISCORD_CONSENT, "region": region},
+    )["data"]
 
     # cover specific realms
     if region == "EU":
@@ -90,70 +260,181 @@ def get_update_timers(region):
     return server_update_times
 
 
-@retry(stop=stop_after_attempt(3))
-def send_discord_message(message, webhook_url):
-    """Send a message to a Discord channel using a webhook.
-    Parameters:
-        - message (str): The message content to send to Discord.
-        - webhook_url (str): The URL of the Discord webhook to use for sending the message.
-    Returns:
-        - bool: True if the message was sent successfully, False otherwise.
-    Processing Logic:
-        - The function uses `requests.post` to send a message via a Discord webhook.
-        - It raises an exception for non-2xx HTTP status codes to ensure the request was successful.
-        - If an exception occurs during the request, it logs the error and returns False.
-    """
-    try:
-        json_data = {"content": message}
-        response = requests.post(webhook_url, json=json_data)
-        response.raise_for_status()  # Raise an exception for non-2xx status codes
-        return True  # Message sent successfully
-    except requests.exceptions.RequestException as ex:
-        print("Error sending Discord message: %s", ex)
-        return False  # Failed to send the message
+def alert_value(auction):
+    """Return how valuable a match is, according to `alert_priority`."""
+    if alert_priority == "price":
+        return auction.ah_price or 0
+    return 0
 
 
-def format_discord_message():
+def format_discord_message(deadline=None):
     """Format and send a message to Discord containing information about matching snipes found in the price alert data.
     Parameters:
-        - None
+        - deadline (Deadline, optional): When the check window closes, see deadline.py.
     Returns:
         - None
     Processing Logic:
-        - Iterates over `price_alert_data` to filter and sum matching snipe items by realm.
-        - Sends a message to Discord only if there are matching snipes.
+        - Requests the matching snipes of every realm once, see `realm_requests`, starting
+          with the realms the previous check did not get to.
+        - Realms not requested by the deadline are skipped, counted and carried into the next
+          check, the snipes of the realms done until then are still sent.
+        - A realm whose request fails is skipped, and the remaining realms are skipped while
+          the api's circuit breaker is open.
+        - "No matching snipes found" is only sent if at least one realm answered. If every
+          request failed an error message is sent instead, nothing is sent if the circuit
+          breaker was open or the deadline passed before any realm answered.
+        - Records the price of every matching snipe in the price history.
+        - Hands the messages to the alert sink as one batch only if there are matching snipes,
+          most valuable first across all realms, see `alert_value`.
         - Ensures each auction is sent only once by checking against `alert_record`."""
-    global alert_record
+    global alert_record, carried
     matching_snipes = {}
-    for single_realm_snipe in price_alert_data:
+    requests_by_realm = carried_first(realm_requests(), carried, realm_key)
+    skipped = []
+    answered = 0
+    failed = 0
+    for index, single_realm_snipe in enumerate(requests_by_realm):
         realm_name = single_realm_snipe["homeRealmName"]
-        snipe_data = simple_snipe(single_realm_snipe)
+        if deadline is not None and deadline.expired():
+            skipped = requests_by_realm[index:]
+            break
+        try:
+            snipe_data, matches = simple_snipe(single_realm_snipe, deadline)
+        except saddlebag_api.DeadlineExceeded as ex:
+            print(ex)
+            skipped = requests_by_realm[index:]
+            break
+        except saddlebag_api.CircuitOpenError:
+            print("Saddlebag api is unavailable, skipping the remaining realms")
+            break
+        except saddlebag_api.SaddlebagError as ex:
+            print(f"Error: {realm_name} {ex}")
+            metrics.incr("errors")
+            failed += 1
+            continue
+        answered += 1
         if "matching" in snipe_data:
             if realm_name not in matching_snipes:
-                matching_snipes[realm_name] = snipe_data["matching"]
+                matching_snipes[realm_name] = matches
             else:
-                matching_snipes[realm_name] += snipe_data["matching"]
+                matching_snipes[realm_name] += matches
+    carried = record_skipped(realm_key(realm) for realm in skipped)
 
+    if answered == 0:
+        if failed:
+            sink.send(
+                webhook_url,
+                [
+                    f"An error occured, no realm could be checked, {failed} requests failed"
+                ],
+            )
+        return
     if len(matching_snipes) == 0:
-        send_discord_message(f"No matching snipes found", webhook_url)
+        sink.send(webhook_url, ["No matching snipes found"])
         return
 
-    for realm_name, auctions in matching_snipes.items():
-        for auction in auctions:
-            message = (
-                "==================================\n"
-                + f"`item:` {auction['item_name']}\n"
-                + f"`price:` {auction['ah_price']}\n"
-                + f"`desired_state`: {auction['desired_state']}\n"
-                + f"`itemID:` {auction['item_id']}\n"
-                + f"[link]({auction['link']})\n"
-                + f"realmNames: {realm_name}\n"
-                + "==================================\n"
+    history.append(
+        (auction.item_id, auction.realm_names, auction.ah_price, None)
+        for auctions in matching_snipes.values()
+        for auction in auctions
+    )
+    by_value = sorted(
+        (auction for auctions in matching_snipes.values() for auction in auctions),
+        key=alert_value,
+        reverse=True,
+    )
+    batch = []
+    for auction in by_value:
+        if auction not in alert_record:
+            batch.append(render_pricecheck(auction))
+            alert_record.append(auction)
+    if batch:
+        sink.submit(webhook_url, batch)
+        sink.flush()
+        metrics.incr("alerts", len(batch))
+
+
+def recheck(previous_requests):
+    """Evaluate edited rules against the matches fetched this hour, without another api call.
+    Parameters:
+        - previous_requests (list): The `realm_requests` from before the edit.
+    Returns:
+        - None
+    Processing Logic:
+        - The data only updates once an hour, so the responses saved this hour for the old
+          requests still hold the current prices of every item they matched.
+        - Each realm's new rules are checked against those prices in one vectorized pass,
+          see `RuleSet.evaluate`, and the query api serves the matches that are kept.
+        - Kept matches that were not sent yet, e.g. after a rule flipped back, are sent.
+        - Items the old rules did not match have no saved price, the next check finds them.
+    """
+    hour_start = datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+    fetched = {}
+    for old_request in previous_requests:
+        key = realm_key(old_request)
+        saved = responses.get_since(key, hour_start)
+        # stop serving results for the old rules, the kept ones are published below
+        current_results.publish(key, [])
+        if saved is not None:
+            realm_name = old_request["homeRealmName"]
+            fetched.setdefault(realm_name, {}).update(
+                dict.fromkeys(items.fill_names("wow", decode_snipes(saved, realm_name)))
             )
+
+    batch = []
+    kept_count = 0
+    for single_realm_snipe in realm_requests():
+        matches = list(fetched.get(single_realm_snipe["homeRealmName"], {}))
+        try:
+            rules = RuleSet(single_realm_snipe["user_auctions"])
+        except RuleConflictError:
+            continue
+        meets = rules.evaluate(
+            [auction.item_id for auction in matches],
+            [
+                float("nan") if auction.ah_price is None else auction.ah_price
+                for auction in matches
+            ],
+        )
+        kept = [auction for auction, ok in zip(matches, meets) if ok]
+        publish_matches(realm_key(single_realm_snipe), kept)
+        kept_count += len(kept)
+        for auction in sorted(kept, key=alert_value, reverse=True):
             if auction not in alert_record:
-                time.sleep(1)
-                send_discord_message(message, webhook_url)
+                batch.append(render_pricecheck(auction))
                 alert_record.append(auction)
+    print(f"Edited rules keep {kept_count} of the matches fetched this hour")
+    if batch:
+        sink.submit(webhook_url, batch)
+        sink.flush()
+        metrics.incr("alerts", len(batch))
+
+
+def warm_start():
+    """Restore the alert record from the results saved earlier this hour.
+    Parameters:
+        - None
+    Returns:
+        - bool: True if every realm has results from this hour, so the start up check can be skipped.
+    Processing Logic:
+        - The data only updates once an hour, so results from the current hour are still current.
+        - Every saved match goes into the alert record so it is not sent again, with its
+          name filled in like a fresh match so the two compare equal.
+        - Realms with saved results are restored even if others have none."""
+    global alert_record
+    hour_start = datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+    saved_record = []
+    complete = True
+    for single_realm_snipe in realm_requests():
+        saved = responses.get_since(realm_key(single_realm_snipe), hour_start)
+        if saved is None:
+            complete = False
+            continue
+        saved_record += items.fill_names(
+            "wow", decode_snipes(saved, single_realm_snipe["homeRealmName"])
+        )
+    alert_record = saved_record
+    return complete
 
 
 #### MAIN ####
@@ -164,29 +445,70 @@ def main():
     Returns:
         None
     Processing Logic:
+        - Loads the config, then picks up from the results saved earlier this hour if there are any.
+        - Otherwise waits 10 seconds and sends a starting message, then checks once on start.
+        - Reloads the config when one of its files changes, an invalid edit keeps the last good config.
+          Edited rules are evaluated against this hour's prices right away, see `recheck`.
         - Clears the `alert_record` every hour when the current minute is 0.
         - Updates `update_time` once per hour when the current minute is 1.
         - Executes `format_discord_message` if the current minute falls within 3 to 7 minutes after `update_time`.
+          The check stops when that window closes.
     """
     global alert_record
+    query_api.start_from_env()
+    load_config()
+    if warm_start():
+        print("Warm start from results saved this hour, skipping the start up check")
+    else:
+        print("Sleep 10 sec on start to avoid spamming the api")
+        time.sleep(10)
+        if not sink.send(webhook_url, ["starting simple alerts"]):
+            print("Failed to send Discord message")
+            exit(1)
+        else:
+            print("Discord message sent successfully")
+
+        # run once on start
+        format_discord_message()
+        responses.save()
+        items.save()
     update_time = get_update_timers(region)[0]["lastUploadMinute"]
+    watcher = ConfigWatcher([SNIPE_PATH, WEBHOOKS_PATH])
     while True:
         current_min = int(datetime.now().minute)
 
+        if watcher.changed():
+            old_region = region
+            old_requests = realm_requests()
+            if reload_config():
+                recheck(old_requests)
+            if region != old_region:
+                try:
+                    update_time = get_update_timers(region)[0]["lastUploadMinute"]
+                except saddlebag_api.SaddlebagError as ex:
+                    print(f"Keeping update minute {update_time}, {ex}")
+                    metrics.incr("errors")
+
         # clear out the alert record once an hour
         if current_min == 0:
             print("\n\nClearing Alert Record\n\n")
             alert_record = []
         # update the update min once per hour
         if current_min == 1:
-            update_time = get_update_timers(region)[0]["lastUploadMinute"]
+            try:
+                update_time = get_update_timers(region)[0]["lastUploadMinute"]
+            except saddlebag_api.SaddlebagError as ex:
+                print(f"Keeping update minute {update_time}, {ex}")
+                metrics.incr("errors")
 
         # check the upload min up 3 to 5 min after the commodities trigger
         if update_time + 3 <= current_min <= update_time + 7:
             print(
                 f"NOW AT MATCHING UPDATE MIN!!! {datetime.now()}, checking for snipes"
             )
-            format_discord_message()
+            format_discord_message(window_deadline(update_time, 7))
+            responses.save()
+            items.save()
             time.sleep(60)
         else:
             print(
@@ -195,14 +517,22 @@ def main():
             time.sleep(60)
 
 
-if not send_discord_message("starting simple alerts", webhook_url):
-    print("Failed to send Discord message")
-    exit(1)
-else:
-    print("Discord message sent successfully")
+def run_once():
+    """Check for snipes once and deliver the results, for cron jobs and systemd timers.
+    Parameters:
+        - None
+    Returns:
+        - None
+    Processing Logic:
+        - Skips the startup sleep and the starting message.
+        - Restores the alert record from the results a run saved earlier in the same hour,
+          like the scheduled loop after a restart, see `warm_start`."""
+    load_config()
+    warm_start()
+    format_discord_message()
+    responses.save()
+    items.save()
+
 
 if __name__ == "__main__":
-    # run once on start
-    format_discord_message()
-    # run on schedule
     main()
@@ -1,75 +1,321 @@
 #!/usr/bin/python3
 from __future__ import print_function
-import os, json, time
+import os, json, time, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
-from constants import SADDLEBAG_REQUEST_HEADERS, URL_BASE
-from wow_auto_undercut_update import update_region_undercut_json
-
-print("Sleep 10 sec on start to avoid spamming the api")
-time.sleep(10)
+from constants import SADDLEBAG_REQUEST_HEADERS
+from wow_auto_undercut_update import (
+    ADDON_CONFIG_PATH,
+    load_accounts,
+    update_all_region_undercut_json,
+)
+from config_watch import ConfigError, ConfigWatcher, load_json
+from deadline import carried_first, record_skipped, window_deadline
+from message_templates import WOW_UNDERCUT_FIELDS, compile_template
+import alert_sinks
+from json_stream import iter_member_items
+from item_index import items
+from models import WowUndercut
+from payload_cache import PayloadCache, post_payload
+import metrics
+import query_api
+from price_history import PriceHistory
+import saddlebag_api
+import snapshot
+import cassette
+
+# record or replay every request when AETHERYTE_CASSETTE is set
+cassette.install_from_env()
 
 WOW_DISCORD_CONSENT = "I have gone to discord and asked the devs about this api and i know it only updates once per hour and will not spam the api like an idiot and there is no point in making more than one request per hour and i will not make request for one item at a time i know many apis support calling multiple items at once"
 
 #### GLOBALS ####
-try:
-    config_data = json.load(open("wow_user_data/config/undercut/webhooks.json"))
-    webhook_url = config_data["webhook"]
-    autoupdate = config_data["autoupdate"]
-    include_sold_not_found = config_data["include_sold_not_found"]
-except FileNotFoundError:
-    print(
-        "Error: No webhook file found for undercut, add your webhook to wow_user_data/config/undercut/webhooks.json"
-    )
-    exit(1)
-except KeyError:
-    print(
-        "Error: No webhook found in wow_user_data/config/undercut/webhooks.json add one in"
-    )
-    exit(1)
-
 alert_record = []
+# bytes read from the undercut response at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+# one entry per account in addon_undercut.json, filled in by load_config
+accounts = []
+# item ids found per realm on each account's last check, used for warm starts
+responses = snapshot.Snapshot("wow_undercut")
+# every lowest price seen on the undercut items, see price_history.py
+history = PriceHistory("wow_undercut")
+# latest undercuts per account, served read only when AETHERYTE_QUERY_PORT is set
+current_results = query_api.results_for("wow_undercut")
+# names of the accounts the last check stopped at its deadline, checked first next time
+carried = set()
+
+# Format used for each item in the undercut embeds, accepts markdown formatting.
+# Accepted variables: {item_name}, {link}, {item_id}, {lowest_price}, {user_price}
+undercut_message_template = (
+    "[Link]({link})\nItem ID: ({item_id})\n"
+    + "Lowest Price: {lowest_price}\nYour Price: {user_price}"
+)
+# Order in which undercuts are sent while discord is rate limiting, most valuable first:
+# - "value" - highest {user_price} first
+# - "gap" - biggest difference between {user_price} and {lowest_price} first
+# - "none" - in the order they were found
+alert_priority = "value"
+# Where alerts go:
+# - "discord" - the webhook in the user data
+# - "jsonl" - appended to state/alerts/wow_undercut.jsonl, or "jsonl:<file>" for another file
+# - "stdout" - printed instead of sent
+# - "null" - dropped, to measure the scans without any delivery
+# AETHERYTE_ALERT_SINK overrides this for every script.
+alert_sink = "discord"
+# embeds are queued here so they go out while later realms are still being read
+sink = alert_sinks.make_sink(alert_sink, "wow_undercut")
+# compiled once on load so every row is rendered without re-parsing the template
+render_undercut = compile_template(
+    undercut_message_template, WOW_UNDERCUT_FIELDS, attributes=True
+)
+
+
+WEBHOOKS_PATH = "wow_user_data/config/undercut/webhooks.json"
+
+
+def read_config():
+    """Read the webhook and options from wow_user_data/config/undercut/webhooks.json
+    and the accounts from wow_user_data/undercut/addon_undercut.json.
+    Parameters:
+        None
+    Returns:
+        - tuple: (webhook_url, autoupdate, include_sold_not_found, account_configs)
+    Processing Logic:
+        - Raises ConfigError with the reason if the file or the webhook is missing, or if
+          addon_undercut.json exists but is not valid JSON."""
+    try:
+        config_data = load_json(WEBHOOKS_PATH)
+        webhook_url = config_data["webhook"]
+        autoupdate = config_data["autoupdate"]
+        include_sold_not_found = config_data["include_sold_not_found"]
+    except ConfigError:
+        if os.path.exists(WEBHOOKS_PATH):
+            raise
+        raise ConfigError(
+            "Error: No webhook file found for undercut, add your webhook to wow_user_data/config/undercut/webhooks.json"
+        )
+    except (KeyError, TypeError):
+        raise ConfigError(
+            "Error: No webhook found in wow_user_data/config/undercut/webhooks.json add one in"
+        )
+    if os.path.exists(ADDON_CONFIG_PATH):
+        load_json(ADDON_CONFIG_PATH)
+    return webhook_url, autoupdate, include_sold_not_found, load_accounts()
+
+
+def build_accounts(account_configs, default_webhook, current=()):
+    """Create the accounts to check, reusing those in `current` whose config and webhook
+    are unchanged so they keep their loaded data and encoded request."""
+    existing = {
+        (json.dumps(account.config, sort_keys=True), account.webhook_url): account
+        for account in current
+    }
+    built = []
+    for config in account_configs:
+        account_webhook = config.get("webhook") or default_webhook
+        key = (json.dumps(config, sort_keys=True), account_webhook)
+        built.append(existing.get(key) or UndercutAccount(config, account_webhook))
+    return built
 
 
-def update_user_undercut_data():
-    """Updates the user undercut data from a specified JSON file.
+def load_config():
+    """Load the webhook and options from wow_user_data/config/undercut/webhooks.json.
     Parameters:
         None
     Returns:
         None
     Processing Logic:
-        - Utilizes global variables `undercut_alert_data`, `region`, and `home_realm_id`.
-        - Conducts an automatic update if `autoupdate` is enabled.
-        - Loads data from 'wow_user_data/undercut/region_undercut.json'.
-        - Exits with an error message if the JSON data is missing or empty."""
-    global undercut_alert_data
-    global region
-    global home_realm_id
-    if autoupdate:
-        update_region_undercut_json()
-    undercut_alert_data = json.load(open("wow_user_data/undercut/region_undercut.json"))
-    if not undercut_alert_data or len(undercut_alert_data) == 0:
-        print(
-            "Error please generate your undercut data from our addon: https://www.curseforge.com/wow/addons/saddlebag-exchange"
-        )
-        print("Then paste it into wow_user_data/undercut/region_undercut.json")
-        print(
-            "Or setup automatic updates with wow_user_data/undercut/addon_undercut.json"
-        )
+        - Sets the globals `webhook_url`, `autoupdate`, `include_sold_not_found` and `accounts`.
+        - Accounts come from wow_user_data/undercut/addon_undercut.json and default to this webhook.
+        - Exits with an error message if the file or the webhook is missing."""
+    global webhook_url
+    global autoupdate
+    global include_sold_not_found
+    global accounts
+    try:
+        webhook_url, autoupdate, include_sold_not_found, account_configs = read_config()
+    except ConfigError as ex:
+        print(ex)
         exit(1)
-    region = undercut_alert_data[0]["region"]
-    home_realm_id = undercut_alert_data[0]["homeRealmName"]
+    accounts = build_accounts(account_configs, webhook_url)
 
 
-def simple_undercut(json_data):
-    payload = {"discord_consent": WOW_DISCORD_CONSENT, **json_data}
-    snipe_results = requests.post(
-        f"{URL_BASE}/wow/regionundercut",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json=payload,
-    ).json()
+def reload_config():
+    """Swap in the edited config between checks.
+    Parameters:
+        None
+    Returns:
+        - bool: True if the new config was loaded, False if it was invalid and the last good
+          config is kept.
+    Processing Logic:
+        - Accounts whose settings did not change are kept as they are, new accounts load their
+          undercut file right away so their region's update minute can be looked up."""
+    global webhook_url
+    global autoupdate
+    global include_sold_not_found
+    global accounts
+    try:
+        new_webhook_url, new_autoupdate, new_include_sold_not_found, account_configs = (
+            read_config()
+        )
+    except ConfigError as ex:
+        print(f"{ex}\nKeeping the last good config")
+        metrics.incr("errors")
+        return False
+    webhook_url = new_webhook_url
+    autoupdate = new_autoupdate
+    include_sold_not_found = new_include_sold_not_found
+    accounts = build_accounts(account_configs, webhook_url, accounts)
+    for account in accounts:
+        if account.data_key is None:
+            account.load()
+    print(f"Reloaded the undercut config, accounts: {[a.name for a in accounts]}")
+    return True
+
+
+class UndercutAccount:
+    """Undercut data and delivery settings for one WoW account.
+    Parameters:
+        - config (dict): The account from addon_undercut.json, see `load_accounts`.
+        - webhook_url (str): Webhook the account's undercuts are sent to.
+    Processing Logic:
+        - `addon_data`, `region` and `home_realm_id` are filled in from the account's undercut file.
+        - `pet_ids` are the battle pet species ids in that file, the api sends them back as
+          item ids, see `fill_names`.
+        - The encoded addonData request is kept per account and reused until that file changes.
+    """
 
-    return snipe_results
+    def __init__(self, config, webhook_url):
+        self.config = config
+        self.name = config["name"]
+        self.undercut_file = config["undercut_file"]
+        self.webhook_url = webhook_url
+        self.addon_data = None
+        self.region = None
+        self.home_realm_id = None
+        self.pet_ids = frozenset()
+        self.data_key = None
+        self.payload_cache = PayloadCache(f"addon_{self.name}")
+
+    def load(self):
+        """Load the undercut file, skipping the decode if it has not changed.
+        Returns:
+            - bool: True if the account has undercut data to check."""
+        try:
+            with open(self.undercut_file, "rb") as f:
+                raw_data = f.read()
+        except FileNotFoundError:
+            raw_data = b""
+        data_key = hashlib.blake2b(raw_data, digest_size=16).digest()
+        if data_key == self.data_key:
+            return self.addon_data is not None
+        self.data_key = data_key
+        self.addon_data = json.loads(raw_data) if raw_data.strip() else None
+        if not self.addon_data:
+            self.addon_data = None
+            print(
+                "Error please generate your undercut data from our addon: https://www.curseforge.com/wow/addons/saddlebag-exchange"
+            )
+            print(f"Then paste it into {self.undercut_file}")
+            print(
+                "Or setup automatic updates with wow_user_data/undercut/addon_undercut.json"
+            )
+            return False
+        self.region = self.addon_data[0]["region"]
+        self.home_realm_id = self.addon_data[0]["homeRealmName"]
+        auctions = [
+            auction for realm in self.addon_data for auction in realm["user_auctions"]
+        ]
+        # an id listed both as an item and as a pet cannot be told apart, keep it an item
+        self.pet_ids = frozenset(
+            auction["petID"] for auction in auctions if "petID" in auction
+        ) - {auction["itemID"] for auction in auctions if "itemID" in auction}
+        return True
+
+
+def update_user_undercut_data(to_update):
+    """Updates the user undercut data of the given accounts from their JSON files.
+    Parameters:
+        - to_update (list): The accounts to update.
+    Returns:
+        - list: The accounts that have undercut data to check.
+    Processing Logic:
+        - Conducts an automatic update if `autoupdate` is enabled, parsing every account's SavedVariables in parallel.
+        - Loads each account's undercut file, skipping the decode if the file is unchanged.
+        - Exits with an error message if no account has any undercut data."""
+    if autoupdate:
+        update_all_region_undercut_json([account.config for account in to_update])
+    ready = [account for account in to_update if account.load()]
+    if not ready:
+        exit(1)
+    return ready
+
+
+def simple_undercut(account, deadline=None):
+    """Request region undercuts for an account and stream the results one realm at a time.
+    Parameters:
+        - account (UndercutAccount): The account to check.
+        - deadline (Deadline, optional): The check's deadline, it also bounds the request timeout.
+    Returns:
+        - generator: Yields (realm, realm_results) tuples from `results_by_realm` as they are read.
+    Processing Logic:
+        - The payload is encoded once per version of the undercut file and sent gzip compressed.
+        - The response body is streamed, so only the realm being decoded is held in memory.
+        - The request goes through the api's circuit breaker, failed requests raise SaddlebagError.
+        - The request keeps its concurrency slot until the body is read, a body that breaks off
+          or times out counts as congestion, see `saddlebag_api.ConcurrencyLimiter`.
+        - Raises DeadlineExceeded if the deadline passes before or while the response is read.
+        - Raises ValueError if the response is empty, not JSON or has no `results_by_realm`.
+    """
+    # note that the region and homeRealmID are legacy dummy data and dont matter
+    payload = account.payload_cache.get(
+        account.data_key,
+        lambda: {
+            "discord_consent": WOW_DISCORD_CONSENT,
+            "region": "foo",
+            "homeRealmID": 1,
+            "addonData": account.addon_data,
+        },
+    )
+    response = saddlebag_api.call(
+        "/wow/regionundercut",
+        lambda base: post_payload(
+            f"addon_{account.name}",
+            f"{base}/wow/regionundercut",
+            payload,
+            SADDLEBAG_REQUEST_HEADERS,
+            stream=True,
+            timeout=saddlebag_api.request_timeout(deadline),
+        ),
+        deadline,
+        stream=True,
+    )
+    congested = False
+    cancelled = False
+    try:
+        yield from iter_member_items(
+            response.iter_content(STREAM_CHUNK_SIZE), "results_by_realm"
+        )
+    except GeneratorExit:
+        # the caller stopped reading, e.g. at the check deadline
+        cancelled = True
+        raise
+    except (ValueError, requests.exceptions.RequestException) as ex:
+        # a read that timed out at the check deadline is not the api's fault
+        if isinstance(ex, requests.exceptions.RequestException) and (
+            deadline is not None and deadline.expired()
+        ):
+            cancelled = True
+            raise saddlebag_api.DeadlineExceeded(
+                "/wow/regionundercut response cut off at the check deadline"
+            )
+        congested = isinstance(ex, requests.exceptions.RequestException)
+        # a body cut off or garbled mid stream counts against the endpoint too
+        saddlebag_api.breaker_for("/wow/regionundercut").record_failure()
+        raise
+    finally:
+        saddlebag_api.finish_stream(response, congested, cancelled)
 
 
 def get_update_timers(region, simple_undercut=False):
@@ -86,11 +332,10 @@ def get_update_timers(region, simple_undercut=False):
     """
     print("Getting update timers")
     # get from api every time
-    update_timers = requests.post(
-        f"{URL_BASE}/wow/uploadtimers",
-        headers=SADDLEBAG_REQUEST_HEADERS,
-        json={"discord_consent": WOW_DISCORD_CONSENT, "region": region},
-    ).json()["data"]
+    update_timers = saddlebag_api.post_json(
+        "/wow/uploadtimers",
+        {"discord_consent": WOW_DISCORD_CONSENT, "region": region},
+    )["data"]
 
     # cover specific realms
     if simple_undercut:
@@ -114,25 +359,14 @@ def get_update_timers(region, simple_undercut=False):
     return server_update_times
 
 
-def send_to_discord(embed, webhook_url):
-    # Send message
-    # print(f"sending embed to discord...")
-    """Send an embed message to a Discord channel via a webhook.
-    Parameters:
-        - embed (dict): The embedded message content formatted as a dictionary.
-        - webhook_url (str): The URL of the Discord webhook for sending messages.
-    Returns:
-        - None
-    Processing Logic:
-        - Makes an HTTP POST request to the Discord webhook with the provided embed.
-        - Logs a success message if the status code of the response is 200 or 204.
-        - Logs an error message containing the status code and response text if the request fails.
-    """
-    req = requests.post(webhook_url, json={"embeds": [embed]})
-    if req.status_code != 204 and req.status_code != 200:
-        print(f"Failed to send embed to discord: {req.status_code} - {req.text}")
-    else:
-        print(f"Embed sent successfully")
+def alert_value(value):
+    """Return how valuable an undercut item is, according to `alert_priority`."""
+    user_price = value.user_price or 0
+    if alert_priority == "value":
+        return user_price
+    if alert_priority == "gap":
+        return user_price - (value.lowest_price or user_price)
+    return 0
 
 
 def create_embed(title, description, fields, color="red"):
@@ -184,80 +418,208 @@ def split_list(input_list, max_length):
     ]
 
 
-def format_discord_message():
-    """Formats and sends a Discord message with item data, including undercut and not found items.
+def format_discord_message(to_check=None, deadline=None):
+    """Formats and sends Discord messages with item data, including undercut and not found items, for every account.
     Parameters:
-        - None
+        - to_check (list, optional): Accounts to check, defaults to all accounts.
+        - deadline (Deadline, optional): When the check window closes, see deadline.py.
     Returns:
         - None
     Processing Logic:
         - Updates item data using a function designed to track undercuts.
-        - Handles empty responses by sending an error message to a Discord webhook.
-        - Constructs embedded messages with item information for undercut and not found datasets, split into manageable parts for Discord.
+        - Sends every account's request at the same time, each on its own thread, starting
+          with the accounts the previous check did not finish.
+        - Accounts still running at the deadline stop, the realms read until then are delivered
+          and the accounts are counted and carried into the next check.
+        - Returns once all accounts are done and every queued embed has been delivered,
+          then saves what was found for a warm start.
     """
-    global alert_record
+    global carried
     # update to latest data
-    update_user_undercut_data()
-    # note that the global region and homeRealmID are legacy dummy data and dont matter
-    raw_undercut_data = simple_undercut(
-        {"region": "foo", "homeRealmID": 1, "addonData": undercut_alert_data}
+    ready = carried_first(
+        update_user_undercut_data(accounts if to_check is None else to_check),
+        carried,
+        lambda account: account.name,
     )
-    if not raw_undercut_data:
-        send_discord_message(
-            f"An error occured got empty response {raw_undercut_data}", webhook_url
+    with ThreadPoolExecutor(max_workers=len(ready)) as pool:
+        finished = list(
+            pool.map(lambda account: check_account_undercuts(account, deadline), ready)
         )
-        return
-    for realm, json_data in raw_undercut_data["results_by_realm"].items():
-        embed_uc = []
-        embed_nf = []
-
-        for dataset in ["undercuts", "not_found"]:
-            for value in json_data[dataset]:
-                # logger.info(value)
-
-                item_name = value.pop("item_name")
-                item_id = value.pop("item_id")
-                link = value.pop("link")
-                desc = (
-                    f"[Link]({link})\nItem ID: ({item_id})\n"
-                    + f"Lowest Price: {value['lowest_price']}\nYour Price: {value['user_price']}"
-                )
+    carried = record_skipped(
+        account.name for account, done in zip(ready, finished) if not done
+    )
+    sink.flush()
+    responses.save()
+    items.save()
+    metrics.report()
+
 
-                if dataset == "undercuts":
-                    embed_uc.append(
-                        {"name": f"**{item_name}**", "value": desc, "inline": True}
-                    )
-                else:
-                    embed_nf.append(
-                        {"name": f"**{item_name}**", "value": desc, "inline": True}
-                    )
-
-        # send message for each realm
-        if len(embed_uc) > 0:
-            # split embed_uc into lists no longer than 25
-            split_uc = split_list(embed_uc, 25)
-            for uc in split_uc:
-                embed = create_embed(
-                    "Undercuts",
-                    f"List of your items that are undercut!\nRealm: {realm}\nRegion: {region}\n",
-                    uc,
-                    "red",
+def fill_names(account, values):
+    """Fill in the names of an account's WowUndercut records from the item index, looking
+    up the account's battle pets by species id so they never take the name of an item.
+    """
+    return [
+        items.fill_names(
+            "wow_pet" if value.item_id in account.pet_ids else "wow", [value]
+        )[0]
+        for value in values
+    ]
+
+
+def check_account_undercuts(account, deadline=None):
+    """Request the undercuts of one account and queue the embeds to its webhook.
+    Parameters:
+        - account (UndercutAccount): The account to check.
+        - deadline (Deadline, optional): When to stop reading the response.
+    Returns:
+        - bool: False if the deadline passed before the whole response was read.
+    Processing Logic:
+        - Reads the response one realm at a time, decodes it into WowUndercut records and queues
+          that realm's embeds before reading the next.
+        - Handles empty or invalid responses by sending an error message to the account's webhook.
+        - Skips the account quietly while the api's circuit breaker is open.
+        - Saves the item ids found per realm once the whole response has been read,
+          and records the lowest price of every undercut item in the price history.
+        - At the deadline the realms queued so far are kept and recorded, but the response is
+          not saved for a warm start since it is incomplete.
+    """
+    found = {}
+    prices = []
+    rows = []
+    try:
+        for realm, json_data in simple_undercut(account, deadline):
+            undercuts = fill_names(
+                account,
+                [WowUndercut.from_json(value) for value in json_data["undercuts"]],
+            )
+            not_found = fill_names(
+                account,
+                [WowUndercut.from_json(value) for value in json_data["not_found"]],
+            )
+            found[realm] = {
+                "undercuts": [value.item_id for value in undercuts],
+                "not_found": [value.item_id for value in not_found],
+            }
+            prices += [
+                (value.item_id, realm, value.lowest_price, None) for value in undercuts
+            ]
+            rows += [
+                {
+                    "item_id": value.item_id,
+                    "item_name": value.item_name,
+                    "server": realm,
+                    "retainer": account.name,
+                    "state": dataset,
+                    "lowest_price": value.lowest_price,
+                    "user_price": value.user_price,
+                    "link": value.link,
+                }
+                for dataset, values in [
+                    ("undercuts", undercuts),
+                    ("not_found", not_found),
+                ]
+                for value in values
+            ]
+            queue_realm_embeds(account, realm, undercuts, not_found)
+            if deadline is not None and deadline.expired():
+                raise saddlebag_api.DeadlineExceeded(
+                    f"{account.name} stopped at the check deadline after {len(found)} realms"
                 )
-                send_to_discord(embed, webhook_url)
-            time.sleep(1)
-
-        if len(embed_nf) > 0 and include_sold_not_found:
-            # split embed_uc into lists no longer than 25
-            split_nf = split_list(embed_nf, 25)
-            for nf in split_nf:
-                embed = create_embed(
-                    "Sold, Expired or Not Found",
-                    f"List of items with price levels not found in the blizzard api data.\nRealm: {realm}\nRegion: {region}\n",
-                    nf,
-                    "green",
+        responses.put(undercut_key(account), found)
+        history.append(prices)
+        current_results.publish(account.name, rows)
+    except saddlebag_api.DeadlineExceeded as ex:
+        print(ex)
+        history.append(prices)
+        current_results.publish(account.name, rows)
+        return False
+    except saddlebag_api.CircuitOpenError:
+        print(f"Saddlebag api is unavailable, skipping {account.name}")
+    except (KeyError, ValueError, saddlebag_api.SaddlebagError) as ex:
+        metrics.incr("errors")
+        sink.send(
+            account.webhook_url,
+            [f"An error occured got invalid response for {account.name}: {ex}"],
+        )
+    return True
+
+
+def undercut_key(account):
+    return snapshot.request_key("/wow/regionundercut", account.data_key.hex())
+
+
+def warm_start():
+    """Check whether every account was already checked this hour with its current undercut data.
+    Parameters:
+        - None
+    Returns:
+        - bool: True if the start up check can be skipped.
+    Processing Logic:
+        - Loads the accounts first, so an undercut file changed while stopped gets a fresh check.
+        - The data only updates once an hour, so results from the current hour are still current.
+    """
+    ready = update_user_undercut_data(accounts)
+    hour_start = datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+    return all(
+        responses.get_since(undercut_key(account), hour_start) is not None
+        for account in ready
+    )
+
+
+def queue_realm_embeds(account, realm, undercuts, not_found):
+    """Build and queue the undercut and not found embeds for a single realm.
+    Parameters:
+        - account (UndercutAccount): The account the results belong to.
+        - realm (str): Realm name the results belong to.
+        - undercuts (list): WowUndercut records of the undercut items, see models.py.
+        - not_found (list): WowUndercut records of the sold, expired or not found items.
+    Returns:
+        - None
+    Processing Logic:
+        - Sorts each dataset by `alert_value` and splits it into embeds of at most 25 fields,
+          which go to the sink as one batch prioritized by its most valuable item.
+        - Not found items are only sent when `include_sold_not_found` is enabled."""
+    embeds = [
+        (
+            "undercuts",
+            undercuts,
+            "Undercuts",
+            "List of your items that are undercut!",
+            "red",
+        ),
+        (
+            "not_found",
+            not_found,
+            "Sold, Expired or Not Found",
+            "List of items with price levels not found in the blizzard api data.",
+            "green",
+        ),
+    ]
+    for dataset, values, title, description, color in embeds:
+        if not values or (dataset == "not_found" and not include_sold_not_found):
+            continue
+        values = sorted(values, key=alert_value, reverse=True)
+        batch = []
+        # split into embeds no longer than 25 fields
+        for chunk in split_list(values, 25):
+            fields = [
+                {
+                    "name": f"**{value.item_name}**",
+                    "value": render_undercut(value),
+                    "inline": True,
+                }
+                for value in chunk
+            ]
+            batch.append(
+                create_embed(
+                    title,
+                    f"{description}\nRealm: {realm}\nRegion: {account.region}\n",
+                    fields,
+                    color,
                 )
-                send_to_discord(embed, webhook_url)
-                time.sleep(1)
+            )
+        sink.submit(account.webhook_url, batch, alert_value(values[0]))
+        metrics.incr("alerts", len(values))
 
 
 #### MAIN ####
@@ -268,15 +630,50 @@ def main():
     Returns:
         - None
     Processing Logic:
+        - Loads the config, then skips the start up check if every account was checked this hour.
+        - Otherwise waits 10 seconds and sends a starting message, then checks once on start.
+        - Reloads the config when one of its files changes, an invalid edit keeps the last good config.
         - Clears the alert record at the start of each hour.
-        - Checks and processes undercuts within a certain time window after the update trigger.
+        - Checks and processes each account's undercuts within a certain time window after its region's update trigger,
+          a check that is still running when the window closes stops there, see deadline.py.
         - Pauses execution for a minute both during the active check and while waiting.
     """
     global alert_record
-    update_time = get_update_timers(region, True)[0]["lastUploadMinute"]
+    query_api.start_from_env()
+    load_config()
+    if warm_start():
+        print("Warm start from results saved this hour, skipping the start up check")
+    else:
+        print("Sleep 10 sec on start to avoid spamming the api")
+        time.sleep(10)
+        if not sink.send(webhook_url, ["starting simple undercuts"]):
+            print("Failed to send Discord message")
+            exit(1)
+        else:
+            print("Discord message sent successfully")
+
+        # run once on start
+        format_discord_message()
+    update_times = {
+        region: get_update_timers(region, True)[0]["lastUploadMinute"]
+        for region in {account.region for account in accounts if account.region}
+    }
+    watcher = ConfigWatcher([WEBHOOKS_PATH, ADDON_CONFIG_PATH])
     while True:
         current_min = int(datetime.now().minute)
 
+        if watcher.changed() and reload_config():
+            for region in {account.region for account in accounts if account.region}:
+                if region in update_times:
+                    continue
+                try:
+                    update_times[region] = get_update_timers(region, True)[0][
+                        "lastUploadMinute"
+                    ]
+                except saddlebag_api.SaddlebagError as ex:
+                    print(f"No update minute for {region} yet, {ex}")
+                    metrics.incr("errors")
+
         # clear out the alert record once an hour
         if current_min == 0:
             print("\n\nClearing Alert Record\n\n")
@@ -287,51 +684,43 @@ def main():
         #     update_time = get_update_timers(region, True)[0]["lastUploadMinute"]
 
         # check the upload min up 3 to 5 min after the commodities trigger
-        if update_time + 3 <= current_min <= update_time + 5:
+        due = [
+            account
+            for account in accounts
+            if account.region in update_times
+            and update_times[account.region] + 3
+            <= current_min
+            <= update_times[account.region] + 5
+        ]
+        if due:
             print(
-                f"NOW AT MATCHING UPDATE MIN!!! {datetime.now()}, checking for undercuts"
+                f"NOW AT MATCHING UPDATE MIN!!! {datetime.now()}, checking for undercuts on {[account.name for account in due]}"
+            )
+            # stop when the last of their check windows closes
+            format_discord_message(
+                due,
+                window_deadline(
+                    max(update_times[account.region] for account in due), 5
+                ),
             )
-            if autoupdate:
-                update_region_undercut_json()
-            format_discord_message()
             time.sleep(60)
         else:
-            print(
-                f"at {datetime.now()}, waiting for {[update_time]} to check undercuts"
-            )
+            print(f"at {datetime.now()}, waiting for {update_times} to check undercuts")
             time.sleep(60)
 
 
-def send_discord_message(message, webhook_url):
-    """Send a message to a Discord channel using a webhook.
+def run_once():
+    """Check for undercuts once and deliver the results, for cron jobs and systemd timers.
     Parameters:
-        - message (str): The message content to send to Discord.
-        - webhook_url (str): The URL of the Discord webhook to use for sending the message.
+        - None
     Returns:
-        - bool: True if the message was sent successfully, False otherwise.
+        - None
     Processing Logic:
-        - The function uses `requests.post` to send a message via a Discord webhook.
-        - It raises an exception for non-2xx HTTP status codes to ensure the request was successful.
-        - If an exception occurs during the request, it logs the error and returns False.
-    """
-    try:
-        json_data = {"content": message}
-        response = requests.post(webhook_url, json=json_data)
-        response.raise_for_status()  # Raise an exception for non-2xx status codes
-        return True  # Message sent successfully
-    except requests.exceptions.RequestException as ex:
-        print("Error sending Discord message: %s", ex)
-        return False  # Failed to send the message
-
+        - Skips the startup sleep and the starting message.
+        - Returns once every queued embed has been delivered."""
+    load_config()
+    format_discord_message()
 
-if not send_discord_message("starting simple undercuts", webhook_url):
-    print("Failed to send Discord message")
-    exit(1)
-else:
-    print("Discord message sent successfully")
 
 if __name__ == "__main__":
-    # run once on start
-    format_discord_message()
-    # run on schedule
     main()